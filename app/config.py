@@ -3,25 +3,114 @@ from __future__ import annotations
 from functools import lru_cache
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
-from dotenv import load_dotenv
-import os
- # Ensure .env is loaded into process environment before settings are constructed
-load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env"), override=False)
-load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env.example"), override=False)
 
 
 class Settings(BaseSettings):
     gemini_api_key: str | None = Field(default=None, validation_alias="GEMINI_API_KEY")
-    gemini_model: str = Field(default=os.getenv("MODEL", "gemini-1.5-pro-latest"), validation_alias="MODEL")
+    # Pool de claves (separadas por comas); si está vacío se usa solo GEMINI_API_KEY
+    gemini_api_keys: str = Field(default="", validation_alias="GEMINI_API_KEYS")
+    key_pool_strategy: str = Field(default="round_robin", validation_alias="KEY_POOL_STRATEGY")  # round_robin | least_loaded
+    key_bench_s: float = Field(default=60.0, validation_alias="KEY_BENCH_S")
+    # Cuota por clave y minuto (0 = sin límite local; solo para repartir carga y medir utilización)
+    key_rpm_limit: int = Field(default=0, validation_alias="KEY_RPM_LIMIT")
+    key_tpm_limit: int = Field(default=0, validation_alias="KEY_TPM_LIMIT")
+    gemini_model: str = Field(default="gemini-1.5-pro-latest", validation_alias="MODEL")
     mock_mode: bool = Field(default=True, validation_alias="MOCK_MODE")
     timeout_s: float = Field(default=30.0, validation_alias="TIMEOUT_S")
     max_input_chars: int = Field(default=12000, validation_alias="MAX_INPUT_CHARS")
     log_level: str = Field(default="INFO", validation_alias="LOG_LEVEL")
     enable_history: bool = Field(default=True, validation_alias="ENABLE_HISTORY")
+    # Base del historial (SQLAlchemy); vacío = SQLite en data/chat_history.db
+    database_url: str | None = Field(default=None, validation_alias="DATABASE_URL")
+    # Cache-Control de /history, /sensors/history y /stats (segundos; 0 y 0 = no-cache, solo revalidación por ETag)
+    http_cache_max_age_s: int = Field(default=5, validation_alias="HTTP_CACHE_MAX_AGE_S")
+    http_cache_cdn_max_age_s: int = Field(default=10, validation_alias="HTTP_CACHE_CDN_MAX_AGE_S")
+    # Backend del modelo: "gemini" (real) o "fake" (simulado, para pruebas de carga)
+    model_backend: str = Field(default="gemini", validation_alias="MODEL_BACKEND")
+    fake_model_latency_ms: float = Field(default=800.0, validation_alias="FAKE_MODEL_LATENCY_MS")
+    fake_model_error_rate: float = Field(default=0.0, validation_alias="FAKE_MODEL_ERROR_RATE")
+    # Administración (traza y perfilado); sin token los endpoints /admin no existen
+    admin_token: str | None = Field(default=None, validation_alias="ADMIN_TOKEN")
+    trace_enabled: bool = Field(default=False, validation_alias="TRACE_ENABLED")
+    trace_max_events: int = Field(default=20000, validation_alias="TRACE_MAX_EVENTS")
+    # Control de admisión: token bucket por cliente (0 = sin límite) y concurrencia hacia el modelo
+    rate_limit_per_minute: float = Field(default=60.0, validation_alias="RATE_LIMIT_PER_MINUTE")
+    rate_limit_burst: int = Field(default=20, validation_alias="RATE_LIMIT_BURST")
+    # API keys de clientes con bucket propio (X-API-Key, separadas por comas); el resto se limita por IP
+    client_api_keys: str = Field(default="", validation_alias="CLIENT_API_KEYS")
+    max_concurrent_model_calls: int = Field(default=8, validation_alias="MAX_CONCURRENT_MODEL_CALLS")
+    max_model_queue: int = Field(default=32, validation_alias="MAX_MODEL_QUEUE")
+    model_queue_timeout_s: float = Field(default=10.0, validation_alias="MODEL_QUEUE_TIMEOUT_S")
+    # Circuit breaker del modelo
+    breaker_window: int = Field(default=20, validation_alias="BREAKER_WINDOW")
+    breaker_min_calls: int = Field(default=5, validation_alias="BREAKER_MIN_CALLS")
+    breaker_failure_rate: float = Field(default=0.5, validation_alias="BREAKER_FAILURE_RATE")
+    breaker_slow_call_s: float = Field(default=20.0, validation_alias="BREAKER_SLOW_CALL_S")
+    breaker_open_s: float = Field(default=30.0, validation_alias="BREAKER_OPEN_S")
+    breaker_half_open_probes: int = Field(default=2, validation_alias="BREAKER_HALF_OPEN_PROBES")
+    # Caché de respuestas de texto: memory (por proceso) o sqlite (archivo compartido por los workers del host)
+    response_cache_backend: str = Field(default="memory", validation_alias="RESPONSE_CACHE_BACKEND")
+    response_cache_path: str = Field(default="data/response_cache.db", validation_alias="RESPONSE_CACHE_PATH")
+    response_cache_ttl_s: float = Field(default=3600.0, validation_alias="RESPONSE_CACHE_TTL_S")
+    response_cache_max_entries: int = Field(default=1000, validation_alias="RESPONSE_CACHE_MAX_ENTRIES")
+    # Motor de reglas (rangos por cultivo/etapa); RULES_FIRST responde lecturas con regla confiable sin llamar al modelo
+    rules_path: str | None = Field(default=None, validation_alias="RULES_PATH")
+    rules_first: bool = Field(default=False, validation_alias="RULES_FIRST")
+    # Términos sensibles adicionales a enmascarar (separados por comas, literales)
+    sanitize_extra_terms: str = Field(default="", validation_alias="SANITIZE_EXTRA_TERMS")
+    # Enrutador de modelos por clase de petición (listas en orden de preferencia, separadas por comas)
+    model_routing: bool = Field(default=False, validation_alias="MODEL_ROUTING")
+    model_route_structured: str = Field(default="gemini-2.5-flash,gemini-2.0-flash,gemini-1.5-flash", validation_alias="MODEL_ROUTE_STRUCTURED")
+    model_route_short: str = Field(default="gemini-2.5-flash,gemini-2.0-flash,gemini-1.5-flash", validation_alias="MODEL_ROUTE_SHORT")
+    model_route_chat: str = Field(default="gemini-2.5-pro,gemini-2.5-flash,gemini-1.5-pro,gemini-1.5-flash", validation_alias="MODEL_ROUTE_CHAT")
+    model_router_alpha: float = Field(default=0.2, validation_alias="MODEL_ROUTER_ALPHA")
+    model_router_max_error_rate: float = Field(default=0.3, validation_alias="MODEL_ROUTER_MAX_ERROR_RATE")
+    model_router_max_latency_s: float = Field(default=15.0, validation_alias="MODEL_ROUTER_MAX_LATENCY_S")
+    model_router_probe_s: float = Field(default=60.0, validation_alias="MODEL_ROUTER_PROBE_S")
+    # Índice de preguntas similares: archivo de persistencia (vacío = solo en memoria), intervalos de
+    # guardado y de sincronización con SQLite, y construcción en segundo plano al arrancar
+    question_index_path: str | None = Field(default="data/question_index.bin", validation_alias="QUESTION_INDEX_PATH")
+    question_index_save_interval_s: float = Field(default=60.0, validation_alias="QUESTION_INDEX_SAVE_INTERVAL_S")
+    question_index_sync_interval_s: float = Field(default=30.0, validation_alias="QUESTION_INDEX_SYNC_INTERVAL_S")
+    question_index_preload: bool = Field(default=True, validation_alias="QUESTION_INDEX_PRELOAD")
+    # Sesiones de chat: presupuesto de contexto (tokens estimados), del resumen, y caché en memoria
+    session_context_tokens: int = Field(default=2000, validation_alias="SESSION_CONTEXT_TOKENS")
+    session_summary_tokens: int = Field(default=500, validation_alias="SESSION_SUMMARY_TOKENS")
+    session_cache_size: int = Field(default=1000, validation_alias="SESSION_CACHE_SIZE")
+    session_cache_ttl_s: float = Field(default=1800.0, validation_alias="SESSION_CACHE_TTL_S")
+    # Ingesta continua de sensores: histéresis (fracción del rango óptimo o variación relativa sin rango),
+    # lote y período de escritura, y pares (cultivo, parámetro) con estado en memoria
+    sensor_stream_hysteresis: float = Field(default=0.05, validation_alias="SENSOR_STREAM_HYSTERESIS")
+    sensor_stream_batch_size: int = Field(default=500, validation_alias="SENSOR_STREAM_BATCH_SIZE")
+    sensor_stream_flush_s: float = Field(default=2.0, validation_alias="SENSOR_STREAM_FLUSH_S")
+    sensor_stream_max_keys: int = Field(default=10000, validation_alias="SENSOR_STREAM_MAX_KEYS")
+    # Antigüedad máxima del timestamp de una lectura del flujo y meses distintos por conexión (cada mes
+    # puede crear una partición de sensor_readings)
+    sensor_reading_max_age_days: float = Field(default=30.0, validation_alias="SENSOR_READING_MAX_AGE_DAYS")
+    sensor_stream_max_months: int = Field(default=3, validation_alias="SENSOR_STREAM_MAX_MONTHS")
+    # Tendencias de sensores: lecturas en la ventana móvil, factor de la EWMA, horas leídas al reconstruir
+    # y reconstrucción en segundo plano al arrancar
+    sensor_trends_window: int = Field(default=120, validation_alias="SENSOR_TRENDS_WINDOW")
+    sensor_trends_alpha: float = Field(default=0.2, validation_alias="SENSOR_TRENDS_ALPHA")
+    sensor_trends_lookback_h: float = Field(default=168.0, validation_alias="SENSOR_TRENDS_LOOKBACK_H")
+    sensor_trends_preload: bool = Field(default=True, validation_alias="SENSOR_TRENDS_PRELOAD")
+    # Retención de lecturas de sensores en días (particiones mensuales completas); 0 = sin límite
+    sensor_retention_days: float = Field(default=0.0, validation_alias="SENSOR_RETENTION_DAYS")
+    # Trabajos asíncronos (POST /v1/agro/jobs): workers, presupuesto por trabajo, intentos y espera máxima del long-poll
+    job_workers: int = Field(default=2, validation_alias="JOB_WORKERS")
+    job_timeout_s: float = Field(default=120.0, validation_alias="JOB_TIMEOUT_S")
+    job_max_attempts: int = Field(default=3, validation_alias="JOB_MAX_ATTEMPTS")
+    job_long_poll_max_s: float = Field(default=30.0, validation_alias="JOB_LONG_POLL_MAX_S")
+    # Estado tibio entre arranques en frío (modelo resuelto, modelos disponibles, caché caliente); vacío = deshabilitado
+    warm_state_path: str | None = Field(default=None, validation_alias="WARM_STATE_PATH")
+    warm_state_models_ttl_s: float = Field(default=21600.0, validation_alias="WARM_STATE_MODELS_TTL_S")
+    warm_state_save_interval_s: float = Field(default=30.0, validation_alias="WARM_STATE_SAVE_INTERVAL_S")
+    warm_state_cache_entries: int = Field(default=50, validation_alias="WARM_STATE_CACHE_ENTRIES")
 
-    # pydantic-settings v2 style configuration
+    # pydantic-settings v2 style configuration; .env se lee una sola vez, al construir Settings
+    # (prioridad: entorno del proceso > .env > .env.example; en pydantic-settings gana el último archivo)
     model_config = SettingsConfigDict(
-        env_file=(".env", ".env.example"),
+        env_file=(".env.example", ".env"),
         env_file_encoding="utf-8",
         extra="ignore",
     )
@@ -1,37 +1,65 @@
 """
-Base de datos SQLite para historial de conversaciones.
+Base de datos del historial de conversaciones (SQLite por defecto; DATABASE_URL para otra).
+
+El engine, el directorio de datos y las tablas se crean en el primer uso del
+historial (no al importar), para no pagar ese costo en el arranque en frío.
+
+Hay dos engines sobre la misma base: el síncrono (Session), que usan los
+servicios en hilos y los scripts, y el asíncrono (AsyncSession, con aiosqlite o
+asyncpg), que usan los endpoints de lectura para no bloquear el event loop.
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, DateTime, JSON
+from sqlalchemy import create_engine, update, BigInteger, Column, Index, Integer, String, Text, Float, DateTime, JSON
+from sqlalchemy.sql import Update
+from sqlalchemy.engine import Connection, Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from contextlib import contextmanager
 from datetime import datetime
-import os
 from pathlib import Path
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from app.config import get_settings
+from app.utils.jsonio import dumps_str, loads
 
-# Crear directorio para la base de datos si no existe
 DB_DIR = Path(__file__).parent.parent.parent / "data"
-DB_DIR.mkdir(exist_ok=True)
 DB_PATH = DB_DIR / "chat_history.db"
 
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Driver asíncrono por dialecto (el síncrono es el de la URL tal cual)
+_ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+_engine: Optional[Engine] = None
+_session_factory: Optional[sessionmaker] = None
+_async_engine: Optional[Any] = None
+_async_session_factory: Optional[Any] = None
+_tables_ready = False
+_db_lock = threading.Lock()
 
 Base = declarative_base()
+# Plantillas de tablas particionadas: create_all no las crea (ver app/db/partitions.py)
+PartitionBase = declarative_base()
 
 
 class ChatHistory(Base):
     """Modelo para guardar el historial de conversaciones."""
     __tablename__ = "chat_history"
+    # Índices con la forma de las consultas: filtro por igualdad + orden por timestamp
+    # (los cambios de índices en bases existentes van en app/db/migrations.py)
+    __table_args__ = (
+        Index("ix_chat_history_crop_timestamp", "crop", "timestamp"),
+        Index("ix_chat_history_endpoint_timestamp", "endpoint", "timestamp"),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
-    endpoint = Column(String(50), index=True)  # "/v1/agro/chat" o "/v1/agro/ask"
+    endpoint = Column(String(50))  # "/v1/agro/chat" o "/v1/agro/ask"
     
     # Request data
     question = Column(Text, nullable=True)
-    crop = Column(String(100), nullable=True, index=True)
+    crop = Column(String(100), nullable=True, index=True)  # (crop, id): recorrido por lotes de iter_chats
     stage = Column(String(100), nullable=True)
     parameter = Column(String(100), nullable=True, index=True)
     value = Column(Float, nullable=True)
@@ -47,17 +75,27 @@ class ChatHistory(Base):
     response_time_ms = Column(Integer, nullable=True)  # Tiempo de respuesta en ms
     user_ip = Column(String(50), nullable=True)
     error = Column(Text, nullable=True)  # Si hubo error
+    session_id = Column(String(32), nullable=True, index=True)  # Sesión multi-turno (si la hay)
+
 
+class SensorReading(PartitionBase):
+    """
+    Lectura de sensor con su recomendación.
 
-class SensorReading(Base):
-    """Modelo para guardar lecturas de sensores y sus recomendaciones."""
+    Es la plantilla de columnas de las particiones mensuales `sensor_readings_AAAAMM`
+    (app/db/partitions.py): las lecturas se leen y escriben por HistoryService, nunca
+    con este modelo directamente.
+    """
     __tablename__ = "sensor_readings"
+    # Los ids nacen con la base de la partición (AAAAMM × 10⁹) y no se reutilizan
+    __table_args__ = {"sqlite_autoincrement": True}
 
-    id = Column(Integer, primary_key=True, index=True)
+    # BIGINT fuera de SQLite (en SQLite, INTEGER PRIMARY KEY ya es de 64 bits y alias del rowid)
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
-    crop = Column(String(100), index=True)
+    crop = Column(String(100))
     stage = Column(String(100), nullable=True)
-    parameter = Column(String(100), index=True)
+    parameter = Column(String(100))
     value = Column(Float)
     unit = Column(String(50))
     
@@ -69,9 +107,160 @@ class SensorReading(Base):
     rationale = Column(Text, nullable=True)
 
 
+class ChatJob(Base):
+    """Trabajo asíncrono de chat (cola durable: sobrevive a reinicios)."""
+    __tablename__ = "chat_jobs"
+    # claim_next: el trabajo en cola más antiguo
+    __table_args__ = (Index("ix_chat_jobs_status_created_at", "status", "created_at"),)
+
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    status = Column(String(20), default="queued")  # queued, running, done, error
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+
+    request_json = Column(JSON)  # ChatRequest
+    result_json = Column(JSON, nullable=True)  # answer, model, tips
+    error = Column(Text, nullable=True)
+    chat_id = Column(Integer, nullable=True)  # fila en chat_history al terminar
+    user_ip = Column(String(50), nullable=True)
+
+
+class ChatSession(Base):
+    """Sesión de chat multi-turno: resumen acumulado de los turnos ya compactados."""
+    __tablename__ = "chat_sessions"
+
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+    summary = Column(Text, default="")
+    # Último chat_history.id incluido en el resumen; los turnos posteriores van completos al prompt
+    summarized_through = Column(Integer, default=0)
+
+
+class TableVersion(Base):
+    """
+    Contador de escrituras por tabla lógica, para validadores HTTP (ETag) que no recorren la tabla.
+
+    Se incrementa en la misma transacción que la escritura (bump_table_version), así
+    que quien lee la versión nueva también ve las filas nuevas.
+    """
+    __tablename__ = "table_versions"
+
+    name = Column(String(100), primary_key=True)
+    version = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=False, default=0)
+
+
+# Las lecturas de sensores: todas sus particiones mensuales comparten un contador
+SENSOR_READINGS_VERSION = "sensor_readings"
+
+
+def bump_table_version(name: str) -> Update:
+    """UPDATE que incrementa la versión de `name` (la fila la crea la migración 4)."""
+    return update(TableVersion).where(TableVersion.name == name).values(version=TableVersion.version + 1)
+
+
+def database_url() -> str:
+    """URL de la base: DATABASE_URL o, por defecto, el SQLite de data/."""
+    return get_settings().database_url or DATABASE_URL
+
+
+def async_database_url(url: str) -> str:
+    """La misma URL con el driver asíncrono del dialecto (sqlite → aiosqlite, postgresql → asyncpg)."""
+    parsed = make_url(url)
+    backend = "postgresql" if parsed.get_backend_name() in ("postgresql", "postgres") else parsed.get_backend_name()
+    driver = _ASYNC_DRIVERS.get(backend)
+    if driver is None:
+        raise ValueError(f"DATABASE_URL: dialecto sin driver asíncrono soportado: {backend}")
+    return parsed.set(drivername=f"{backend}+{driver}").render_as_string(hide_password=False)
+
+
+def get_engine() -> Engine:
+    """Engine compartido; crea el directorio de datos en la primera llamada."""
+    global _engine, _session_factory
+    if _engine is None:
+        with _db_lock:
+            if _engine is None:
+                url = database_url()
+                sqlite = make_url(url).get_backend_name() == "sqlite"
+                if sqlite:
+                    DB_DIR.mkdir(exist_ok=True)
+                engine = create_engine(
+                    url,
+                    connect_args={"check_same_thread": False} if sqlite else {},
+                    json_serializer=dumps_str,
+                    json_deserializer=loads,
+                )
+                _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                _engine = engine
+    return _engine
+
+
+def get_async_engine() -> Any:
+    """Engine asíncrono compartido (se crea en el primer uso; importa sqlalchemy.ext.asyncio recién ahí)."""
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        with _db_lock:
+            if _async_engine is None:
+                from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+                engine = create_async_engine(
+                    async_database_url(database_url()),
+                    json_serializer=dumps_str,
+                    json_deserializer=loads,
+                )
+                _async_session_factory = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+                _async_engine = engine
+    return _async_engine
+
+
+async def dispose_async_engine() -> None:
+    """Cerrar las conexiones del engine asíncrono (al apagar la app)."""
+    if _async_engine is not None:
+        await _async_engine.dispose()
+
+
+@contextmanager
+def exclusive_transaction(engine: Engine) -> Iterator[Connection]:
+    """Transacción con el lock de escritura tomado desde el inicio (DDL seguro entre workers y procesos)."""
+    with engine.connect() as conn:
+        if conn.dialect.name == "sqlite":
+            # BEGIN IMMEDIATE: pysqlite no abre transacción antes de DDL por su cuenta
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.exec_driver_sql("COMMIT")
+            except BaseException:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+        else:
+            with conn.begin():
+                # Lock consultivo de la transacción: serializa migraciones y creación de particiones
+                conn.exec_driver_sql("SELECT pg_advisory_xact_lock(4848)")
+                yield conn
+
+
 def init_db():
-    """Inicializar la base de datos creando las tablas."""
-    Base.metadata.create_all(bind=engine)
+    """Inicializar la base de datos creando las tablas (solo la primera vez por proceso)."""
+    global _tables_ready
+    if _tables_ready:
+        return
+    engine = get_engine()
+    with _db_lock:
+        if not _tables_ready:
+            from app.db.migrations import migrate
+
+            # Tablas nuevas con su esquema actual; los cambios a tablas existentes, por migraciones
+            Base.metadata.create_all(bind=engine)
+            migrate(engine)
+            _tables_ready = True
+
+
+def SessionLocal() -> Session:
+    """Nueva sesión de DB, con las tablas ya creadas."""
+    init_db()
+    return _session_factory()
 
 
 def get_db():
@@ -81,3 +270,12 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncIterator[Any]:
+    """Dependency para obtener una AsyncSession (las tablas se crean con el engine síncrono, en un hilo)."""
+    if not _tables_ready:
+        await asyncio.to_thread(init_db)
+    get_async_engine()
+    async with _async_session_factory() as db:
+        yield db
@@ -2,10 +2,20 @@
 Servicios para gestión del historial de chats.
 """
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+from sqlalchemy import Row, Select, Table, desc, func, insert, select
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from app.db.database import ChatHistory, SensorReading
+from typing import TYPE_CHECKING, Iterator, List, Optional, Dict, Any, Tuple
+from app.db.database import SENSOR_READINGS_VERSION, ChatHistory, SensorReading, TableVersion, bump_table_version
+from app.db.partitions import get_sensor_partitions, month_key
+from app.utils.logger import get_logger
+from app.utils.metrics import DB_WRITE_SECONDS
+from app.utils.tracing import span
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = get_logger("agro.history")
 
 
 class HistoryService:
@@ -27,7 +37,8 @@ class HistoryService:
         recommendation: Optional[Dict[str, Any]],
         response_time_ms: Optional[int],
         user_ip: Optional[str],
-        error: Optional[str] = None
+        error: Optional[str] = None,
+        session_id: Optional[str] = None
     ) -> ChatHistory:
         """Guardar una conversación en el historial."""
         chat = ChatHistory(
@@ -44,11 +55,18 @@ class HistoryService:
             recommendation_json=recommendation,
             response_time_ms=response_time_ms,
             user_ip=user_ip,
-            error=error
+            error=error,
+            session_id=session_id
         )
-        db.add(chat)
-        db.commit()
-        db.refresh(chat)
+        with DB_WRITE_SECONDS.time(table="chat_history"):
+            db.add(chat)
+            with span("db.commit", cat="db", table="chat_history"):
+                db.commit()
+            db.refresh(chat)
+        # Índice de preguntas similares (incremental; no hace nada si todavía no se cargó)
+        from app.services.question_index import get_question_index_store
+
+        get_question_index_store().on_saved(chat.id, question)
         return chat
 
     @staticmethod
@@ -65,42 +83,96 @@ class HistoryService:
         target_unit: Optional[str] = None,
         rationale: Optional[str] = None
     ) -> SensorReading:
-        """Guardar lectura de sensor con su recomendación."""
-        reading = SensorReading(
-            crop=crop,
-            stage=stage,
-            parameter=parameter,
-            value=value,
-            unit=unit,
-            action=action,
-            target_min=target_min,
-            target_max=target_max,
-            target_unit=target_unit,
-            rationale=rationale
-        )
-        db.add(reading)
-        db.commit()
-        db.refresh(reading)
+        """Guardar lectura de sensor con su recomendación (en la partición del mes en curso)."""
+        values = {
+            "timestamp": datetime.utcnow(),
+            "crop": crop,
+            "stage": stage,
+            "parameter": parameter,
+            "value": value,
+            "unit": unit,
+            "action": action,
+            "target_min": target_min,
+            "target_max": target_max,
+            "target_unit": target_unit,
+            "rationale": rationale,
+        }
+        table = get_sensor_partitions().ensure(db.get_bind(), month_key(values["timestamp"]))
+        with DB_WRITE_SECONDS.time(table="sensor_readings"):
+            reading_id = db.execute(insert(table).returning(table.c.id), values).scalar_one()
+            db.execute(bump_table_version(SENSOR_READINGS_VERSION))
+            with span("db.commit", cat="db", table="sensor_readings"):
+                db.commit()
+        reading = SensorReading(id=reading_id, **values)
+        from app.services.sensor_trends import get_sensor_trends
+
+        get_sensor_trends().observe(reading)
         return reading
 
+    @staticmethod
+    def save_sensor_readings(db: Session, rows: List[Dict[str, Any]]) -> int:
+        """Guardar un lote de lecturas en una sola transacción (un INSERT en bloque por partición mensual).
+
+        Las lecturas más viejas que la retención (SENSOR_RETENTION_DAYS) se descartan: su
+        partición ya se borró o se borraría enseguida. Devuelve las lecturas guardadas.
+        """
+        if not rows:
+            return 0
+        now = datetime.utcnow()
+        partitions = get_sensor_partitions()
+        cutoff = partitions.cutoff()
+        groups: Dict[int, List[Dict[str, Any]]] = {}
+        expired = 0
+        for row in rows:
+            if row.get("timestamp") is None:
+                row = dict(row, timestamp=now)
+            elif cutoff is not None and row["timestamp"] < cutoff:
+                expired += 1
+                continue
+            groups.setdefault(month_key(row["timestamp"]), []).append(row)
+        if expired:
+            logger.warning("Lecturas de sensores descartadas por estar fuera de la retención: %d", expired)
+        if not groups:
+            return 0
+        tables = {key: partitions.ensure(db.get_bind(), key) for key in groups}
+        saved: List[Dict[str, Any]] = []
+        with DB_WRITE_SECONDS.time(table="sensor_readings"):
+            for key, group in groups.items():
+                table = tables[key]
+                ids = db.scalars(insert(table).returning(table.c.id, sort_by_parameter_order=True), group).all()
+                saved.extend(dict(row, id=rid) for row, rid in zip(group, ids))
+            db.execute(bump_table_version(SENSOR_READINGS_VERSION))
+            with span("db.commit", cat="db", table="sensor_readings", rows=len(rows)):
+                db.commit()
+        from app.services.sensor_trends import get_sensor_trends
+
+        get_sensor_trends().observe_many(saved)
+        return len(saved)
+
+    @staticmethod
+    def sensor_tables(db: Session, since: Optional[datetime] = None) -> List[Table]:
+        """Particiones mensuales de lecturas que cubren desde `since`, de la más antigua a la más nueva."""
+        return get_sensor_partitions().tables(db, since)
+
+    @staticmethod
+    def drop_sensor_readings_before(db: Session, cutoff: datetime) -> List[str]:
+        """Borrar las particiones de meses terminados antes de `cutoff`; devuelve las tablas borradas."""
+        return get_sensor_partitions().drop_before(db.get_bind(), cutoff)
+
     @staticmethod
     def get_recent_chats(db: Session, limit: int = 20, endpoint: Optional[str] = None) -> List[ChatHistory]:
         """Obtener conversaciones recientes."""
-        query = db.query(ChatHistory).order_by(desc(ChatHistory.timestamp))
-        if endpoint:
-            query = query.filter(ChatHistory.endpoint == endpoint)
-        return query.limit(limit).all()
+        return list(db.scalars(_recent_chats_stmt(limit, endpoint)))
 
     @staticmethod
     def get_chats_by_crop(db: Session, crop: str, limit: int = 20) -> List[ChatHistory]:
         """Obtener conversaciones de un cultivo específico."""
-        return (
-            db.query(ChatHistory)
-            .filter(ChatHistory.crop == crop)
-            .order_by(desc(ChatHistory.timestamp))
-            .limit(limit)
-            .all()
-        )
+        return list(db.scalars(_chats_by_crop_stmt(crop, limit)))
+
+    @staticmethod
+    def get_chat(db: Session, chat_id: int) -> Optional[ChatHistory]:
+        """Obtener una conversación por id."""
+        return db.get(ChatHistory, chat_id)
 
     @staticmethod
     def get_sensor_history(
@@ -109,57 +181,46 @@ class HistoryService:
         parameter: Optional[str] = None,
         hours: int = 24,
         limit: int = 100
-    ) -> List[SensorReading]:
-        """Obtener historial de sensores con filtros."""
+    ) -> List[Row]:
+        """Obtener historial de sensores con filtros (solo lee las particiones del rango)."""
         since = datetime.utcnow() - timedelta(hours=hours)
-        query = db.query(SensorReading).filter(SensorReading.timestamp >= since)
-        
-        if crop:
-            query = query.filter(SensorReading.crop == crop)
-        if parameter:
-            query = query.filter(SensorReading.parameter == parameter)
-        
-        return query.order_by(desc(SensorReading.timestamp)).limit(limit).all()
+        readings: List[Row] = []
+        # Particiones de la más nueva a la más antigua: sus rangos no se solapan, así que
+        # concatenar cada resultado ya ordenado mantiene el orden global
+        for table in reversed(HistoryService.sensor_tables(db, since)):
+            readings += db.execute(_sensor_history_stmt(table, since, crop, parameter, limit - len(readings))).all()
+            if len(readings) >= limit:
+                break
+        return readings
 
     @staticmethod
     def get_stats(db: Session) -> Dict[str, Any]:
         """Obtener estadísticas generales del uso."""
-        total_chats = db.query(func.count(ChatHistory.id)).scalar()
-        total_sensors = db.query(func.count(SensorReading.id)).scalar()
-        
-        # Top cultivos
-        top_crops = (
-            db.query(ChatHistory.crop, func.count(ChatHistory.id).label("count"))
-            .filter(ChatHistory.crop.isnot(None))
-            .group_by(ChatHistory.crop)
-            .order_by(desc("count"))
-            .limit(5)
-            .all()
-        )
-        
-        # Top parámetros
-        top_params = (
-            db.query(SensorReading.parameter, func.count(SensorReading.id).label("count"))
-            .group_by(SensorReading.parameter)
-            .order_by(desc("count"))
-            .limit(5)
-            .all()
-        )
-        
-        # Promedio tiempo de respuesta
-        avg_response_time = (
-            db.query(func.avg(ChatHistory.response_time_ms))
-            .filter(ChatHistory.response_time_ms.isnot(None))
-            .scalar()
-        )
-        
-        return {
-            "total_conversations": total_chats,
-            "total_sensor_readings": total_sensors,
-            "top_crops": [{"crop": c, "count": count} for c, count in top_crops],
-            "top_parameters": [{"parameter": p, "count": count} for p, count in top_params],
-            "avg_response_time_ms": round(avg_response_time, 2) if avg_response_time else None
-        }
+        chats = {name: db.execute(stmt).all() for name, stmt in _chat_stats_stmts().items()}
+        sensors = [
+            (db.scalar(count), db.execute(params).all())
+            for count, params in map(_sensor_stats_stmts, HistoryService.sensor_tables(db))
+        ]
+        return _stats_result(chats, sensors)
+
+    @staticmethod
+    def chats_version(db: Session) -> int:
+        """Versión de chat_history para validadores HTTP: max(id) (la tabla es de solo inserción)."""
+        return db.scalar(_chats_version_stmt()) or 0
+
+    @staticmethod
+    def sensors_version(db: Session, hours: Optional[int] = None) -> Tuple[Any, ...]:
+        """Versión de las lecturas para validadores HTTP (ver _sensors_version)."""
+        version = db.scalar(_sensors_version_stmt()) or 0
+        if hours is None:
+            return _sensors_version(version)
+        since = datetime.utcnow() - timedelta(hours=hours)
+        start = None
+        for table in HistoryService.sensor_tables(db, since):
+            start = db.scalar(_window_start_stmt(table, since))
+            if start is not None:
+                break
+        return _sensors_version(version, start)
 
     @staticmethod
     def search_chats(
@@ -168,14 +229,193 @@ class HistoryService:
         limit: int = 20
     ) -> List[ChatHistory]:
         """Buscar en el historial por texto."""
-        search_pattern = f"%{query}%"
-        return (
-            db.query(ChatHistory)
-            .filter(
-                (ChatHistory.question.ilike(search_pattern)) |
-                (ChatHistory.answer.ilike(search_pattern))
-            )
-            .order_by(desc(ChatHistory.timestamp))
-            .limit(limit)
-            .all()
-        )
+        return list(db.scalars(_search_stmt(query, limit)))
+
+    @staticmethod
+    def iter_chats(
+        db: Session,
+        crop: Optional[str] = None,
+        since: Optional[datetime] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Dict[str, Any]]:
+        """Recorrer el historial completo por lotes (keyset por id), como dicts sin pasar por el ORM."""
+        table = ChatHistory.__table__
+        columns = [c for c in table.c if c.name != "user_ip"]
+        last_id = 0
+        while True:
+            stmt = select(*columns).where(table.c.id > last_id)
+            if crop:
+                stmt = stmt.where(table.c.crop == crop)
+            if since:
+                stmt = stmt.where(table.c.timestamp >= since)
+            rows = db.execute(stmt.order_by(table.c.id).limit(batch_size)).mappings().all()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]["id"]
+
+
+class AsyncHistoryService:
+    """Consultas de lectura del historial con AsyncSession (endpoints: no bloquean el event loop).
+
+    Usa las mismas consultas que HistoryService; las escrituras siguen en HistoryService.
+    """
+
+    @staticmethod
+    async def get_recent_chats(db: "AsyncSession", limit: int = 20, endpoint: Optional[str] = None) -> List[ChatHistory]:
+        return list(await db.scalars(_recent_chats_stmt(limit, endpoint)))
+
+    @staticmethod
+    async def get_chats_by_crop(db: "AsyncSession", crop: str, limit: int = 20) -> List[ChatHistory]:
+        return list(await db.scalars(_chats_by_crop_stmt(crop, limit)))
+
+    @staticmethod
+    async def get_chat(db: "AsyncSession", chat_id: int) -> Optional[ChatHistory]:
+        return await db.get(ChatHistory, chat_id)
+
+    @staticmethod
+    async def get_sensor_history(
+        db: "AsyncSession",
+        crop: Optional[str] = None,
+        parameter: Optional[str] = None,
+        hours: int = 24,
+        limit: int = 100
+    ) -> List[Row]:
+        since = datetime.utcnow() - timedelta(hours=hours)
+        readings: List[Row] = []
+        for table in reversed(await get_sensor_partitions().tables_async(db, since)):
+            result = await db.execute(_sensor_history_stmt(table, since, crop, parameter, limit - len(readings)))
+            readings += result.all()
+            if len(readings) >= limit:
+                break
+        return readings
+
+    @staticmethod
+    async def get_stats(db: "AsyncSession") -> Dict[str, Any]:
+        chats = {name: (await db.execute(stmt)).all() for name, stmt in _chat_stats_stmts().items()}
+        sensors = []
+        for table in await get_sensor_partitions().tables_async(db):
+            count, params = _sensor_stats_stmts(table)
+            sensors.append((await db.scalar(count), (await db.execute(params)).all()))
+        return _stats_result(chats, sensors)
+
+    @staticmethod
+    async def search_chats(db: "AsyncSession", query: str, limit: int = 20) -> List[ChatHistory]:
+        return list(await db.scalars(_search_stmt(query, limit)))
+
+    @staticmethod
+    async def chats_version(db: "AsyncSession") -> int:
+        return await db.scalar(_chats_version_stmt()) or 0
+
+    @staticmethod
+    async def sensors_version(db: "AsyncSession", hours: Optional[int] = None) -> Tuple[Any, ...]:
+        version = await db.scalar(_sensors_version_stmt()) or 0
+        if hours is None:
+            return _sensors_version(version)
+        since = datetime.utcnow() - timedelta(hours=hours)
+        start = None
+        for table in await get_sensor_partitions().tables_async(db, since):
+            start = await db.scalar(_window_start_stmt(table, since))
+            if start is not None:
+                break
+        return _sensors_version(version, start)
+
+
+# Consultas compartidas por HistoryService (Session) y AsyncHistoryService (AsyncSession)
+
+def _recent_chats_stmt(limit: int, endpoint: Optional[str]) -> Select:
+    stmt = select(ChatHistory).order_by(desc(ChatHistory.timestamp))
+    if endpoint:
+        stmt = stmt.where(ChatHistory.endpoint == endpoint)
+    return stmt.limit(limit)
+
+
+def _chats_by_crop_stmt(crop: str, limit: int) -> Select:
+    return select(ChatHistory).where(ChatHistory.crop == crop).order_by(desc(ChatHistory.timestamp)).limit(limit)
+
+
+def _search_stmt(query: str, limit: int) -> Select:
+    search_pattern = f"%{query}%"
+    return (
+        select(ChatHistory)
+        .where(ChatHistory.question.ilike(search_pattern) | ChatHistory.answer.ilike(search_pattern))
+        .order_by(desc(ChatHistory.timestamp))
+        .limit(limit)
+    )
+
+
+def _sensor_history_stmt(
+    table: Table, since: datetime, crop: Optional[str], parameter: Optional[str], limit: int
+) -> Select:
+    stmt = select(table).where(table.c.timestamp >= since)
+    if crop:
+        stmt = stmt.where(table.c.crop == crop)
+    if parameter:
+        stmt = stmt.where(table.c.parameter == parameter)
+    return stmt.order_by(desc(table.c.timestamp)).limit(limit)
+
+
+def _chat_stats_stmts() -> Dict[str, Select]:
+    count = func.count(ChatHistory.id).label("count")
+    return {
+        "total": select(func.count(ChatHistory.id)),
+        # Top cultivos
+        "top_crops": (
+            select(ChatHistory.crop, count)
+            .where(ChatHistory.crop.isnot(None))
+            .group_by(ChatHistory.crop)
+            .order_by(desc("count"))
+            .limit(5)
+        ),
+        # Promedio tiempo de respuesta
+        "avg_response_time": select(func.avg(ChatHistory.response_time_ms)).where(ChatHistory.response_time_ms.isnot(None)),
+    }
+
+
+def _sensor_stats_stmts(table: Table) -> Tuple[Select, Select]:
+    return (
+        select(func.count()).select_from(table),
+        select(table.c.parameter, func.count()).group_by(table.c.parameter),
+    )
+
+
+def _stats_result(chats: Dict[str, List[Row]], sensors: List[Tuple[int, List[Row]]]) -> Dict[str, Any]:
+    # Top parámetros (sumados entre particiones)
+    param_counts: Counter = Counter()
+    for _, params in sensors:
+        for p, count in params:
+            param_counts[p] += count
+    avg_response_time = chats["avg_response_time"][0][0]
+    return {
+        "total_conversations": chats["total"][0][0],
+        "total_sensor_readings": sum(total for total, _ in sensors),
+        "top_crops": [{"crop": c, "count": count} for c, count in chats["top_crops"]],
+        "top_parameters": [{"parameter": p, "count": count} for p, count in param_counts.most_common(5)],
+        "avg_response_time_ms": round(avg_response_time, 2) if avg_response_time else None
+    }
+
+
+# Versiones baratas para ETag: búsquedas por PK/índice, sin recorrer las tablas
+
+def _chats_version_stmt() -> Select:
+    return select(func.max(ChatHistory.id))
+
+
+def _sensors_version_stmt() -> Select:
+    # Un contador por escritura (bump_table_version), no max(id) de cada partición:
+    # el costo no crece con la cantidad de meses guardados
+    return select(TableVersion.version).where(TableVersion.name == SENSOR_READINGS_VERSION)
+
+
+def _window_start_stmt(table: Table, since: datetime) -> Select:
+    return select(func.min(table.c.timestamp)).where(table.c.timestamp >= since)
+
+
+def _sensors_version(version: int, window_start: Optional[datetime] = None) -> Tuple[Any, ...]:
+    """
+    El contador de escrituras cambia con cada lectura nueva (también las de meses pasados)
+    y con cada partición borrada por retención. La lectura más antigua de la ventana cambia
+    cuando una lectura sale de "últimas N horas" aunque no haya escrituras.
+    """
+    return (version, window_start)
@@ -0,0 +1,94 @@
+"""
+Persistencia de la cola de trabajos asíncronos (tabla chat_jobs).
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
+from datetime import datetime
+from typing import Any, Dict, Optional
+from uuid import uuid4
+
+from app.db.database import ChatJob
+from app.utils.metrics import DB_WRITE_SECONDS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+
+
+class JobService:
+    """Operaciones sobre la cola de trabajos. Cada cambio de estado es una transacción corta."""
+
+    @staticmethod
+    def create(db: Session, request: Dict[str, Any], user_ip: Optional[str]) -> ChatJob:
+        """Encolar un trabajo nuevo."""
+        job = ChatJob(id=uuid4().hex, status=QUEUED, request_json=request, user_ip=user_ip, attempts=0)
+        with DB_WRITE_SECONDS.time(table="chat_jobs"):
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+        return job
+
+    @staticmethod
+    def get(db: Session, job_id: str) -> Optional[ChatJob]:
+        return db.get(ChatJob, job_id)
+
+    @staticmethod
+    def claim_next(db: Session) -> Optional[ChatJob]:
+        """Tomar el trabajo en cola más antiguo (UPDATE condicional: seguro entre workers y procesos)."""
+        while True:
+            job_id = db.execute(
+                select(ChatJob.id).where(ChatJob.status == QUEUED).order_by(ChatJob.created_at).limit(1)
+            ).scalar()
+            if job_id is None:
+                return None
+            claimed = db.execute(
+                update(ChatJob)
+                .where(ChatJob.id == job_id, ChatJob.status == QUEUED)
+                .values(status=RUNNING, started_at=datetime.utcnow(), attempts=ChatJob.attempts + 1)
+            ).rowcount
+            db.commit()
+            if claimed == 1:
+                return db.get(ChatJob, job_id, populate_existing=True)
+            # Otro worker lo tomó entre el SELECT y el UPDATE: probar con el siguiente
+
+    @staticmethod
+    def finish(db: Session, job_id: str, result: Dict[str, Any], chat_id: Optional[int]) -> None:
+        with DB_WRITE_SECONDS.time(table="chat_jobs"):
+            db.execute(
+                update(ChatJob)
+                .where(ChatJob.id == job_id)
+                .values(status=DONE, result_json=result, chat_id=chat_id, finished_at=datetime.utcnow(), error=None)
+            )
+            db.commit()
+
+    @staticmethod
+    def fail(db: Session, job_id: str, error: str, *, retry: bool) -> None:
+        """Registrar un fallo: vuelve a la cola si `retry`, si no queda en error."""
+        values: Dict[str, Any] = {"error": error}
+        if retry:
+            values.update(status=QUEUED, started_at=None)
+        else:
+            values.update(status=ERROR, finished_at=datetime.utcnow())
+        db.execute(update(ChatJob).where(ChatJob.id == job_id).values(**values))
+        db.commit()
+
+    @staticmethod
+    def requeue_stale(db: Session, started_before: datetime) -> int:
+        """Devolver a la cola los trabajos en curso desde antes de `started_before`.
+
+        Son trabajos huérfanos (el proceso que los tomó se reinició o murió): ningún
+        worker vivo tarda más que el timeout de un trabajo.
+        """
+        count = db.execute(
+            update(ChatJob)
+            .where(ChatJob.status == RUNNING, ChatJob.started_at < started_before)
+            .values(status=QUEUED, started_at=None)
+        ).rowcount
+        db.commit()
+        return count
+
+    @staticmethod
+    def count_by_status(db: Session) -> Dict[str, int]:
+        rows = db.execute(select(ChatJob.status, func.count()).group_by(ChatJob.status)).all()
+        return {status: count for status, count in rows}
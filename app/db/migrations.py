@@ -0,0 +1,145 @@
+"""
+Migraciones de esquema livianas para la base SQLite del historial.
+
+`create_all` crea las tablas nuevas con el esquema actual pero no altera las que
+ya existen; cada cambio posterior (columnas, índices) se agrega aquí como una
+migración numerada. La tabla `schema_migrations` registra las ya aplicadas, de
+modo que cada una corre una sola vez por base de datos.
+
+Las migraciones deben ser idempotentes (IF NOT EXISTS / comprobar antes de
+alterar): en una base recién creada `create_all` ya dejó el esquema final y la
+migración solo se registra.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from app.db.database import SENSOR_READINGS_VERSION, SensorReading, exclusive_transaction
+from app.utils.logger import get_logger
+
+logger = get_logger("agro.migrations")
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+def _add_session_id(conn: Connection) -> None:
+    columns = {c["name"] for c in inspect(conn).get_columns("chat_history")}
+    if "session_id" not in columns:
+        conn.exec_driver_sql("ALTER TABLE chat_history ADD COLUMN session_id VARCHAR(32)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_chat_history_session_id ON chat_history (session_id)")
+
+
+# Índices compuestos con la forma de las consultas calientes (igualdad primero, luego el orden)
+_COMPOSITE_INDEXES = {
+    # get_sensor_history / tendencias: crop + parameter + rango de timestamp, orden por timestamp
+    "ix_sensor_readings_crop_parameter_timestamp": "sensor_readings (crop, parameter, timestamp)",
+    # get_sensor_history filtrando solo por parámetro
+    "ix_sensor_readings_parameter_timestamp": "sensor_readings (parameter, timestamp)",
+    # get_chats_by_crop: crop = ? ORDER BY timestamp DESC LIMIT n
+    "ix_chat_history_crop_timestamp": "chat_history (crop, timestamp)",
+    # get_recent_chats con endpoint
+    "ix_chat_history_endpoint_timestamp": "chat_history (endpoint, timestamp)",
+    # JobService.claim_next: status = 'queued' ORDER BY created_at LIMIT 1
+    "ix_chat_jobs_status_created_at": "chat_jobs (status, created_at)",
+}
+
+# Índices de una columna que quedan cubiertos por un compuesto (prefijo) o duplican la PK.
+# ix_chat_history_crop se conserva: equivale a (crop, id) y sirve el recorrido por id de iter_chats
+_REDUNDANT_INDEXES = (
+    "ix_chat_history_id",
+    "ix_chat_history_endpoint",
+    "ix_sensor_readings_id",
+    "ix_sensor_readings_crop",
+    "ix_sensor_readings_parameter",
+    "ix_chat_jobs_status",
+)
+
+
+def _composite_indexes(conn: Connection) -> None:
+    tables = set(inspect(conn).get_table_names())
+    for name, target in _COMPOSITE_INDEXES.items():
+        # sensor_readings no existe en bases creadas ya con particiones (migración 3)
+        if target.split(" ", 1)[0] in tables:
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    for name in _REDUNDANT_INDEXES:
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    # Sin ANALYZE: en una base chica dejaría estadísticas de "tabla diminuta" que luego,
+    # con la tabla ya grande, llevan al planificador a recorrerla completa
+
+
+def _partition_sensor_readings(conn: Connection) -> None:
+    """Mover sensor_readings a particiones mensuales (conservando los ids) y borrar la tabla única."""
+    from app.db.partitions import create_partition, partition_name
+
+    # Solo bases SQLite anteriores a las particiones tienen la tabla única
+    if not inspect(conn).has_table("sensor_readings"):
+        return
+    month = "CAST(strftime('%Y%m', COALESCE(timestamp, CURRENT_TIMESTAMP)) AS INTEGER)"
+    keys = [row[0] for row in conn.exec_driver_sql(f"SELECT DISTINCT {month} FROM sensor_readings")]
+    columns = ", ".join(c.name for c in SensorReading.__table__.columns)
+    for key in keys:
+        create_partition(conn, key)
+        conn.exec_driver_sql(
+            f"INSERT INTO {partition_name(key)} ({columns}) "
+            f"SELECT {columns} FROM sensor_readings WHERE {month} = ? ORDER BY id",
+            (key,),
+        )
+    conn.exec_driver_sql("DROP TABLE sensor_readings")
+
+
+def _sensor_readings_version(conn: Connection) -> None:
+    # create_all ya creó table_versions (también en bases existentes: es una tabla nueva)
+    conn.execute(
+        text(
+            "INSERT INTO table_versions (name, version) SELECT :name, 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM table_versions WHERE name = :name)"
+        ),
+        {"name": SENSOR_READINGS_VERSION},
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "chat_history.session_id", _add_session_id),
+    Migration(2, "índices compuestos por forma de consulta", _composite_indexes),
+    Migration(3, "sensor_readings particionada por mes", _partition_sensor_readings),
+    Migration(4, "versión de escritura de sensor_readings", _sensor_readings_version),
+]
+
+
+def applied_versions(conn: Connection) -> List[int]:
+    if not inspect(conn).has_table("schema_migrations"):
+        return []
+    return [row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations ORDER BY version")]
+
+
+def migrate(engine: Engine) -> List[int]:
+    """Aplicar las migraciones pendientes; devuelve las versiones aplicadas en esta llamada."""
+    # El lock de escritura se toma antes de leer las versiones: si varios workers arrancan
+    # a la vez, solo uno aplica cada migración y el resto espera y la ve registrada
+    with exclusive_transaction(engine) as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at TIMESTAMP NOT NULL)"
+        )
+        done = set(applied_versions(conn))
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            migration.apply(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": migration.version, "name": migration.name, "applied_at": datetime.utcnow()},
+            )
+            applied.append(migration.version)
+    if applied:
+        logger.info("Migraciones aplicadas: %s", applied)
+    return applied
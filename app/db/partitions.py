@@ -0,0 +1,201 @@
+"""
+Particiones mensuales de las lecturas de sensores.
+
+Las lecturas se guardan en una tabla por mes, `sensor_readings_AAAAMM`, con las
+columnas del modelo SensorReading y sus propios índices. HistoryService enruta
+cada escritura a la partición del mes de su timestamp, y cada consulta por rango
+de tiempo solo a las particiones que lo cubren. La retención
+(SENSOR_RETENTION_DAYS) borra particiones completas con DROP TABLE en lugar de
+un DELETE sobre millones de filas; las páginas liberadas quedan en la base y las
+reutilizan las particiones nuevas.
+
+Los ids siguen siendo únicos entre particiones: cada tabla numera (AUTOINCREMENT
+en SQLite, su secuencia en Postgres) a partir de AAAAMM × 10⁹, así que además
+crecen de un mes al siguiente.
+"""
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from sqlalchemy import Index, MetaData, Table, text
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.orm import Session
+
+from app.config import get_settings
+from app.db.database import SENSOR_READINGS_VERSION, SensorReading, bump_table_version, exclusive_transaction
+from app.utils.logger import get_logger
+
+logger = get_logger("agro.partitions")
+
+PREFIX = "sensor_readings_"
+# Primer id de cada partición: AAAAMM × ID_STRIDE (cabe en 53 bits, seguro para clientes JSON)
+ID_STRIDE = 10**9
+
+_metadata = MetaData()
+_tables: Dict[int, Table] = {}
+_tables_lock = threading.Lock()
+
+
+def month_key(ts: datetime) -> int:
+    return ts.year * 100 + ts.month
+
+
+def month_start(key: int) -> datetime:
+    return datetime(key // 100, key % 100, 1)
+
+
+def next_month(key: int) -> int:
+    year, month = divmod(key, 100)
+    return (year + 1) * 100 + 1 if month == 12 else key + 1
+
+
+def partition_name(key: int) -> str:
+    return f"{PREFIX}{key}"
+
+
+def partition_table(key: int) -> Table:
+    """Tabla de la partición (solo la definición; no toca la base)."""
+    table = _tables.get(key)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(key)
+            if table is None:
+                name = partition_name(key)
+                table = SensorReading.__table__.to_metadata(_metadata, name=name)
+                # Igualdad primero y luego el rango/orden por timestamp (el índice de timestamp viene del modelo)
+                Index(f"ix_{name}_crop_parameter_timestamp", table.c.crop, table.c.parameter, table.c.timestamp)
+                Index(f"ix_{name}_parameter_timestamp", table.c.parameter, table.c.timestamp)
+                _tables[key] = table
+    return table
+
+
+# Catálogo de particiones por dialecto (una consulta sobre unas pocas filas)
+_LIST_SQL = {
+    "sqlite": text(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND name GLOB 'sensor_readings_[0-9][0-9][0-9][0-9][0-9][0-9]'"
+    ),
+    "postgresql": text(
+        "SELECT tablename FROM pg_tables WHERE schemaname = current_schema() "
+        "AND tablename ~ '^sensor_readings_[0-9]{6}$'"
+    ),
+}
+
+
+def list_statement(dialect: str) -> Any:
+    return _LIST_SQL[dialect]
+
+
+def partition_keys(rows: Any) -> List[int]:
+    return sorted(int(name[len(PREFIX):]) for (name,) in rows)
+
+
+def list_partitions(bind: Any) -> List[int]:
+    """Meses con partición en la base, del más antiguo al más nuevo (bind: Connection o Session)."""
+    dialect = bind.dialect.name if isinstance(bind, Connection) else bind.get_bind().dialect.name
+    return partition_keys(bind.execute(list_statement(dialect)))
+
+
+def create_partition(conn: Connection, key: int) -> bool:
+    """Crear la partición si falta, dentro de la transacción de `conn`; True si se creó."""
+    table = partition_table(key)
+    if conn.dialect.has_table(conn, table.name):
+        return False
+    table.create(conn)
+    seq = {"name": table.name, "seq": key * ID_STRIDE}
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), seq)
+    else:
+        conn.execute(text("SELECT setval(pg_get_serial_sequence(:name, 'id'), :seq)"), seq)
+    return True
+
+
+def _database_key(url: Any) -> str:
+    """La misma base con el engine síncrono y el asíncrono (mismo host/archivo, distinto driver)."""
+    url = make_url(url)
+    return str(url.set(drivername=url.get_backend_name()))
+
+
+class SensorPartitions:
+    """Particiones conocidas por base de datos y creación/borrado seguros entre procesos."""
+
+    def __init__(self, retention_days: float = 0.0):
+        self.retention_days = retention_days
+        self._known: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def tables(self, db: Session, since: Optional[datetime] = None) -> List[Table]:
+        """Particiones que pueden tener lecturas desde `since`, de la más antigua a la más nueva."""
+        return self._select(db, list_partitions(db), since)
+
+    async def tables_async(self, db: Any, since: Optional[datetime] = None) -> List[Table]:
+        """Como tables(), con una AsyncSession."""
+        rows = await db.execute(list_statement(db.get_bind().dialect.name))
+        return self._select(db, partition_keys(rows), since)
+
+    def _select(self, db: Any, keys: List[int], since: Optional[datetime]) -> List[Table]:
+        with self._lock:
+            self._known[_database_key(db.get_bind().url)] = set(keys)
+        if since is not None:
+            first = month_key(since)
+            keys = [k for k in keys if k >= first]
+        return [partition_table(k) for k in keys]
+
+    def cutoff(self) -> Optional[datetime]:
+        """Lecturas anteriores a este momento ya están fuera de la retención (None: sin retención)."""
+        if self.retention_days <= 0:
+            return None
+        return datetime.utcnow() - timedelta(days=self.retention_days)
+
+    def ensure(self, engine: Engine, key: int) -> Table:
+        """Partición del mes `key`, creándola si falta (con el lock de escritura de SQLite).
+
+        La retención que corre al crearla nunca borra la partición `key`, aunque su mes ya
+        haya vencido: quien la pidió va a escribir en ella a continuación.
+        """
+        url = _database_key(engine.url)
+        known = self._known.get(url)
+        if known is not None and key in known:
+            return partition_table(key)
+        with exclusive_transaction(engine) as conn:
+            created = create_partition(conn, key)
+        with self._lock:
+            self._known.setdefault(url, set()).add(key)
+        if created:
+            logger.info("Partición de sensores creada: %s", partition_name(key))
+            cutoff = self.cutoff()
+            if cutoff is not None:
+                self.drop_before(engine, cutoff, keep=key)
+        return partition_table(key)
+
+    def drop_before(self, engine: Engine, cutoff: datetime, keep: Optional[int] = None) -> List[str]:
+        """Borrar las particiones cuyo mes terminó antes de `cutoff` (DROP TABLE, sin DELETE), salvo `keep`."""
+        dropped = []
+        with exclusive_transaction(engine) as conn:
+            for key in list_partitions(conn):
+                if month_start(next_month(key)) > cutoff:
+                    break
+                if key == keep:
+                    continue
+                conn.exec_driver_sql(f"DROP TABLE {partition_name(key)}")
+                dropped.append(key)
+            if dropped:
+                conn.execute(bump_table_version(SENSOR_READINGS_VERSION))
+        with self._lock:
+            self._known.get(_database_key(engine.url), set()).difference_update(dropped)
+        if dropped:
+            logger.info("Particiones de sensores borradas por retención: %s", [partition_name(k) for k in dropped])
+        return [partition_name(k) for k in dropped]
+
+
+_partitions: Optional[SensorPartitions] = None
+_partitions_lock = threading.Lock()
+
+
+def get_sensor_partitions() -> SensorPartitions:
+    global _partitions
+    if _partitions is None:
+        with _partitions_lock:
+            if _partitions is None:
+                _partitions = SensorPartitions(retention_days=get_settings().sensor_retention_days)
+    return _partitions
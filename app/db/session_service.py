@@ -0,0 +1,52 @@
+"""
+Persistencia de sesiones de chat multi-turno (tabla chat_sessions).
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
+from datetime import datetime
+from typing import List, Optional
+from uuid import uuid4
+
+from app.db.database import ChatHistory, ChatSession
+from app.utils.metrics import DB_WRITE_SECONDS
+
+
+class SessionService:
+    """Sesiones: el resumen vive en chat_sessions y los turnos en chat_history (session_id)."""
+
+    @staticmethod
+    def create(db: Session) -> ChatSession:
+        session = ChatSession(id=uuid4().hex, summary="", summarized_through=0)
+        with DB_WRITE_SECONDS.time(table="chat_sessions"):
+            db.add(session)
+            db.commit()
+            db.refresh(session)
+        return session
+
+    @staticmethod
+    def get(db: Session, session_id: str) -> Optional[ChatSession]:
+        return db.get(ChatSession, session_id)
+
+    @staticmethod
+    def turns_after(db: Session, session_id: str, after_id: int) -> List[ChatHistory]:
+        """Turnos de la sesión todavía no incluidos en el resumen, del más antiguo al más nuevo."""
+        return list(db.scalars(
+            select(ChatHistory)
+            .where(ChatHistory.session_id == session_id, ChatHistory.id > after_id)
+            .order_by(ChatHistory.id)
+        ))
+
+    @staticmethod
+    def last_turn_id(db: Session, session_id: str) -> int:
+        """Último chat_history.id de la sesión (versión barata: una búsqueda en el índice de session_id)."""
+        return db.scalar(select(func.max(ChatHistory.id)).where(ChatHistory.session_id == session_id)) or 0
+
+    @staticmethod
+    def save_summary(db: Session, session_id: str, summary: str, summarized_through: int) -> None:
+        with DB_WRITE_SECONDS.time(table="chat_sessions"):
+            db.execute(
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                .values(summary=summary, summarized_through=summarized_through, updated_at=datetime.utcnow())
+            )
+            db.commit()
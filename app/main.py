@@ -1,14 +1,125 @@
 from __future__ import annotations
 
-from fastapi import FastAPI
+import threading
+import time
+from contextlib import asynccontextmanager
 
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from app.config import get_settings
+from app.routes.admin import router as admin_router
 from app.routes.agro import router as agro_router
+from app.utils.jsonio import FastJSONResponse
+from app.utils.logger import get_logger
+from app.utils.metrics import CONTENT_TYPE, REGISTRY, REQUEST_SECONDS
+from app.utils.profiler import PROFILER
+from app.utils.tracing import TRACER, begin_request, span
+
+logger = get_logger("agro.main")
+
+_settings = get_settings()
+TRACER.configure(enabled=_settings.trace_enabled, max_events=_settings.trace_max_events)
+
+
+def _preload_question_index() -> None:
+    """Construye o carga el índice de preguntas similares en segundo plano (no retrasa el arranque)."""
+    if not (_settings.enable_history and _settings.question_index_preload):
+        return
+
+    def build():
+        from app.db.database import SessionLocal
+        from app.services.question_index import get_question_index_store
+
+        db = SessionLocal()
+        try:
+            get_question_index_store().get(db)
+        except Exception as e:
+            logger.warning("No se pudo precargar el índice de preguntas: %s", e)
+        finally:
+            db.close()
+
+    threading.Thread(target=build, name="agro-question-index-preload", daemon=True).start()
+
+
+def _preload_sensor_trends() -> None:
+    """Reconstruye las tendencias de sensores en segundo plano (las usa el prompt de /v1/agro/ask)."""
+    if not (_settings.enable_history and _settings.sensor_trends_preload):
+        return
+
+    def build():
+        from app.db.database import SessionLocal
+        from app.services.sensor_trends import get_sensor_trends
+
+        db = SessionLocal()
+        try:
+            get_sensor_trends().ensure_loaded(db)
+        except Exception as e:
+            logger.warning("No se pudieron precargar las tendencias de sensores: %s", e)
+        finally:
+            db.close()
 
-app = FastAPI(title="Agro Gemini API", version="0.1.0")
+    threading.Thread(target=build, name="agro-sensor-trends-preload", daemon=True).start()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _preload_question_index()
+    _preload_sensor_trends()
+    yield
+    if get_settings().enable_history:
+        from app.db.database import dispose_async_engine
+
+        await dispose_async_engine()
+
+
+# Respuestas JSON con orjson (si está instalado) en todas las rutas
+app = FastAPI(
+    title="Agro Gemini API",
+    version="0.1.0",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
+)
 
 app.include_router(agro_router)
+app.include_router(admin_router)
+
+
+# Rutas que no descuentan peticiones de una sesión del profiler (`/admin/profiler/start?requests=N`)
+_UNPROFILED_ROUTES = ("/admin/", "/metrics")
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    begin_request()
+    try:
+        with span("http.request", cat="http", method=request.method, path=request.url.path) as attrs:
+            response = await call_next(request)
+            status = response.status_code
+            attrs["status"] = status
+        return response
+    finally:
+        # Usar la plantilla de la ruta (p. ej. /v1/agro/history/{chat_id}) para acotar la cardinalidad
+        route_path = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=route_path,
+            status=str(status),
+        )
+        # El cupo del profiler cuenta solo tráfico real (no su propio control ni los scrapes)
+        if not route_path.startswith(_UNPROFILED_ROUTES):
+            PROFILER.request_finished()
 
 
 @app.get("/")
 async def root():
     return {"name": "Agro Gemini API", "docs": "/docs"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Métricas en formato de exposición de Prometheus."""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.config import get_settings
+from app.utils.profiler import PROFILER
+from app.utils.tracing import TRACER
+
+router = APIRouter(prefix="/admin", include_in_schema=False)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Los endpoints de administración solo existen si ADMIN_TOKEN está configurado."""
+    token = get_settings().admin_token
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, token):
+        raise HTTPException(status_code=401, detail="Token de administración inválido")
+
+
+@router.get("/trace", dependencies=[Depends(require_admin)])
+async def get_trace():
+    """
+    Spans registrados en formato Chrome Trace (abrir en chrome://tracing o ui.perfetto.dev).
+    """
+    return TRACER.export_chrome_trace()
+
+
+@router.post("/trace", dependencies=[Depends(require_admin)])
+async def set_tracing(enabled: bool = True, clear: bool = False):
+    """
+    Activa o desactiva el registro de spans.
+
+    - enabled: true para registrar spans
+    - clear: vaciar el buffer antes de continuar
+    """
+    if clear:
+        TRACER.clear()
+    TRACER.configure(enabled=enabled)
+    return {"enabled": TRACER.enabled, "events": len(TRACER.events())}
+
+
+@router.post("/profiler/start", dependencies=[Depends(require_admin)])
+async def start_profiler(
+    requests: Optional[int] = None,
+    seconds: Optional[float] = None,
+    interval_ms: float = 5.0,
+):
+    """
+    Inicia el perfilador por muestreo para las próximas N peticiones o una ventana de tiempo.
+
+    - requests: número de peticiones a perfilar
+    - seconds: duración máxima de la sesión (por defecto 30 s si no se indica ninguno)
+    - interval_ms: intervalo de muestreo (default 5 ms)
+    """
+    if requests is not None and requests <= 0:
+        raise HTTPException(status_code=400, detail="'requests' debe ser mayor que 0")
+    if seconds is not None and seconds <= 0:
+        raise HTTPException(status_code=400, detail="'seconds' debe ser mayor que 0")
+    if requests is None and seconds is None:
+        seconds = 30.0
+    try:
+        PROFILER.start(requests=requests, seconds=seconds, interval_ms=interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    return PROFILER.status()
+
+
+@router.post("/profiler/stop", dependencies=[Depends(require_admin)])
+async def stop_profiler():
+    PROFILER.stop()
+    return PROFILER.status()
+
+
+@router.get("/profiler", dependencies=[Depends(require_admin)])
+async def profiler_status():
+    return PROFILER.status()
+
+
+@router.get("/profiler/flamegraph", dependencies=[Depends(require_admin)], response_class=PlainTextResponse)
+async def profiler_flamegraph():
+    """
+    Pilas muestreadas en formato folded (flamegraph.pl, speedscope.app).
+    """
+    return PlainTextResponse(PROFILER.folded())
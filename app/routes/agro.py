@@ -1,28 +1,81 @@
 from __future__ import annotations
 
-from pathlib import Path
+import asyncio
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Any, Optional
 
-from fastapi import APIRouter, HTTPException, Depends, Request
-from sqlalchemy.orm import Session
+import anyio
+from fastapi import APIRouter, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.requests import ClientDisconnect
 
 from app.config import get_settings
 from app.schemas.requests import AskRequest
 from app.schemas.responses import AskResponse
 from app.schemas.chat import ChatRequest, ChatResponse
-from app.services.gemini_client import GeminiClient
-from app.db.database import get_db, init_db, ChatHistory
-from app.db.history_service import HistoryService
+from app.services.gemini_client import get_gemini_client
+from app.services.jobs import get_job_pool, job_to_dict
+from app.services.admission import model_slot, rate_limit
+from app.services.circuit_breaker import BREAKER
+from app.services.key_pool import get_key_pool
+from app.services.model_router import get_model_router
+from app.services.sensor_stream import SensorStream, open_stream
+from app.services.sensor_trends import get_sensor_trends
+from app.services.sessions import estimate_tokens, get_session_store
+from app.utils.deadline import Deadline
+from app.utils.http_cache import cache_headers, make_etag, not_modified
+from app.utils.jsonio import FastJSONResponse, JSONDecodeError, dumps, loads
+from app.utils.logger import get_logger
 
 router = APIRouter()
+logger = get_logger("agro.routes")
 
-PROMPT_PATH = Path(__file__).resolve().parent.parent / "prompts" / "agriculture_system_prompt.md"
+# Intervalo entre lecturas del trabajo durante un long-poll
+_JOB_POLL_INTERVAL_S = 0.25
+# Línea NDJSON más larga aceptada en /v1/agro/sensors/stream (una lectura ocupa ~200 bytes)
+_STREAM_MAX_LINE_BYTES = 64 * 1024
 
-# Inicializar DB al cargar el módulo (solo si está habilitado)
-settings = get_settings()
-if settings.enable_history:
-    init_db()
+
+def get_db():
+    """Sesión de DB para el historial (None si está deshabilitado).
+
+    SQLAlchemy se importa y las tablas se crean en el primer uso del historial,
+    no al importar el módulo, para no cargar el arranque en frío.
+    """
+    if not get_settings().enable_history:
+        yield None
+        return
+    from app.db.database import get_db as _get_db
+
+    yield from _get_db()
+
+
+async def get_async_db():
+    """AsyncSession para los endpoints de lectura del historial (None si está deshabilitado).
+
+    Las consultas corren en el driver asíncrono (aiosqlite/asyncpg) y no bloquean el
+    event loop mientras otras peticiones esperan al modelo.
+    """
+    if not get_settings().enable_history:
+        yield None
+        return
+    from app.db.database import get_async_db as _get_async_db
+
+    async for db in _get_async_db():
+        yield db
+
+
+async def _load_session(db, session_id: str):
+    """Estado de una sesión de chat (404 si no existe; 503 sin historial, que es su almacenamiento)."""
+    if db is None:
+        raise HTTPException(status_code=503, detail="Sesiones deshabilitadas en este entorno")
+    session = await run_in_threadpool(get_session_store().get, db, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    return session
 
 
 @router.get("/health")
@@ -32,12 +85,15 @@ async def health():
         "status": "ok",
         "mock_mode": settings.mock_mode,
         "model": settings.gemini_model,
-        "history_enabled": settings.enable_history
+        "history_enabled": settings.enable_history,
+        "circuit_breaker": BREAKER.status(),
+        "model_router": get_model_router().status() if settings.model_routing else None,
+        "api_keys": pool.status() if (pool := get_key_pool()) is not None else None,
     }
 
 
-@router.post("/v1/agro/ask", response_model=AskResponse)
-async def ask(req: AskRequest, request: Request, db: Session = Depends(get_db)):
+@router.post("/v1/agro/ask", response_model=AskResponse, dependencies=[Depends(rate_limit)])
+async def ask(req: AskRequest, request: Request, db=Depends(get_db)):
     """
     Endpoint principal para recomendaciones agrícolas.
     
@@ -46,6 +102,8 @@ async def ask(req: AskRequest, request: Request, db: Session = Depends(get_db)):
     """
     settings = get_settings()
     start_time = datetime.utcnow()
+    # El presupuesto cuenta desde que llega la petición (incluye la espera en cola)
+    deadline = Deadline(settings.timeout_s)
 
     # Validación flexible: requiere 'question' o (parameter y value)
     has_question = bool(req.question and req.question.strip())
@@ -56,8 +114,10 @@ async def ask(req: AskRequest, request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="La pregunta es demasiado larga.")
 
     try:
-        client = GeminiClient(prompt_path=PROMPT_PATH)
-        resp = client.ask(req)
+        client = get_gemini_client()
+        # La llamada al modelo es bloqueante: se ejecuta fuera del event loop y con cupo acotado
+        async with model_slot():
+            resp = await run_in_threadpool(client.ask, req, deadline)
         
         # Calcular tiempo de respuesta
         response_time = int((datetime.utcnow() - start_time).total_seconds() * 1000)
@@ -65,6 +125,8 @@ async def ask(req: AskRequest, request: Request, db: Session = Depends(get_db)):
         # Guardar en historial (solo si está habilitado)
         if settings.enable_history:
             try:
+                from app.db.history_service import HistoryService
+
                 rec_dict = None
                 if resp.recommendation:
                     rec_dict = {
@@ -114,17 +176,19 @@ async def ask(req: AskRequest, request: Request, db: Session = Depends(get_db)):
                     )
             except Exception as e:
                 # No fallar si el guardado falla, solo loggear
-                print(f"Error guardando historial: {e}")
+                logger.warning("Error guardando historial: %s", e)
         
         return resp
+    except HTTPException:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve)) from ve
     except Exception as e:
         raise HTTPException(status_code=502, detail="Error al consultar el modelo.") from e
 
 
-@router.post("/v1/agro/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)):
+@router.post("/v1/agro/chat", response_model=ChatResponse, dependencies=[Depends(rate_limit)])
+async def chat(req: ChatRequest, request: Request, db=Depends(get_db)):
     """
     Endpoint simplificado para consultas de texto libre (sin datos de sensores).
     
@@ -133,12 +197,17 @@ async def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)
     """
     settings = get_settings()
     start_time = datetime.utcnow()
+    # El presupuesto cuenta desde que llega la petición (incluye la espera en cola)
+    deadline = Deadline(settings.timeout_s)
     
     if len(req.question) > settings.max_input_chars:
         raise HTTPException(status_code=400, detail="La pregunta es demasiado larga.")
+
+    session = await _load_session(db, req.session_id) if req.session_id else None
+    context = get_session_store().context(session) if session is not None else None
     
     try:
-        client = GeminiClient(prompt_path=PROMPT_PATH)
+        client = get_gemini_client()
         # Convertir ChatRequest a AskRequest para reutilizar la lógica existente
         ask_req = AskRequest(
             question=req.question,
@@ -147,7 +216,8 @@ async def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)
             length=req.length,
             safe_mode=req.safe_mode
         )
-        resp = client.ask(ask_req)
+        async with model_slot():
+            resp = await run_in_threadpool(client.ask, ask_req, deadline, context)
         
         # Calcular tiempo de respuesta
         response_time = int((datetime.utcnow() - start_time).total_seconds() * 1000)
@@ -155,7 +225,9 @@ async def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)
         # Guardar en historial (solo si está habilitado)
         if settings.enable_history:
             try:
-                HistoryService.save_chat(
+                from app.db.history_service import HistoryService
+
+                chat = HistoryService.save_chat(
                     db=db,
                     endpoint="/v1/agro/chat",
                     question=req.question,
@@ -169,30 +241,128 @@ async def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)
                     model=resp.model,
                     recommendation=None,
                     response_time_ms=response_time,
-                    user_ip=request.client.host if request.client else None
+                    user_ip=request.client.host if request.client else None,
+                    session_id=req.session_id
                 )
+                if session is not None:
+                    get_session_store().record(db, session, chat.id, req.question, resp.answer)
             except Exception as e:
                 # No fallar si el guardado falla, solo loggear
-                print(f"Error guardando historial: {e}")
+                logger.warning("Error guardando historial: %s", e)
         
         # Convertir AskResponse a ChatResponse (solo campos relevantes)
         return ChatResponse(
             answer=resp.answer,
             model=resp.model,
-            tips=resp.tips
+            tips=resp.tips,
+            session_id=req.session_id
         )
+    except HTTPException:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve)) from ve
     except Exception as e:
         raise HTTPException(status_code=502, detail="Error al consultar el modelo.") from e
 
 
+@router.post("/v1/agro/sessions", status_code=201)
+async def create_session(db=Depends(get_db)):
+    """
+    Abre una sesión de chat multi-turno.
+
+    Enviar el `session_id` devuelto en /v1/agro/chat (o /v1/agro/jobs) para que
+    la conversación previa se use como contexto, sin repetirla en `question`.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Sesiones deshabilitadas en este entorno")
+    session = await run_in_threadpool(get_session_store().create, db)
+    return FastJSONResponse({"session_id": session.session_id}, status_code=201)
+
+
+@router.get("/v1/agro/sessions/{session_id}")
+async def get_session(session_id: str, db=Depends(get_db)):
+    """Resumen acumulado y turnos recientes de una sesión (lo que se envía como contexto)."""
+    session = await _load_session(db, session_id)
+    context = get_session_store().context(session) or ""
+    return FastJSONResponse({
+        "session_id": session.session_id,
+        "summary": session.summary,
+        "summarized_through": session.summarized_through,
+        "turns": [{"chat_id": t.chat_id, "question": t.question, "answer": t.answer} for t in session.turns],
+        "context_tokens": estimate_tokens(context),
+    })
+
+
+@router.post("/v1/agro/jobs", status_code=202, dependencies=[Depends(rate_limit)])
+async def submit_job(req: ChatRequest, request: Request, db=Depends(get_db)):
+    """
+    Encola una consulta de chat y responde de inmediato con el id del trabajo.
+
+    Pensado para respuestas largas y redes inestables: el cliente consulta el
+    resultado con GET /v1/agro/jobs/{job_id} (opcionalmente con long-poll).
+    """
+    settings = get_settings()
+    if not settings.enable_history:
+        raise HTTPException(status_code=503, detail="Trabajos asíncronos deshabilitados en este entorno")
+    if len(req.question) > settings.max_input_chars:
+        raise HTTPException(status_code=400, detail="La pregunta es demasiado larga.")
+    if req.session_id:
+        await _load_session(db, req.session_id)
+
+    pool = get_job_pool()
+    try:
+        job = await run_in_threadpool(pool.submit, req, request.client.host if request.client else None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al encolar el trabajo: {str(e)}") from e
+    return FastJSONResponse(
+        {"job_id": job.id, "status": job.status, "poll_url": f"/v1/agro/jobs/{job.id}"},
+        status_code=202,
+    )
+
+
+@router.get("/v1/agro/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0.0):
+    """
+    Estado y resultado de un trabajo asíncrono.
+
+    - wait: segundos a esperar a que termine (long-poll, máximo JOB_LONG_POLL_MAX_S)
+    Estados: queued, running, done (con `result`) o error.
+    """
+    settings = get_settings()
+    if not settings.enable_history:
+        raise HTTPException(status_code=503, detail="Trabajos asíncronos deshabilitados en este entorno")
+    from app.db.database import SessionLocal
+    from app.db.job_service import DONE, ERROR, JobService
+
+    # Tras un reinicio, la primera consulta de un cliente reanuda los trabajos pendientes
+    await run_in_threadpool(get_job_pool().start)
+
+    def load():
+        db = SessionLocal()
+        try:
+            job = JobService.get(db, job_id)
+            return job_to_dict(job) if job is not None else None
+        finally:
+            db.close()
+
+    deadline = time.monotonic() + min(max(wait, 0.0), settings.job_long_poll_max_s)
+    while True:
+        job = await run_in_threadpool(load)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+        remaining = deadline - time.monotonic()
+        if job["status"] in (DONE, ERROR) or remaining <= 0:
+            return FastJSONResponse(job)
+        await asyncio.sleep(min(_JOB_POLL_INTERVAL_S, remaining))
+
+
 @router.get("/v1/agro/history")
 async def get_history(
+    request: Request,
     limit: int = 50,
     endpoint: Optional[str] = None,
     crop: Optional[str] = None,
-    db: Session = Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Obtiene el historial reciente de conversaciones.
@@ -200,25 +370,32 @@ async def get_history(
     - limit: número máximo de resultados (default 50)
     - endpoint: filtrar por endpoint (/v1/agro/chat o /v1/agro/ask)
     - crop: filtrar por cultivo
+
+    Responde 304 si If-None-Match trae el ETag vigente (no hubo conversaciones nuevas).
     """
     settings = get_settings()
     if not settings.enable_history:
         raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.history_service import AsyncHistoryService
     
     try:
+        etag = make_etag("history", await AsyncHistoryService.chats_version(db))
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
         if endpoint:
-            chats = HistoryService.get_recent_chats(db, limit=limit, endpoint=endpoint)
+            chats = await AsyncHistoryService.get_recent_chats(db, limit=limit, endpoint=endpoint)
         elif crop:
-            chats = HistoryService.get_chats_by_crop(db, crop=crop, limit=limit)
+            chats = await AsyncHistoryService.get_chats_by_crop(db, crop=crop, limit=limit)
         else:
-            chats = HistoryService.get_recent_chats(db, limit=limit)
+            chats = await AsyncHistoryService.get_recent_chats(db, limit=limit)
         
-        return {
+        return FastJSONResponse({
             "total": len(chats),
             "chats": [
                 {
                     "id": chat.id,
-                    "timestamp": chat.timestamp.isoformat(),
+                    "timestamp": chat.timestamp,
                     "endpoint": chat.endpoint,
                     "question": chat.question,
                     "crop": chat.crop,
@@ -232,28 +409,60 @@ async def get_history(
                 }
                 for chat in chats
             ]
-        }
+        }, headers=cache_headers(etag))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener historial: {str(e)}") from e
 
 
+@router.get("/v1/agro/history/export")
+async def export_history(crop: Optional[str] = None, since: Optional[datetime] = None):
+    """
+    Exporta el historial completo como NDJSON (una conversación por línea), en streaming.
+
+    - crop: filtrar por cultivo
+    - since: solo conversaciones desde esta fecha (ISO 8601)
+    No incluye la IP del usuario.
+    """
+    settings = get_settings()
+    if not settings.enable_history:
+        raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.database import SessionLocal
+    from app.db.history_service import HistoryService
+
+    def rows():
+        # Sesión propia: el generador sigue leyendo después de que el endpoint retorna
+        db = SessionLocal()
+        try:
+            for row in HistoryService.iter_chats(db, crop=crop, since=since):
+                yield dumps(row) + b"\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(
+        rows(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="chat_history.ndjson"'},
+    )
+
+
 @router.get("/v1/agro/history/{chat_id}")
-async def get_chat_detail(chat_id: int, db: Session = Depends(get_db)):
+async def get_chat_detail(chat_id: int, db=Depends(get_async_db)):
     """
     Obtiene el detalle completo de una conversación específica.
     """
     settings = get_settings()
     if not settings.enable_history:
         raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.history_service import AsyncHistoryService
     
     try:
-        chat = db.query(ChatHistory).filter_by(id=chat_id).first()
+        chat = await AsyncHistoryService.get_chat(db, chat_id)
         if not chat:
             raise HTTPException(status_code=404, detail="Conversación no encontrada")
         
-        return {
+        return FastJSONResponse({
             "id": chat.id,
-            "timestamp": chat.timestamp.isoformat(),
+            "timestamp": chat.timestamp,
             "endpoint": chat.endpoint,
             "question": chat.question,
             "crop": chat.crop,
@@ -268,7 +477,7 @@ async def get_chat_detail(chat_id: int, db: Session = Depends(get_db)):
             "response_time_ms": chat.response_time_ms,
             "user_ip": chat.user_ip,
             "error": chat.error
-        }
+        })
     except HTTPException:
         raise
     except Exception as e:
@@ -277,11 +486,12 @@ async def get_chat_detail(chat_id: int, db: Session = Depends(get_db)):
 
 @router.get("/v1/agro/sensors/history")
 async def get_sensor_history(
+    request: Request,
     crop: Optional[str] = None,
     parameter: Optional[str] = None,
     hours: int = 24,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Obtiene el historial de lecturas de sensores y recomendaciones.
@@ -290,13 +500,21 @@ async def get_sensor_history(
     - parameter: filtrar por parámetro (ej: "humedad_suelo")
     - hours: últimas N horas (default 24)
     - limit: número máximo de resultados (default 100)
+
+    Responde 304 si If-None-Match trae el ETag vigente (sin lecturas nuevas ni lecturas
+    que hayan salido de la ventana de `hours`).
     """
     settings = get_settings()
     if not settings.enable_history:
         raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.history_service import AsyncHistoryService
     
     try:
-        sensors = HistoryService.get_sensor_history(
+        etag = make_etag("sensors", await AsyncHistoryService.sensors_version(db, hours=hours))
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+        sensors = await AsyncHistoryService.get_sensor_history(
             db=db,
             crop=crop,
             parameter=parameter,
@@ -304,12 +522,12 @@ async def get_sensor_history(
             limit=limit
         )
         
-        return {
+        return FastJSONResponse({
             "total": len(sensors),
             "readings": [
                 {
                     "id": s.id,
-                    "timestamp": s.timestamp.isoformat(),
+                    "timestamp": s.timestamp,
                     "crop": s.crop,
                     "stage": s.stage,
                     "parameter": s.parameter,
@@ -325,35 +543,296 @@ async def get_sensor_history(
                 }
                 for s in sensors
             ]
-        }
+        }, headers=cache_headers(etag))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener sensores: {str(e)}") from e
 
 
+@router.get("/v1/agro/sensors/trends")
+async def get_sensor_trend_stats(crop: Optional[str] = None, parameter: Optional[str] = None, db=Depends(get_db)):
+    """
+    Estadísticas móviles por (cultivo, parámetro), mantenidas en memoria.
+
+    - crop: filtrar por cultivo
+    - parameter: filtrar por parámetro (ej: "humedad_suelo")
+    Por serie: EWMA, media, desvío, mínimo y máximo de la ventana, pendiente por
+    hora, z-score de la última lectura y tendencia (subiendo/bajando/estable).
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    trends = get_sensor_trends()
+    try:
+        series = await run_in_threadpool(trends.query, db, crop, parameter)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtener tendencias: {str(e)}") from e
+    return FastJSONResponse({"total": len(series), "window": trends.window, "series": series})
+
+
+async def _ingest(stream: SensorStream, payload, line: int):
+    """Procesa una lectura del flujo; devuelve el evento de error si no es válida o None.
+
+    Las recomendaciones salen aparte, de stream.take_events(), cuando el modelo responde.
+    """
+    try:
+        return await stream.handle(payload)
+    except ValidationError as e:
+        detail = "; ".join(f"{'.'.join(map(str, err['loc'])) or 'lectura'}: {err['msg']}" for err in e.errors())
+        return stream.invalid(line, detail)
+    except ValueError as e:
+        return stream.invalid(line, str(e))
+
+
+async def _wait_input(stream: SensorStream, incoming: "asyncio.Future[Any]", timeout: Optional[float] = None) -> bool:
+    """Espera la próxima entrada del cliente o una recomendación lista; True si llegó la entrada.
+
+    `incoming` sigue pendiente si despertó una recomendación (o venció `timeout`): se
+    vuelve a esperar en la próxima vuelta, sin perder lo que el cliente envíe.
+    """
+    ready = asyncio.ensure_future(stream.ready.wait())
+    try:
+        await asyncio.wait({incoming, ready}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        ready.cancel()
+    return incoming.done()
+
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse que no escucha la desconexión en paralelo.
+
+    La respuesta estándar consume `receive` en otra tarea para detectar la
+    desconexión y se come el body que el generador todavía está leyendo; aquí la
+    desconexión llega al generador como ClientDisconnect de request.stream().
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+@router.post("/v1/agro/sensors/stream", dependencies=[Depends(rate_limit)])
+async def stream_sensor_readings(request: Request):
+    """
+    Ingesta continua de lecturas de sensores (body NDJSON en chunks, una lectura por línea).
+
+    Responde otro flujo NDJSON: un evento `recommendation` cuando una lectura cambia
+    de banda o de etapa, `error` por cada línea inválida y un `summary` al final.
+    Las lecturas se guardan en sensor_readings por lotes.
+    """
+    if not get_settings().enable_history:
+        raise HTTPException(status_code=503, detail="Ingesta de sensores deshabilitada en este entorno")
+    from app.db.database import SessionLocal
+
+    async def events():
+        # Sesión propia: el cuerpo se sigue leyendo después de que el endpoint retorna
+        db = SessionLocal()
+        stream = open_stream(db)
+        line = 0
+        pending = b""
+        chunks = request.stream().__aiter__()
+        incoming = None
+        try:
+            while True:
+                if incoming is None:
+                    incoming = asyncio.ensure_future(chunks.__anext__())
+                arrived = await _wait_input(stream, incoming)
+                for event in stream.take_events():
+                    yield dumps(event) + b"\n"
+                if not arrived:
+                    continue
+                try:
+                    chunk = incoming.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    incoming = None
+                pending += chunk
+                *lines, pending = pending.split(b"\n")
+                if len(pending) > _STREAM_MAX_LINE_BYTES:
+                    yield dumps(stream.invalid(line + 1, "Línea demasiado larga; se corta el flujo")) + b"\n"
+                    pending = b""
+                    break
+                for raw in lines:
+                    line += 1
+                    if not raw.strip():
+                        continue
+                    try:
+                        payload = loads(raw)
+                    except JSONDecodeError:
+                        yield dumps(stream.invalid(line, "JSON inválido")) + b"\n"
+                        continue
+                    event = await _ingest(stream, payload, line)
+                    if event is not None:
+                        yield dumps(event) + b"\n"
+            if pending.strip():
+                line += 1
+                try:
+                    event = await _ingest(stream, loads(pending), line)
+                except JSONDecodeError:
+                    event = stream.invalid(line, "JSON inválido")
+                if event is not None:
+                    yield dumps(event) + b"\n"
+            for event in await stream.drain():
+                yield dumps(event) + b"\n"
+            await stream.flush()
+        except ClientDisconnect:
+            # El gateway cortó: se guarda lo recibido, pero ya no hay a quién responder
+            await stream.drain()
+            await stream.flush()
+            return
+        except Exception as e:
+            db.rollback()
+            logger.warning("Error en ingesta continua de sensores: %s", e)
+            yield dumps({"type": "error", "detail": "Error al guardar lecturas"}) + b"\n"
+        finally:
+            if incoming is not None:
+                incoming.cancel()
+            stream.cancel()
+            db.close()
+        yield dumps(stream.summary()) + b"\n"
+
+    return _DuplexStreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@router.websocket("/v1/agro/sensors/ws")
+async def sensor_readings_ws(websocket: WebSocket):
+    """
+    Ingesta continua de lecturas por WebSocket: cada mensaje es una lectura o una lista.
+
+    Envía un evento `recommendation` cuando cambia el estado y `error` por lectura
+    inválida; las lecturas se guardan por lotes, también si la conexión queda ociosa.
+    """
+    if not get_settings().enable_history:
+        await websocket.close(code=1013, reason="Ingesta de sensores deshabilitada en este entorno")
+        return
+    from app.db.database import SessionLocal
+
+    await websocket.accept()
+    db = SessionLocal()
+    stream = open_stream(db)
+    message = 0
+    incoming = None
+    try:
+        while True:
+            if incoming is None:
+                incoming = asyncio.ensure_future(websocket.receive_text())
+            idle_since = time.monotonic()
+            arrived = await _wait_input(stream, incoming, timeout=stream.flush_interval_s)
+            for event in stream.take_events():
+                await websocket.send_text(dumps(event).decode("utf-8"))
+            if not arrived:
+                if time.monotonic() - idle_since >= stream.flush_interval_s:
+                    await stream.flush()
+                continue
+            try:
+                text = incoming.result()
+            finally:
+                incoming = None
+            message += 1
+            try:
+                payload = loads(text)
+            except JSONDecodeError:
+                await websocket.send_text(dumps(stream.invalid(message, "JSON inválido")).decode("utf-8"))
+                continue
+            for item in payload if isinstance(payload, list) else (payload,):
+                event = await _ingest(stream, item, message)
+                if event is not None:
+                    await websocket.send_text(dumps(event).decode("utf-8"))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if incoming is not None:
+            incoming.cancel()
+        try:
+            # Protegido de la cancelación: lo recibido se guarda aunque el servidor cierre la conexión
+            with anyio.CancelScope(shield=True):
+                await stream.drain()
+                await stream.flush()
+        except Exception as e:
+            db.rollback()
+            logger.warning("Error guardando lecturas al cerrar el WebSocket: %s", e)
+        db.close()
+
+
 @router.get("/v1/agro/stats")
-async def get_stats(db: Session = Depends(get_db)):
+async def get_stats(request: Request, db=Depends(get_async_db)):
     """
     Obtiene estadísticas de uso del API.
     
     Retorna total de chats, total de sensores, cultivos más consultados,
     parámetros más medidos, y tiempo promedio de respuesta.
+    Responde 304 si If-None-Match trae el ETag vigente, sin recalcular los agregados.
     """
     settings = get_settings()
     if not settings.enable_history:
         raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.history_service import AsyncHistoryService
     
     try:
-        stats = HistoryService.get_stats(db)
-        return stats
+        etag = make_etag(
+            "stats", await AsyncHistoryService.chats_version(db), await AsyncHistoryService.sensors_version(db)
+        )
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+        stats = await AsyncHistoryService.get_stats(db)
+        return FastJSONResponse(stats, headers=cache_headers(etag))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener estadísticas: {str(e)}") from e
 
 
+@router.get("/v1/agro/similar")
+async def similar_questions(q: str, k: int = 5, min_score: float = 0.2, db=Depends(get_db)):
+    """
+    Preguntas ya respondidas parecidas a `q` (para sugerir mientras el usuario escribe).
+
+    - q: texto de la consulta (al menos 3 caracteres)
+    - k: número de resultados (1-50)
+    - min_score: similitud mínima (0-1)
+    """
+    settings = get_settings()
+    if not settings.enable_history:
+        raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    if not q or len(q.strip()) < 3:
+        raise HTTPException(status_code=400, detail="La consulta debe tener al menos 3 caracteres")
+    if len(q) > settings.max_input_chars:
+        raise HTTPException(status_code=400, detail="La consulta es demasiado larga.")
+    from app.db.database import ChatHistory
+    from app.services.question_index import get_question_index_store
+
+    k = min(max(k, 1), 50)
+
+    def lookup():
+        index = get_question_index_store().get(db)
+        hits = index.search(q, k=k, min_score=min_score)
+        rows = {c.id: c for c in db.query(ChatHistory).filter(ChatHistory.id.in_([cid for cid, _ in hits]))}
+        return [(rows[cid], score) for cid, score in hits if cid in rows]
+
+    try:
+        hits = await run_in_threadpool(lookup)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error en búsqueda: {str(e)}") from e
+    return FastJSONResponse({
+        "query": q,
+        "results": [
+            {
+                "id": chat.id,
+                "score": score,
+                "timestamp": chat.timestamp,
+                "question": chat.question,
+                "crop": chat.crop,
+                "answer_preview": chat.answer[:150] + "..." if chat.answer and len(chat.answer) > 150 else chat.answer,
+            }
+            for chat, score in hits
+        ],
+    })
+
+
 @router.get("/v1/agro/search")
 async def search_history(
     q: str,
     limit: int = 20,
-    db: Session = Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Busca en el historial de conversaciones por texto.
@@ -364,20 +843,21 @@ async def search_history(
     settings = get_settings()
     if not settings.enable_history:
         raise HTTPException(status_code=503, detail="Historial deshabilitado en este entorno")
+    from app.db.history_service import AsyncHistoryService
     
     if not q or len(q) < 2:
         raise HTTPException(status_code=400, detail="El término de búsqueda debe tener al menos 2 caracteres")
     
     try:
-        chats = HistoryService.search_chats(db, query=q, limit=limit)
+        chats = await AsyncHistoryService.search_chats(db, query=q, limit=limit)
         
-        return {
+        return FastJSONResponse({
             "query": q,
             "total": len(chats),
             "results": [
                 {
                     "id": chat.id,
-                    "timestamp": chat.timestamp.isoformat(),
+                    "timestamp": chat.timestamp,
                     "endpoint": chat.endpoint,
                     "question": chat.question,
                     "crop": chat.crop,
@@ -386,6 +866,6 @@ async def search_history(
                 }
                 for chat in chats
             ]
-        }
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en búsqueda: {str(e)}") from e
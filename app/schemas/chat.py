@@ -17,6 +17,10 @@ class ChatRequest(BaseModel):
         True,
         description="Modo educativo seguro con reframings automáticos"
     )
+    session_id: Optional[str] = Field(
+        None,
+        description="Sesión multi-turno (de POST /v1/agro/sessions); la conversación previa se agrega como contexto"
+    )
 
 
 class ChatResponse(BaseModel):
@@ -24,3 +28,4 @@ class ChatResponse(BaseModel):
     answer: str = Field(..., description="Respuesta educativa en formato texto o bullets")
     model: str = Field(..., description="Modelo usado para generar la respuesta")
     tips: Optional[list[str]] = Field(None, description="Tips adicionales opcionales")
+    session_id: Optional[str] = Field(None, description="Sesión a la que se agregó el turno (si se envió)")
@@ -1,8 +1,14 @@
 from __future__ import annotations
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Literal
 
+from app.config import get_settings
+
+# Adelanto máximo aceptado en la hora que envía un gateway (relojes desfasados, zona horaria mal puesta)
+MAX_READING_CLOCK_SKEW = timedelta(days=1)
+
 
 class AskRequest(BaseModel):
     question: Optional[str] = Field(None, description="Pregunta principal (opcional si se envía parámetro y valor)")
@@ -57,3 +63,33 @@ class AskRequest(BaseModel):
         # Normaliza a forma inglesa interna para la lógica del modelo, manteniendo el valor original disponible en output
         if self.parameter:
             object.__setattr__(self, "parameter", self._map_parameter(self.parameter))
+
+
+class SensorStreamReading(BaseModel):
+    """Lectura enviada por un gateway en el flujo continuo (una línea NDJSON o un mensaje WebSocket)."""
+    crop: str = Field(..., description="Cultivo")
+    parameter: str = Field(..., description="Parámetro medido (mismos nombres que en /v1/agro/ask)")
+    value: float = Field(..., description="Valor observado")
+    unit: Optional[str] = Field(None, description="Unidad del parámetro")
+    stage: Optional[str] = Field(None, description="Etapa fenológica (opcional)")
+    timestamp: Optional[datetime] = Field(None, description="Momento de la lectura (por defecto, cuando llega)")
+
+    @field_validator("timestamp")
+    @classmethod
+    def _check_timestamp(cls, value: Optional[datetime]) -> Optional[datetime]:
+        # Se guarda en UTC sin zona, como datetime.utcnow() en el resto del historial
+        if value is None:
+            return value
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        # Cada mes distinto crea una partición: una hora arbitraria no puede abrir tablas fuera de la ventana
+        now = datetime.utcnow()
+        if value > now + MAX_READING_CLOCK_SKEW:
+            raise ValueError("timestamp más de un día en el futuro")
+        settings = get_settings()
+        max_age_days = settings.sensor_reading_max_age_days
+        if settings.sensor_retention_days > 0:
+            max_age_days = min(max_age_days, settings.sensor_retention_days)
+        if value < now - timedelta(days=max_age_days):
+            raise ValueError(f"timestamp de hace más de {max_age_days:g} días")
+        return value
@@ -0,0 +1,189 @@
+"""
+Control de admisión: límite de tasa por cliente y concurrencia acotada hacia el modelo.
+
+- RateLimiter: token bucket por cliente (API key configurada o IP). Al agotarse → 429 + Retry-After.
+- ConcurrencyLimiter: semáforo global de llamadas al modelo con cola de espera acotada.
+  Si la cola está llena o vence el plazo de espera → 503 + Retry-After, en lugar de
+  acumular peticiones que agotarían la cuota de Gemini para todos.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+from app.config import get_settings
+from app.utils.metrics import REGISTRY
+
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "agro_admission_rejections_total",
+    "Peticiones rechazadas por control de admisión.",
+    ("reason",),
+)
+MODEL_QUEUE_DEPTH = REGISTRY.gauge(
+    "agro_model_queue_depth",
+    "Peticiones esperando turno para llamar al modelo.",
+)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Límite de peticiones excedido")
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__("Servicio saturado")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class RateLimiter:
+    """Token bucket por clave con número de claves acotado (LRU)."""
+
+    def __init__(self, rate_per_s: float, burst: int, max_keys: int = 10_000):
+        self.rate = rate_per_s
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, cost: float = 1.0) -> None:
+        """Consume `cost` tokens o lanza RateLimited con el tiempo hasta tener saldo."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                allowed = True
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed = False
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        if not allowed:
+            raise RateLimited(retry_after=(cost - tokens) / self.rate)
+
+
+class ConcurrencyLimiter:
+    """Semáforo asyncio con cola de espera acotada y plazo máximo de espera."""
+
+    def __init__(self, max_concurrent: int, max_queue: int, wait_timeout_s: float):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.wait_timeout_s = wait_timeout_s
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._active = 0
+        # EWMA del tiempo que se mantiene un cupo, para estimar Retry-After
+        self._hold_ewma_s = 1.0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Se crea perezosamente para quedar ligado al event loop del servidor
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrent)
+        return self._sem
+
+    def _retry_after(self) -> float:
+        return max(1.0, self._hold_ewma_s * (self._waiting + 1) / self.max_concurrent)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        sem = self._semaphore()
+        if sem.locked():
+            if self._waiting >= self.max_queue:
+                raise Overloaded(self._retry_after(), reason="queue_full")
+            self._waiting += 1
+            MODEL_QUEUE_DEPTH.set(self._waiting)
+            try:
+                await asyncio.wait_for(sem.acquire(), timeout=self.wait_timeout_s)
+            except asyncio.TimeoutError:
+                raise Overloaded(self._retry_after(), reason="queue_timeout") from None
+            finally:
+                self._waiting -= 1
+                MODEL_QUEUE_DEPTH.set(self._waiting)
+        else:
+            await sem.acquire()
+        self._active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._hold_ewma_s = 0.8 * self._hold_ewma_s + 0.2 * (time.monotonic() - start)
+            sem.release()
+
+    def status(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
+
+
+_settings = get_settings()
+RATE_LIMITER = RateLimiter(
+    rate_per_s=_settings.rate_limit_per_minute / 60.0,
+    burst=_settings.rate_limit_burst,
+)
+MODEL_LIMITER = ConcurrencyLimiter(
+    max_concurrent=_settings.max_concurrent_model_calls,
+    max_queue=_settings.max_model_queue,
+    wait_timeout_s=_settings.model_queue_timeout_s,
+)
+
+
+_CLIENT_API_KEYS = frozenset(k.strip() for k in _settings.client_api_keys.split(",") if k.strip())
+
+
+def client_key(request: Request) -> str:
+    """Identifica al cliente por API key (solo si es una de CLIENT_API_KEYS) o por IP.
+
+    Una X-API-Key arbitraria no cuenta: con un valor nuevo en cada petición se
+    saltaría el límite y llenaría el LRU de buckets desplazando a los clientes reales.
+    """
+    api_key = request.headers.get("x-api-key")
+    if api_key and api_key in _CLIENT_API_KEYS:
+        # Resumen de la clave: el valor en claro no queda en memoria ni en logs
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def rate_limit(request: Request) -> None:
+    """Dependency de FastAPI: aplica el token bucket del cliente."""
+    try:
+        RATE_LIMITER.acquire(client_key(request))
+    except RateLimited as e:
+        ADMISSION_REJECTIONS.inc(reason="rate_limited")
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones. Intenta nuevamente más tarde.",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        ) from e
+
+
+@asynccontextmanager
+async def model_slot() -> AsyncIterator[None]:
+    """Reserva un cupo de llamada al modelo o responde 503 con Retry-After."""
+    try:
+        async with MODEL_LIMITER.slot():
+            yield
+    except Overloaded as e:
+        ADMISSION_REJECTIONS.inc(reason=e.reason)
+        raise HTTPException(
+            status_code=503,
+            detail="Servicio saturado. Intenta nuevamente en unos segundos.",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        ) from e
@@ -0,0 +1,144 @@
+"""
+Circuit breaker para las llamadas al modelo.
+
+Observa las últimas N llamadas (errores y llamadas lentas). Si la proporción de
+fallos supera el umbral, el circuito se abre y las peticiones dejan de llamar al
+modelo durante `open_seconds`; luego pasa a semiabierto y deja pasar unas pocas
+sondas: si responden bien se cierra, si fallan vuelve a abrirse.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from app.config import get_settings
+from app.utils.metrics import REGISTRY
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = REGISTRY.gauge(
+    "agro_circuit_breaker_state",
+    "Estado del circuit breaker del modelo (0 cerrado, 1 semiabierto, 2 abierto).",
+)
+BREAKER_SHORT_CIRCUITS = REGISTRY.counter(
+    "agro_circuit_breaker_short_circuits_total",
+    "Peticiones atendidas sin llamar al modelo por circuito abierto.",
+    ("fallback",),
+)
+
+
+class CircuitOpenError(RuntimeError):
+    """El circuito está abierto: no se debe llamar al modelo."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: int = 20,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_s: float = 15.0,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 2,
+    ):
+        self.min_calls = max(1, min_calls)
+        self.failure_rate = failure_rate
+        self.slow_call_s = slow_call_s
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        # (ok, latencia_s) de las últimas llamadas
+        self._calls: Deque[Tuple[bool, float]] = deque(maxlen=max(window, self.min_calls))
+        self._state = CLOSED
+        self._opened_at: Optional[float] = None
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _set_state(self, state: str) -> None:
+        self._state = state
+        BREAKER_STATE.set(_STATE_VALUES[state])
+
+    def _maybe_half_open(self) -> None:
+        if self._state == OPEN and self._opened_at is not None and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _trip(self) -> None:
+        self._set_state(OPEN)
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+
+    def allow_request(self) -> bool:
+        """True si se puede llamar al modelo; en semiabierto reserva una sonda."""
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            return False
+
+    def record(self, ok: bool, latency_s: float) -> None:
+        """Registra el resultado de una llamada; las llamadas lentas cuentan como fallo."""
+        success = ok and latency_s < self.slow_call_s
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if not success:
+                    self._trip()
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._set_state(CLOSED)
+                    self._opened_at = None
+                    self._calls.clear()
+                return
+            if self._state == OPEN:
+                return
+            self._calls.append((success, latency_s))
+            if len(self._calls) >= self.min_calls:
+                failures = sum(1 for s, _ in self._calls if not s)
+                if failures / len(self._calls) >= self.failure_rate:
+                    self._trip()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            self._maybe_half_open()
+            calls = list(self._calls)
+            failures = sum(1 for s, _ in calls if not s)
+            return {
+                "state": self._state,
+                "recent_calls": len(calls),
+                "failure_rate": round(failures / len(calls), 3) if calls else 0.0,
+                "avg_latency_ms": round(sum(l for _, l in calls) / len(calls) * 1000, 1) if calls else None,
+                "retry_in_s": (
+                    round(max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)), 1)
+                    if self._state == OPEN and self._opened_at is not None
+                    else None
+                ),
+            }
+
+
+_settings = get_settings()
+BREAKER = CircuitBreaker(
+    window=_settings.breaker_window,
+    min_calls=_settings.breaker_min_calls,
+    failure_rate=_settings.breaker_failure_rate,
+    slow_call_s=_settings.breaker_slow_call_s,
+    open_seconds=_settings.breaker_open_s,
+    half_open_probes=_settings.breaker_half_open_probes,
+)
@@ -0,0 +1,85 @@
+"""
+Backend de modelo simulado para pruebas de carga y capacidad.
+
+Imita la forma de las respuestas del SDK de Gemini (candidates → content → parts,
+usage_metadata) con una latencia configurable, de modo que todo el camino de
+GeminiClient (extracción, parseo JSON, reintentos, historial) se ejercita sin
+llamar a la API real. Se activa con MODEL_BACKEND=fake.
+"""
+from __future__ import annotations
+
+import json
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+
+_TEXT_ANSWER = (
+    "Resumen educativo: en general, el manejo depende del cultivo, la etapa fenológica y las condiciones locales.\n\n"
+    "- Factores a considerar: clima, tipo de suelo y disponibilidad de agua.\n"
+    "- Monitoreo sugerido: registrar lecturas de forma periódica y comparar con rangos de referencia.\n"
+    "- Riesgos comunes: cambios bruscos de humedad o temperatura; como referencia, conviene anticiparlos."
+)
+
+_STRUCTURED_ANSWER = {
+    "action": "maintain",
+    "parameter": "other",
+    "target_range": {"min": None, "max": None, "unit": None},
+    "rationale": "Respuesta simulada del backend de pruebas.",
+    "warnings": ["Backend simulado: sin análisis real del modelo."],
+}
+
+
+class FakeGenerativeModel:
+    """Sustituto de genai.GenerativeModel con latencia y tasa de error configurables."""
+
+    def __init__(
+        self,
+        model_name: str = "fake-model",
+        system_instruction: Optional[str] = None,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+    ):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def generate_content(
+        self,
+        contents: Any,
+        *,
+        generation_config: Optional[Dict[str, Any]] = None,
+        safety_settings: Any = None,
+        request_options: Any = None,
+        **_: Any,
+    ) -> SimpleNamespace:
+        delay = self.latency_ms + (random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        timeout = (request_options or {}).get("timeout") if isinstance(request_options, dict) else None
+        if timeout is not None and delay / 1000.0 > timeout:
+            time.sleep(max(0.0, timeout))
+            raise TimeoutError("504 Deadline Exceeded (backend simulado)")
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("503 Service Unavailable (backend simulado)")
+
+        cfg = generation_config or {}
+        if cfg.get("response_mime_type") == "application/json":
+            text = json.dumps(_STRUCTURED_ANSWER, ensure_ascii=False)
+        else:
+            text = _TEXT_ANSWER
+        prompt_chars = len(contents) if isinstance(contents, str) else 0
+        candidate = SimpleNamespace(
+            content=SimpleNamespace(parts=[SimpleNamespace(text=text)]),
+            finish_reason=1,
+        )
+        usage = SimpleNamespace(
+            prompt_token_count=prompt_chars // 4,
+            candidates_token_count=len(text) // 4,
+            total_token_count=(prompt_chars + len(text)) // 4,
+        )
+        return SimpleNamespace(candidates=[candidate], usage_metadata=usage)
@@ -1,19 +1,144 @@
 from __future__ import annotations
 
-import json
+import re
+import threading
+import time
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception, wait_exponential
 
 from app.config import get_settings
 from app.schemas.requests import AskRequest
 from app.schemas.responses import AskResponse, Recommendation, TargetRange
+from app.services.circuit_breaker import BREAKER, BREAKER_SHORT_CIRCUITS, OPEN, CircuitOpenError
+from app.services.response_cache import cache_key, cache_version, get_response_cache
+from app.services.key_pool import ApiKey, KeyPoolExhausted, configured_keys, get_key_pool
+from app.services.model_router import STRUCTURED, get_model_router, route_for
+from app.services.rules_engine import get_rules_engine
+from app.services.sensor_trends import get_sensor_trends
+from app.services.warm_state import WARM_STATE_EVENTS, get_warm_state
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.jsonio import JSONDecodeError, extract_json_object, loads
 from app.utils.logger import get_logger
+from app.utils.metrics import (
+    HEURISTIC_FALLBACKS,
+    MODEL_CALL_SECONDS,
+    MODEL_INFLIGHT,
+    MODEL_RETRIES,
+    PROMPT_COMPOSE_SECONDS,
+    REFRAME_ATTEMPTS,
+    STRUCTURED_PARSE_FAILURES,
+)
 from app.utils.sanitize import sanitize_question, sanitize_data_preview
+from app.utils.tracing import span
 
 logger = get_logger("agro.gemini")
 
+DEFAULT_PROMPT_PATH = Path(__file__).resolve().parent.parent / "prompts" / "agriculture_system_prompt.md"
+
+
+def _count_retry(retry_state) -> None:
+    """Hook before_sleep de tenacity: contabiliza cada reintento por método."""
+    MODEL_RETRIES.inc(call=getattr(retry_state.fn, "__name__", "unknown"))
+
+
+def _traced_sleep(seconds: float) -> None:
+    """Espera de backoff de tenacity, visible como span en la traza."""
+    with span("tenacity.sleep", cat="gemini", seconds=round(seconds, 3)):
+        time.sleep(seconds)
+
+
+# --- Política de reintentos -------------------------------------------------
+_MAX_ATTEMPTS = 3
+# Tiempo mínimo que debe quedar en el presupuesto para que valga la pena otro intento
+_MIN_ATTEMPT_S = 0.5
+# finish_reason de bloqueo (SAFETY, RECITATION, BLOCKLIST, PROHIBITED_CONTENT, SPII)
+_BLOCKED_FINISH_REASONS = {3, 4, 6, 7, 8}
+_RETRY_IN_RE = re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+_backoff = wait_exponential(multiplier=0.5, min=0.5, max=4)
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code
+    match = re.match(r"\s*(\d{3})\b", str(exc))
+    return int(match.group(1)) if match else None
+
+
+def _is_blocked_finish(finish_reason: Any) -> bool:
+    try:
+        return int(finish_reason) in _BLOCKED_FINISH_REASONS
+    except (TypeError, ValueError):
+        return False
+
+
+def _is_client_error(exc: BaseException) -> bool:
+    """Errores 4xx (salvo 408/429) y bloqueos de seguridad: reintentar no cambia el resultado."""
+    name = type(exc).__name__
+    if "Blocked" in name or "StopCandidate" in name:
+        return True
+    code = _status_code(exc)
+    return code is not None and 400 <= code < 500 and code not in (408, 429)
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (CircuitOpenError, DeadlineExceeded)):
+        return False
+    return not _is_client_error(exc)
+
+
+def _retry_after_hint(exc: Optional[BaseException]) -> Optional[float]:
+    """Retry-After de un 429: cabecera HTTP, RetryInfo en los detalles o 'retry in Xs' en el mensaje."""
+    if exc is None:
+        return None
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            value = headers.get("Retry-After") or headers.get("retry-after")
+            if value:
+                return float(value)
+        except (TypeError, ValueError):
+            pass
+    for detail in getattr(exc, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            try:
+                return float(getattr(delay, "seconds", 0)) + float(getattr(delay, "nanos", 0)) / 1e9
+            except (TypeError, ValueError):
+                pass
+    match = _RETRY_IN_RE.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def _retry_wait(retry_state) -> float:
+    """Backoff exponencial, respetando Retry-After si el servidor lo indica."""
+    delay = _backoff(retry_state)
+    hint = _retry_after_hint(retry_state.outcome.exception() if retry_state.outcome else None)
+    return max(delay, hint) if hint is not None else delay
+
+
+def _retry_stop(retry_state) -> bool:
+    """Detener tras _MAX_ATTEMPTS o si el presupuesto restante no cubre la espera más un intento."""
+    if retry_state.attempt_number >= _MAX_ATTEMPTS:
+        return True
+    deadline = retry_state.kwargs.get("deadline")
+    if deadline is None:
+        return False
+    return deadline.remaining() < _retry_wait(retry_state) + _MIN_ATTEMPT_S
+
+
+_RETRY_POLICY = dict(
+    stop=_retry_stop,
+    wait=_retry_wait,
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+    before_sleep=_count_retry,
+    sleep=_traced_sleep,
+)
+
 
 class GeminiClient:
     def __init__(self, prompt_path: Path):
@@ -30,19 +155,47 @@ class GeminiClient:
             logger.warning("No se pudo leer el archivo de prompt en %s; usando prompt por defecto.", prompt_path)
             self.prompt_text = default_prompt
         self._model = None
+        # Modelos adicionales del enrutador (por nombre) y modelos disponibles según list_models
+        self._models: Dict[str, Any] = {}
+        self._models_lock = threading.Lock()
+        self._available: set[str] = set()
         self._configured = False
+        self._configure_lock = threading.Lock()
 
     def _configure(self):
         if self._configured:
             return
-        if not self.settings.mock_mode and not self.settings.gemini_api_key:
+        # Una sola configuración (import de genai + list_models) aunque lleguen peticiones en paralelo
+        with self._configure_lock:
+            if self._configured:
+                return
+            with span("gemini.configure", cat="gemini"):
+                self._configure_model()
+
+    def _configure_model(self):
+        if self.settings.model_backend == "fake":
+            from app.services.fake_model import FakeGenerativeModel
+
+            self._model = FakeGenerativeModel(
+                model_name=self.settings.gemini_model,
+                system_instruction=self.prompt_text,
+                latency_ms=self.settings.fake_model_latency_ms,
+                jitter_ms=self.settings.fake_model_latency_ms * 0.25,
+                error_rate=self.settings.fake_model_error_rate,
+            )
+            self._configured = True
+            logger.info("Using fake model backend (%.0f ms)", self.settings.fake_model_latency_ms)
+            return
+        keys = configured_keys()
+        if not self.settings.mock_mode and not keys:
             logger.warning("No GEMINI_API_KEY provided. Falling back to mock mode.")
             self.settings.mock_mode = True
             return
         try:
             import google.generativeai as genai
 
-            genai.configure(api_key=self.settings.gemini_api_key)
+            # Cliente global con la primera clave (list_models y pool de una sola clave)
+            genai.configure(api_key=keys[0])
             # Determine best available model for generateContent
             requested = (self.settings.gemini_model or "").strip()
             normalized = requested.replace("-latest", "") if requested.endswith("-latest") else requested
@@ -56,20 +209,35 @@ class GeminiClient:
                 "gemini-1.5-flash",
             ]
 
-            try:
-                models = list(genai.list_models())
-                avail = {
-                    getattr(m, "name", "").split("/")[-1]
-                    for m in models
-                    if "supported_generation_methods" in dir(m)
-                    and "generateContent" in getattr(m, "supported_generation_methods", [])
-                }
-            except Exception:
-                avail = set()
+            # Un snapshot vigente de otra instancia evita la consulta de modelos (ida y vuelta a la API)
+            warm = get_warm_state()
+            warm_models = warm.enabled and warm.state.models_fresh(
+                requested, self.settings.warm_state_models_ttl_s
+            )
+            if warm_models:
+                avail = set(warm.state.available_models)
+                WARM_STATE_EVENTS.inc(event="models_reused")
+            else:
+                try:
+                    with span("gemini.list_models", cat="gemini"):
+                        models = list(genai.list_models())
+                    avail = {
+                        getattr(m, "name", "").split("/")[-1]
+                        for m in models
+                        if "supported_generation_methods" in dir(m)
+                        and "generateContent" in getattr(m, "supported_generation_methods", [])
+                    }
+                except Exception:
+                    avail = set()
+                if avail:
+                    warm.record_models(requested, sorted(avail))
 
             candidates = [m for m in preferences if m] or ["gemini-2.5-flash"]
             if avail:
                 candidates = [m for m in candidates if m in avail] or list(avail)
+                # Si la instancia anterior terminó usando otro modelo (p. ej. tras un 404), empezar por ese
+                if warm_models and warm.state.model in avail and warm.state.model != candidates[0]:
+                    candidates.insert(0, warm.state.model)
 
             last_err = None
             for m in candidates:
@@ -85,15 +253,66 @@ class GeminiClient:
                     continue
             if self._model is None:
                 raise last_err or RuntimeError("No se pudo configurar el modelo de Gemini.")
+            self._available = avail
             self._genai = genai
             self._configured = True
             logger.info("Gemini client configured with model %s", self.settings.gemini_model)
+            if warm.enabled and (not warm_models or warm.state.model != self.settings.gemini_model):
+                warm.record_model(self.settings.gemini_model)
+                warm.save(force=True)
         except Exception as e:
             logger.exception("Failed to configure Gemini: %s", e)
             self.settings.mock_mode = True
 
-    def _compose_chat_prompt(self, req: AskRequest) -> str:
-        """Prompt flexible y conversacional para consultas de texto libre (endpoint /chat)."""
+    def _model_for(self, name: str, key: Optional[ApiKey] = None) -> Any:
+        """Instancia del modelo `name` (la principal o una creada a demanda para el enrutador).
+
+        Con `key` (pool de varias claves) cada clave tiene su propia instancia y cliente.
+        """
+        if key is None and (name == self.settings.gemini_model or self._model is None):
+            return self._model
+        cache_key = (name, key.label if key is not None else None)
+        model = self._models.get(cache_key)
+        if model is None:
+            with self._models_lock:
+                model = self._models.get(cache_key)
+                if model is None:
+                    if self.settings.model_backend == "fake":
+                        from app.services.fake_model import FakeGenerativeModel
+
+                        model = FakeGenerativeModel(
+                            model_name=name,
+                            system_instruction=self.prompt_text,
+                            latency_ms=self.settings.fake_model_latency_ms,
+                            jitter_ms=self.settings.fake_model_latency_ms * 0.25,
+                            error_rate=self.settings.fake_model_error_rate,
+                        )
+                    else:
+                        model = self._genai.GenerativeModel(model_name=name, system_instruction=self.prompt_text)
+                        if key is not None:
+                            # Cliente propio con la clave: genai.configure() es global al proceso
+                            model._client = self._client_for_key(key)
+                    self._models[cache_key] = model
+        return model
+
+    @staticmethod
+    def _client_for_key(key: ApiKey) -> Any:
+        from google.ai import generativelanguage as glm
+        from google.api_core.client_options import ClientOptions
+
+        return glm.GenerativeServiceClient(client_options=ClientOptions(api_key=key.secret))
+
+    def _pick_model(self, route: str) -> str:
+        """Modelo para la clase de petición `route` (el configurado si el enrutador está apagado)."""
+        if not self.settings.model_routing:
+            return self.settings.gemini_model
+        return get_model_router().choose(route, self._available, default=self.settings.gemini_model)
+
+    def _compose_chat_prompt(self, req: AskRequest, context: Optional[str] = None) -> str:
+        """Prompt flexible y conversacional para consultas de texto libre (endpoint /chat).
+
+        `context` es la conversación previa de la sesión (ya acotada por SessionStore).
+        """
         parts: List[str] = []
         # Educational, non-prescriptive framing to reduce safety blocks
         parts.append(
@@ -105,6 +324,11 @@ class GeminiClient:
             parts.append(f"Cultivo: {req.crop}")
         if getattr(req, "stage", None):
             parts.append(f"Etapa: {req.stage}")
+        if context:
+            parts.append(
+                "Conversación previa (solo como contexto; responde la pregunta actual):\n"
+                + sanitize_question(context, max_len=len(context) + 3)
+            )
         safe_q = sanitize_question(req.question, max_len=min(800, self.settings.max_input_chars))
         parts.append(f"Pregunta: {safe_q}")
         
@@ -177,8 +401,11 @@ class GeminiClient:
             )
         return "\n\n".join(parts)
 
-    def _compose_adjustment_prompt(self, req: AskRequest) -> str:
-        """Prompt específico para obtener una recomendación direccional estructurada en JSON."""
+    def _compose_adjustment_prompt(self, req: AskRequest, trend: Optional[Dict[str, Any]] = None) -> str:
+        """Prompt específico para obtener una recomendación direccional estructurada en JSON.
+
+        `trend` son las estadísticas recientes del (cultivo, parámetro) (SensorTrends.peek), si las hay.
+        """
         pv = {
             "cultivo": req.crop,
             "parametro": req.parameter,
@@ -187,11 +414,28 @@ class GeminiClient:
             "etapa": getattr(req, "stage", None),
             "temperatura": req.temperature,
         }
+        if trend:
+            def r(x, nd=2):
+                return round(x, nd) if x is not None else None
+
+            pv["lecturas_previas"] = {
+                "n": trend["count"],
+                "media_movil": r(trend["ewma"]),
+                "min": r(trend["min"]),
+                "max": r(trend["max"]),
+                "pendiente_por_hora": r(trend["slope_per_hour"], 3),
+                "tendencia": trend["trend"],
+            }
         preview = sanitize_data_preview({k: v for k, v in pv.items() if v is not None}, max_chars=800)
         instructions = (
             "Tarea: Con base en el parámetro medido y el cultivo, devuelve SOLO un JSON válido en español que indique si se debe 'aumentar', 'disminuir' o 'mantener' el parámetro, con rango objetivo orientativo, justificación breve y advertencias. "
             "Sigue exactamente el esquema indicado en la instrucción del sistema. No incluyas texto fuera del JSON." 
         )
+        if trend:
+            instructions += (
+                " 'lecturas_previas' resume las mediciones recientes del mismo cultivo y parámetro: "
+                "considera si el valor viene subiendo o bajando al justificar la acción."
+            )
         return (
             f"Datos: {preview}\n\n" + instructions
         )
@@ -239,101 +483,148 @@ class GeminiClient:
         ]
 
     def _heuristic_recommendation(self, req: AskRequest) -> Recommendation | None:
-        """Fallback simple y seguro basado en rangos orientativos genéricos.
+        """Fallback seguro basado en el motor de reglas (rangos por cultivo y etapa).
         No sustituye al modelo, pero mejora la UX cuando no hay JSON.
         """
         if not req.parameter or req.value is None:
             return None
-        p = (req.parameter or "").lower()
-        unit = req.unit
-        v = req.value
-
-        # Rangos orientativos genéricos (no prescriptivos)
-        ranges: Dict[str, Dict[str, float | None]] = {
-            "soil_moisture": {"min": 20.0, "max": 30.0},  # % humedad de suelo
-            "air_temperature": {"min": 18.0, "max": 30.0},  # °C temperatura aire
-            "soil_temperature": {"min": 15.0, "max": 25.0},  # °C temperatura suelo
-            "air_humidity": {"min": 50.0, "max": 80.0},  # % humedad aire (HR)
-            "soil_ph": {"min": 6.0, "max": 7.5},  # pH suelo
-            "ec": {"min": 0.8, "max": 2.5},  # dS/m conductividad eléctrica
-            "ndvi": {"min": 0.5, "max": 0.9},  # índice NDVI
-            "vpd": {"min": 0.8, "max": 1.5},  # kPa déficit de presión de vapor
-            # parámetros nuevos sin rango explícito → se dejan null para no inventar
-                "rain": {"min": None, "max": None},  # lluvia puntual (mm)
-                "light": {"min": None, "max": None},  # luz/luminosidad (depende del cultivo y sensor)
-                "nutrients": {"min": None, "max": None},  # nivel agregado de nutrientes (muy dependiente de análisis)
-        }
+        match = get_rules_engine().evaluate(req.parameter, req.value, unit=req.unit, crop=req.crop, stage=req.stage)
+        return match.to_recommendation() if match else None
 
-        r = ranges.get(p)
-        if not r:
-            return None
-        tmin = r.get("min")
-        tmax = r.get("max")
-        action = "mantener"
-        if tmin is not None and v < tmin:
-            action = "aumentar"
-        elif tmax is not None and v > tmax:
-            action = "disminuir"
-
-        rationale = []
-        if tmin is not None and tmax is not None:
-            rationale.append(f"El valor observado ({v}{' ' + unit if unit else ''}) se compara con un rango orientativo de {tmin}–{tmax}{' ' + unit if unit else ''}.")
-        elif tmin is not None:
-            rationale.append(f"El valor observado ({v}{' ' + unit if unit else ''}) se compara con un mínimo orientativo de {tmin}{' ' + unit if unit else ''}.")
-        elif tmax is not None:
-            rationale.append(f"El valor observado ({v}{' ' + unit if unit else ''}) se compara con un máximo orientativo de {tmax}{' ' + unit if unit else ''}.")
-        else:
-            rationale.append("No hay rango genérico confiable; se sugiere monitoreo adicional y contextualizar según cultivo y etapa.")
+    def _generate(
+        self,
+        prompt: str,
+        *,
+        generation_config: Dict[str, Any],
+        kind: str,
+        deadline: Optional[Deadline] = None,
+        model_name: Optional[str] = None,
+    ) -> Any:
+        """Única vía hacia generate_content: aplica el circuit breaker, el presupuesto de tiempo y mide latencia.
 
-        warns = [
-            "Rangos genéricos de referencia; ajustar según cultivo, etapa fenológica, tipo de suelo y sistema de manejo.",
-        ]
-        if p in ("light",):
-            warns.append("La iluminación óptima depende de cultivo, intensidad fotosintética (PPFD) y duración; calibrar con curvas específicas.")
-        if p in ("nutrients",):
-            warns.append("El valor de 'nutrients' requiere desagregar tipo de nutriente y comparar con análisis de suelo y foliar.")
-        if p in ("rain",):
-            warns.append("La lluvia puntual debe interpretarse junto a humedad del suelo y pronóstico; no indica acción directa por sí sola.")
-        if p in ("ndvi",):
-            warns.append("NDVI es un índice; la acción depende del diagnóstico agronómico complementario.")
-
-        # Mapear parámetro interno inglés→español si es necesario
-        param_map = {
-            "soil_moisture": "humedad_suelo",
-            "air_temperature": "temperatura_aire",
-            "soil_temperature": "temperatura_suelo",
-            "air_humidity": "humedad_aire",
-            "soil_ph": "ph_suelo",
-            "ec": "ce",
-            "ndvi": "ndvi",
-            "rain": "lluvia",
-                "light": "luz",
-                "nutrients": "nutrientes",
-            "vpd": "vpd",
-            "other": "otro",
-        }
-        p_es = param_map.get(p, p)
-        return Recommendation(
-            action=action,
-            parameter=p_es,
-            target_range=TargetRange(min=tmin, max=tmax, unit=unit),
-            rationale=" ".join(rationale),
-            warnings=warns,
-        )
+        `model_name` es el modelo elegido por el enrutador (por defecto, el configurado).
+        """
+        extra: Dict[str, Any] = {}
+        if deadline is not None:
+            # Sin tiempo para un intento útil: no llamar al modelo
+            deadline.check(_MIN_ATTEMPT_S)
+            # Cada intento solo dispone del tiempo que queda del presupuesto
+            extra["request_options"] = {"timeout": deadline.remaining()}
+        # La clave se toma antes de pedir cupo al breaker: si todas están en pausa no se ocupa una sonda
+        pool = get_key_pool()
+        key = pool.acquire() if pool is not None else None
+        if not BREAKER.allow_request():
+            if key is not None:
+                pool.cancel(key)
+            raise CircuitOpenError("Circuito abierto: el modelo no está disponible temporalmente.")
+        model_name = model_name or self.settings.gemini_model
+        model = self._model_for(model_name, key if pool is not None and len(pool) > 1 else None)
+        response = None
+        error: Optional[BaseException] = None
+        outcome = "error"
+        healthy = False
+        # Para el enrutador un 404 sí cuenta como fallo del modelo (no está disponible)
+        routed_ok = False
+        start = time.perf_counter()
+        with MODEL_INFLIGHT.track_inprogress(), span("gemini.generate_content", cat="gemini", model=model_name, kind=kind):
+            try:
+                response = model.generate_content(
+                    prompt,
+                    generation_config=generation_config,
+                    safety_settings=self._safety_settings(),
+                    **extra,
+                )
+                outcome = "ok"
+                healthy = routed_ok = True
+                return response
+            except Exception as e:
+                # Un 4xx o un bloqueo de seguridad no indica que el servicio esté degradado
+                error = e
+                healthy = _is_client_error(e)
+                routed_ok = healthy and _status_code(e) != 404
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                BREAKER.record(healthy, elapsed)
+                if key is not None:
+                    pool.release(
+                        key,
+                        outcome=outcome,
+                        usage=getattr(response, "usage_metadata", None),
+                        status=_status_code(error) if error is not None else None,
+                        retry_after_s=_retry_after_hint(error),
+                    )
+                if self.settings.model_routing:
+                    get_model_router().record(model_name, elapsed, routed_ok)
+                MODEL_CALL_SECONDS.observe(elapsed, model=model_name, kind=kind, outcome=outcome)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.5, min=0.5, max=4), reraise=True)
-    def _call_gemini(self, user_prompt: str, *, allow_reframe: bool = True, length: Optional[str] = None, conversational: bool = False) -> AskResponse:
+    @staticmethod
+    def _extract_text(response: Any) -> tuple[str, Any]:
+        """Extrae el texto de la primera candidata sin usar la propiedad response.text.
+
+        Devuelve (texto, finish_reason); el texto queda vacío si no hay partes legibles.
+        """
+        answer = ""
+        finish_reason = None
+        try:
+            candidates = getattr(response, "candidates", None) or []
+            if candidates:
+                first = candidates[0]
+                content = getattr(first, "content", None)
+                parts = getattr(content, "parts", []) if content else []
+                texts = []
+                for p in parts:
+                    t = getattr(p, "text", None)
+                    if isinstance(t, str) and t:
+                        texts.append(t)
+                    elif isinstance(p, str) and p:
+                        texts.append(p)
+                answer = "\n".join(texts)
+                finish_reason = getattr(first, "finish_reason", None)
+        except Exception:
+            pass
+        return answer, finish_reason
+
+    @retry(**_RETRY_POLICY)
+    def _call_gemini(
+        self,
+        user_prompt: str,
+        *,
+        allow_reframe: bool = True,
+        length: Optional[str] = None,
+        conversational: bool = False,
+        deadline: Optional[Deadline] = None,
+    ) -> AskResponse:
         config = self._build_generation_config(length=length, conversational=conversational)
+        # Se elige en cada intento: un reintento puede ir a otro modelo si el elegido se degradó
+        model_name = self._pick_model(route_for(length=length))
         try:
-            response = self._model.generate_content(
+            response = self._generate(
                 user_prompt,
                 generation_config=config,
-                safety_settings=self._safety_settings(),
+                kind="text",
+                deadline=deadline,
+                model_name=model_name,
             )
+        except (CircuitOpenError, DeadlineExceeded, KeyPoolExhausted):
+            raise
         except Exception as e:
             msg = str(e).lower()
+            is_unavailable = "404" in msg or "not found" in msg or "unsupported" in msg
+            if is_unavailable and model_name != self.settings.gemini_model:
+                # Modelo del enrutador no disponible: sacarlo de la rotación y usar el configurado
+                logger.info("Routed model %s unavailable; using %s", model_name, self.settings.gemini_model)
+                get_model_router().disable(model_name)
+                model_name = self.settings.gemini_model
+                response = self._generate(
+                    user_prompt,
+                    generation_config=config,
+                    kind="text",
+                    deadline=deadline,
+                    model_name=model_name,
+                )
             # Fallback to a widely available model if the requested one isn't supported
-            if "404" in msg or "not found" in msg or "unsupported" in msg:
+            elif is_unavailable:
                 try:
                     import google.generativeai as genai
 
@@ -343,11 +634,17 @@ class GeminiClient:
                         model_name=fallback,
                         system_instruction=self.prompt_text,
                     )
-                    self.settings.gemini_model = fallback
-                    response = self._model.generate_content(
+                    self.settings.gemini_model = model_name = fallback
+                    warm = get_warm_state()
+                    if warm.enabled:
+                        warm.record_model(fallback)
+                        warm.save(force=True)
+                    response = self._generate(
                         user_prompt,
                         generation_config=config,
-                        safety_settings=self._safety_settings(),
+                        kind="text",
+                        deadline=deadline,
+                        model_name=model_name,
                     )
                 except Exception as e2:
                     logger.exception("Gemini fallback call failed: %s", e2)
@@ -357,30 +654,12 @@ class GeminiClient:
                 raise
 
         # Extract answer text robustly without accessing response.text property
-        answer = ""
-        finish_reason = None
-        try:
-            candidates = getattr(response, "candidates", None) or []
-            if candidates:
-                first = candidates[0]
-                content = getattr(first, "content", None)
-                parts = getattr(content, "parts", []) if content else []
-                texts = []
-                for p in parts:
-                    t = getattr(p, "text", None)
-                    if isinstance(t, str) and t:
-                        texts.append(t)
-                    elif isinstance(p, str) and p:
-                        texts.append(p)
-                answer = "\n".join(texts)
-                finish_reason = getattr(first, "finish_reason", None)
-                if not answer and finish_reason not in (None, 0):
-                    answer = (
-                        "La respuesta fue bloqueada por las políticas de seguridad del modelo. "
-                        "Intenta reformular la pregunta con términos neutros y sin información sensible."
-                    )
-        except Exception:
-            pass
+        answer, finish_reason = self._extract_text(response)
+        if not answer and finish_reason not in (None, 0):
+            answer = (
+                "La respuesta fue bloqueada por las políticas de seguridad del modelo. "
+                "Intenta reformular la pregunta con términos neutros y sin información sensible."
+            )
         usage_md = getattr(response, "usage_metadata", None)
         usage = None
         if usage_md:
@@ -391,131 +670,109 @@ class GeminiClient:
                 if not k.startswith("_") and not callable(getattr(usage_md, k))
             }
         # If blocked or empty, try a single educational reframe to reduce safety triggers
-        if allow_reframe and (not answer or "fue bloqueada" in answer.lower() or finish_reason not in (None, 0)):
-            try:
-                re_user_prompt = (
-                    user_prompt
-                    + "\n\nReformulación: Proporciona únicamente un resumen educativo general de alto nivel. "
-                      "Evita pasos operativos, cantidades, dosis, calendarios o imperativos. "
-                      "No incluyas productos, marcas ni instrucciones de ‘cómo hacer’. "
-                      "En su lugar, resume factores a considerar, buenas prácticas generales y señales de monitoreo, usando lenguaje condicional. "
-                      "No apliques límites de longitud estrictos; prioriza neutralidad y claridad (≈150–300 palabras en bullets)."
-                )
-                response2 = self._model.generate_content(
-                    re_user_prompt,
-                    generation_config={**config, "temperature": 0.1, "top_p": 0.7},
-                    safety_settings=self._safety_settings(),
-                )
-                # Extract again
-                answer2 = ""
+        reframes = 0
+        if allow_reframe and (not answer or "fue bloqueada" in answer.lower() or _is_blocked_finish(finish_reason)):
+            with span("gemini.reframe_cascade", cat="gemini") as cascade:
                 try:
-                    candidates2 = getattr(response2, "candidates", None) or []
-                    if candidates2:
-                        first2 = candidates2[0]
-                        content2 = getattr(first2, "content", None)
-                        parts2 = getattr(content2, "parts", []) if content2 else []
-                        texts2 = []
-                        for p in parts2:
-                            t2 = getattr(p, "text", None)
-                            if isinstance(t2, str) and t2:
-                                texts2.append(t2)
-                            elif isinstance(p, str) and p:
-                                texts2.append(p)
-                        answer2 = "\n".join(texts2)
+                    reframes += 1
+                    re_user_prompt = (
+                        user_prompt
+                        + "\n\nReformulación: Proporciona únicamente un resumen educativo general de alto nivel. "
+                          "Evita pasos operativos, cantidades, dosis, calendarios o imperativos. "
+                          "No incluyas productos, marcas ni instrucciones de ‘cómo hacer’. "
+                          "En su lugar, resume factores a considerar, buenas prácticas generales y señales de monitoreo, usando lenguaje condicional. "
+                          "No apliques límites de longitud estrictos; prioriza neutralidad y claridad (≈150–300 palabras en bullets)."
+                    )
+                    response2 = self._generate(
+                        re_user_prompt,
+                        generation_config={**config, "temperature": 0.1, "top_p": 0.7},
+                        kind="reframe",
+                        deadline=deadline,
+                        model_name=model_name,
+                    )
+                    # Extract again
+                    answer2, _ = self._extract_text(response2)
+                    if answer2:
+                        answer = answer2
                 except Exception:
                     pass
-                if answer2:
-                    answer = answer2
-            except Exception:
-                pass
 
-            # Second, more generic reframe if still empty/blocked
-            if not answer:
-                try:
-                    re_user_prompt2 = (
-                        "Finalidad educativa: Ofrece un panorama general sobre manejo del agua en cultivos en términos amplios y neutros. "
-                        "Evita pasos operativos, cantidades, dosis, calendarios, marcas o productos. "
-                        "Usa bullets y lenguaje condicional para describir factores a considerar (clima, suelo, fenología, monitoreo), sin recomendaciones prescriptivas."
-                    )
-                    response3 = self._model.generate_content(
-                        re_user_prompt2,
-                        generation_config={**config, "temperature": 0.1, "top_p": 0.6},
-                        safety_settings=self._safety_settings(),
-                    )
-                    answer3 = ""
+                # Second, more generic reframe if still empty/blocked
+                if not answer:
                     try:
-                        candidates3 = getattr(response3, "candidates", None) or []
-                        if candidates3:
-                            first3 = candidates3[0]
-                            content3 = getattr(first3, "content", None)
-                            parts3 = getattr(content3, "parts", []) if content3 else []
-                            texts3 = []
-                            for p in parts3:
-                                t3 = getattr(p, "text", None)
-                                if isinstance(t3, str) and t3:
-                                    texts3.append(t3)
-                                elif isinstance(p, str) and p:
-                                    texts3.append(p)
-                            answer3 = "\n".join(texts3)
+                        reframes += 1
+                        re_user_prompt2 = (
+                            "Finalidad educativa: Ofrece un panorama general sobre manejo del agua en cultivos en términos amplios y neutros. "
+                            "Evita pasos operativos, cantidades, dosis, calendarios, marcas o productos. "
+                            "Usa bullets y lenguaje condicional para describir factores a considerar (clima, suelo, fenología, monitoreo), sin recomendaciones prescriptivas."
+                        )
+                        response3 = self._generate(
+                            re_user_prompt2,
+                            generation_config={**config, "temperature": 0.1, "top_p": 0.6},
+                            kind="reframe",
+                            deadline=deadline,
+                            model_name=model_name,
+                        )
+                        answer3, _ = self._extract_text(response3)
+                        if answer3:
+                            answer = answer3
                     except Exception:
                         pass
-                    if answer3:
-                        answer = answer3
-                except Exception:
-                    pass
 
-            # Third fallback: if requested short still fails, try concise-medium guidance
-            if not answer and (length == "short"):
-                try:
-                    re_user_prompt3 = (
-                        user_prompt
-                        + "\n\nAjuste de formato: Responde de forma concisa (≈ 200–300 palabras) en bullets educativos. "
-                          "Evita pasos, cantidades numéricas, calendarios, marcas o productos. Usa lenguaje condicional."
-                    )
-                    response4 = self._model.generate_content(
-                        re_user_prompt3,
-                        generation_config=self._build_generation_config(length="medium"),
-                        safety_settings=self._safety_settings(),
-                    )
-                    answer4 = ""
+                # Third fallback: if requested short still fails, try concise-medium guidance
+                if not answer and (length == "short"):
                     try:
-                        candidates4 = getattr(response4, "candidates", None) or []
-                        if candidates4:
-                            first4 = candidates4[0]
-                            content4 = getattr(first4, "content", None)
-                            parts4 = getattr(content4, "parts", []) if content4 else []
-                            texts4 = []
-                            for p in parts4:
-                                t4 = getattr(p, "text", None)
-                                if isinstance(t4, str) and t4:
-                                    texts4.append(t4)
-                                elif isinstance(p, str) and p:
-                                    texts4.append(p)
-                            answer4 = "\n".join(texts4)
+                        reframes += 1
+                        re_user_prompt3 = (
+                            user_prompt
+                            + "\n\nAjuste de formato: Responde de forma concisa (≈ 200–300 palabras) en bullets educativos. "
+                              "Evita pasos, cantidades numéricas, calendarios, marcas o productos. Usa lenguaje condicional."
+                        )
+                        response4 = self._generate(
+                            re_user_prompt3,
+                            generation_config=self._build_generation_config(length="medium"),
+                            kind="reframe",
+                            deadline=deadline,
+                            model_name=model_name,
+                        )
+                        answer4, _ = self._extract_text(response4)
+                        if answer4:
+                            answer = answer4
                     except Exception:
                         pass
-                    if answer4:
-                        answer = answer4
-                except Exception:
-                    pass
+                cascade["attempts"] = reframes
 
-        return AskResponse(answer=answer.strip(), model=self.settings.gemini_model, usage=usage, tips=None)
+        REFRAME_ATTEMPTS.observe(reframes)
+        return AskResponse(answer=answer.strip(), model=model_name, usage=usage, tips=None)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.5, min=0.5, max=4), reraise=True)
-    def _call_gemini_structured(self, user_prompt: str) -> Recommendation | None:
-        """Solicita salida JSON y la transforma en Recommendation."""
+    @retry(**_RETRY_POLICY)
+    def _call_gemini_structured(
+        self, user_prompt: str, *, deadline: Optional[Deadline] = None
+    ) -> tuple[Recommendation | None, str]:
+        """Solicita salida JSON y la transforma en Recommendation; devuelve también el modelo usado."""
         config = self._build_generation_config(length="short", json_output=True)
+        model_name = self._pick_model(STRUCTURED)
         try:
-            response = self._model.generate_content(
+            response = self._generate(
                 user_prompt,
                 generation_config=config,
-                safety_settings=self._safety_settings(),
+                kind="structured",
+                deadline=deadline,
+                model_name=model_name,
             )
+        except (CircuitOpenError, DeadlineExceeded, KeyPoolExhausted):
+            raise
         except Exception as e:
+            if _status_code(e) == 404 and model_name != self.settings.gemini_model:
+                get_model_router().disable(model_name)
             logger.exception("Gemini structured call failed: %s", e)
             raise
 
-        # Intentar extraer JSON desde parts
+        return self._parse_structured(self._extract_structured_raw(response)), model_name
+
+    @staticmethod
+    def _extract_structured_raw(response: Any) -> Optional[str]:
+        """Primer fragmento de texto no vacío de la respuesta (o .text como respaldo)."""
         raw = None
         try:
             candidates = getattr(response, "candidates", None) or []
@@ -539,22 +796,23 @@ class GeminiClient:
                 raw = getattr(response, "text", None)
             except Exception:
                 raw = None
+        return raw or None
+
+    @staticmethod
+    def _parse_structured(raw: Optional[str]) -> Recommendation | None:
+        """Convierte el JSON devuelto por el modelo en Recommendation (None si no es válido)."""
         if not raw:
+            STRUCTURED_PARSE_FAILURES.inc(reason="empty")
             return None
 
         try:
-            data = json.loads(raw)
-        except Exception:
-            # Intento de limpieza mínima si viene con formateo alrededor
-            try:
-                raw2 = raw.strip()
-                if raw2.startswith("```"):
-                    raw2 = raw2.strip("`\n ")
-                    if raw2.startswith("json"):
-                        raw2 = raw2[4:].lstrip()
-                data = json.loads(raw2)
-            except Exception:
+            data = loads(raw)
+        except (JSONDecodeError, ValueError):
+            # Cercas ```json, prosa alrededor, etc.: tomar el primer objeto JSON válido
+            data = extract_json_object(raw)
+            if data is None:
                 logger.debug("Structured response is not valid JSON: %s", raw[:200])
+                STRUCTURED_PARSE_FAILURES.inc(reason="invalid_json")
                 return None
 
         try:
@@ -568,21 +826,7 @@ class GeminiClient:
             action_es = action_map.get(action_raw, action_raw)
 
             param_raw = (data.get("parameter") or "").lower()
-            param_map = {
-                "soil_moisture": "humedad_suelo",
-                "air_temperature": "temperatura_aire",
-                "soil_temperature": "temperatura_suelo",
-                "air_humidity": "humedad_aire",
-                "soil_ph": "ph_suelo",
-                "ec": "ce",
-                "ndvi": "ndvi",
-                "rain": "lluvia",
-                "light": "luz",
-                "nutrients": "nutrientes",
-                "vpd": "vpd",
-                "other": "otro",
-            }
-            param_es = param_map.get(param_raw, param_raw)
+            param_es = get_rules_engine().label(param_raw)
 
             rec = Recommendation(
                 action=action_es,
@@ -594,9 +838,16 @@ class GeminiClient:
             return rec
         except Exception as e:
             logger.debug("Failed to map structured JSON to Recommendation: %s", e)
+            STRUCTURED_PARSE_FAILURES.inc(reason="invalid_schema")
             return None
 
-    def ask(self, req: AskRequest) -> AskResponse:
+    def ask(self, req: AskRequest, deadline: Optional[Deadline] = None, context: Optional[str] = None) -> AskResponse:
+        """Responde la consulta dentro del presupuesto `deadline` (por defecto Settings.timeout_s).
+
+        `context` (conversación previa de una sesión) solo se usa en el chat sin sensores.
+        """
+        if deadline is None:
+            deadline = Deadline(self.settings.timeout_s)
         if req.question and len(req.question) > self.settings.max_input_chars:
             raise ValueError("La pregunta es demasiado larga. Reduce el tamaño del texto.")
 
@@ -611,7 +862,7 @@ class GeminiClient:
             ]
             answer = (
                 "[MODO DEMO] Resumen preliminar. Agrega tu GEMINI_API_KEY en .env para respuestas reales.\n\n"
-                f"Resumen: {req.question[:180]}..."
+                f"Resumen: {(req.question or '')[:180]}..."
             )
             recommendation = None
             if req.parameter and req.value is not None:
@@ -624,6 +875,13 @@ class GeminiClient:
                 )
             return AskResponse(answer=answer, model=self.settings.gemini_model, usage=None, tips=tips, recommendation=recommendation)
 
+        # Modo reglas primero: una regla confiable del cultivo responde sin configurar ni llamar al modelo
+        if self.settings.rules_first and req.parameter and req.value is not None:
+            engine = get_rules_engine()
+            match = engine.evaluate(req.parameter, req.value, unit=req.unit, crop=req.crop, stage=req.stage)
+            if match is not None and match.confident:
+                return self._recommendation_response(match.to_recommendation(), model=f"rules:{engine.version}")
+
         # Ensure client is configured; on failure, configuration can toggle mock_mode
         self._configure()
         if self.settings.mock_mode:
@@ -636,48 +894,34 @@ class GeminiClient:
             answer = (
                 "[MODO DEMO] Recomendación preliminar para agricultura basada en la información disponible. "
                 "Agrega tu GEMINI_API_KEY en .env para respuestas reales.\n\n"
-                f"Resumen: {req.question[:180]}...\n\n"
+                f"Resumen: {(req.question or '')[:180]}...\n\n"
                 "Siguiente paso: proporciona datos de suelo y clima para ajustar dosis y calendario."
             )
             return AskResponse(answer=answer, model=self.settings.gemini_model, usage=None, tips=tips)
 
         # Si se proporcionan parámetros medibles, intentar flujo estructurado primero
         if req.parameter and (req.value is not None):
-            prompt = self._compose_adjustment_prompt(req)
+            # Tendencia de las lecturas anteriores (solo si ya está en memoria; no consulta la base)
+            trend = get_sensor_trends().peek(req.crop, req.parameter) if self.settings.enable_history else None
+            with PROMPT_COMPOSE_SECONDS.time(kind="adjustment"):
+                prompt = self._compose_adjustment_prompt(req, trend)
             rec = None
-            # Intento principal modelo
-            try:
-                rec = self._call_gemini_structured(prompt)
-            except Exception:
-                rec = None
+            model_name = self.settings.gemini_model
+            # Intento principal modelo (omitido si el circuito está abierto)
+            if BREAKER.state == OPEN:
+                BREAKER_SHORT_CIRCUITS.inc(fallback="heuristic")
+            else:
+                try:
+                    rec, model_name = self._call_gemini_structured(prompt, deadline=deadline)
+                except Exception:
+                    rec = None
             # Si falla el modelo o JSON inválido, usar heurística
             if rec is None:
+                HEURISTIC_FALLBACKS.inc()
                 rec = self._heuristic_recommendation(req)
-            # Generar además un resumen en texto breve (por si el cliente lo usa)
-            text_summary = None
+                model_name = self.settings.gemini_model
             if rec:
-                action_es = rec.action  # Ya normalizada a español
-                tr = rec.target_range
-                rango = None
-                if tr and (tr.min is not None or tr.max is not None):
-                    if tr.min is not None and tr.max is not None:
-                        rango = f"{tr.min}–{tr.max} {tr.unit or ''}".strip()
-                    elif tr.min is not None:
-                        rango = f">= {tr.min} {tr.unit or ''}".strip()
-                    elif tr.max is not None:
-                        rango = f"<= {tr.max} {tr.unit or ''}".strip()
-                text_summary = (
-                    f"Sugerencia: {action_es or '—'} {rec.parameter or ''}. "
-                    + (f"Rango objetivo: {rango}. " if rango else "")
-                    + (rec.rationale or "")
-                ).strip()
-                return AskResponse(
-                    answer=text_summary or (rec.rationale or ""),
-                    model=self.settings.gemini_model,
-                    usage=None,
-                    tips=None,
-                    recommendation=rec,
-                )
+                return self._recommendation_response(rec, model=model_name)
             # Si no se logró JSON válido, continuar con el flujo textual educativo
 
         # Usar prompt conversacional si NO hay sensores (chat puro), sino usar prompt estructurado
@@ -685,15 +929,127 @@ class GeminiClient:
         is_conversational = not has_sensor_data
         
         if has_sensor_data:
-            user_prompt = self._compose_user_prompt(req)
+            with PROMPT_COMPOSE_SECONDS.time(kind="user"):
+                user_prompt = self._compose_user_prompt(req)
         else:
             # Chat puro: usar prompt flexible y conversacional
-            user_prompt = self._compose_chat_prompt(req)
+            with PROMPT_COMPOSE_SECONDS.time(kind="chat"):
+                user_prompt = self._compose_chat_prompt(req, context)
         
-        return self._call_gemini(
-            user_prompt, 
-            allow_reframe=bool(getattr(req, "safe_mode", True)), 
+        cache = get_response_cache()
+        key = self._cache_key(req, length, context if is_conversational else None)
+        cached = cache.get(key)
+        if cached is not None:
+            return AskResponse(**cached)
+        if BREAKER.state == OPEN:
+            return self._degraded_response(req, key)
+
+        try:
+            resp = self._call_gemini(
+                user_prompt, 
+                allow_reframe=bool(getattr(req, "safe_mode", True)), 
+                length=length,
+                conversational=is_conversational,
+                deadline=deadline,
+            )
+        except (CircuitOpenError, DeadlineExceeded, KeyPoolExhausted):
+            return self._degraded_response(req, key)
+        except Exception:
+            # Reintentos cortados por falta de presupuesto: mejor una respuesta degradada que un 502
+            if deadline.remaining() < _MIN_ATTEMPT_S:
+                return self._degraded_response(req, key)
+            raise
+        if resp.answer and "fue bloqueada" not in resp.answer.lower():
+            cache.set(key, {"answer": resp.answer, "model": resp.model, "tips": resp.tips})
+            # Persistir la caché caliente para la próxima instancia (como máximo cada WARM_STATE_SAVE_INTERVAL_S)
+            get_warm_state().save()
+        return resp
+
+    @staticmethod
+    def _recommendation_response(rec: Recommendation, *, model: str) -> AskResponse:
+        """Respuesta de una recomendación estructurada, con un resumen en texto breve (por si el cliente lo usa)."""
+        tr = rec.target_range
+        rango = None
+        if tr and (tr.min is not None or tr.max is not None):
+            if tr.min is not None and tr.max is not None:
+                rango = f"{tr.min}–{tr.max} {tr.unit or ''}".strip()
+            elif tr.min is not None:
+                rango = f">= {tr.min} {tr.unit or ''}".strip()
+            elif tr.max is not None:
+                rango = f"<= {tr.max} {tr.unit or ''}".strip()
+        text_summary = (
+            f"Sugerencia: {rec.action or '—'} {rec.parameter or ''}. "
+            + (f"Rango objetivo: {rango}. " if rango else "")
+            + (rec.rationale or "")
+        ).strip()
+        return AskResponse(
+            answer=text_summary or (rec.rationale or ""),
+            model=model,
+            usage=None,
+            tips=None,
+            recommendation=rec,
+        )
+
+    def _cache_model(self, length: str) -> str:
+        """Modelo de la versión de caché: con MODEL_ROUTING, la lista de la clase de petición.
+
+        El modelo concreto se elige en cada llamada (salud, latencia), así que las respuestas
+        de los modelos de una misma lista comparten la caché; cambiar la lista la invalida.
+        """
+        if not self.settings.model_routing:
+            return self.settings.gemini_model
+        models = get_model_router().routes.get(route_for(length=length))
+        return ",".join(models) if models else self.settings.gemini_model
+
+    def _cache_key(self, req: AskRequest, length: str, context: Optional[str] = None) -> str:
+        # El contexto de sesión solo entra en la clave si existe (las claves sin sesión no cambian)
+        extra = {"context": context} if context else {}
+        return cache_key(
+            cache_version(self.prompt_text, self._cache_model(length)),
+            question=req.question,
+            crop=req.crop,
+            stage=req.stage,
             length=length,
-            conversational=is_conversational
+            safe_mode=bool(getattr(req, "safe_mode", True)),
+            temperature=req.temperature,
+            parameter=req.parameter,
+            value=req.value,
+            unit=req.unit,
+            **extra,
+        )
+
+    def _degraded_response(self, req: AskRequest, key: str) -> AskResponse:
+        """Respuesta sin modelo (circuito abierto o presupuesto agotado): caché, aunque esté vencida, o demo."""
+        cached = get_response_cache().get(key, allow_stale=True)
+        if cached is not None:
+            BREAKER_SHORT_CIRCUITS.inc(fallback="cache")
+            return AskResponse(**cached)
+        BREAKER_SHORT_CIRCUITS.inc(fallback="demo")
+        answer = (
+            "[MODO DEGRADADO] El modelo no está disponible temporalmente; esta es una orientación general.\n\n"
+            f"Resumen: {(req.question or '')[:180]}...\n\n"
+            "Intenta nuevamente en unos minutos para obtener una respuesta completa."
         )
+        tips = [
+            "Incluye datos de suelo (pH, CE, % humedad) y clima (ET0, precipitación).",
+            "Especifica el estado fenológico del cultivo para recomendaciones más precisas.",
+        ]
+        return AskResponse(answer=answer, model=self.settings.gemini_model, usage=None, tips=tips)
+
+
+_client: Optional[GeminiClient] = None
+_client_lock = threading.Lock()
+
 
+def get_gemini_client() -> GeminiClient:
+    """Cliente compartido del proceso: el prompt se lee y el modelo se configura una sola vez."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GeminiClient(prompt_path=DEFAULT_PROMPT_PATH)
+                # Instancia nueva: recuperar las respuestas cacheadas por la anterior (si hay snapshot)
+                restored = get_warm_state().restore_cache()
+                if restored:
+                    logger.info("Estado tibio: %d respuestas restauradas en caché", restored)
+    return _client
@@ -0,0 +1,246 @@
+"""
+Modo asíncrono para consultas de chat largas.
+
+POST /v1/agro/jobs encola la consulta en la tabla chat_jobs (SQLite, durable) y
+responde de inmediato con el id. Un pool de JOB_WORKERS hilos toma los trabajos
+en orden de llegada, ejecuta GeminiClient.ask con un presupuesto de
+JOB_TIMEOUT_S y guarda el resultado en el trabajo y en chat_history. Los errores
+transitorios se reintentan hasta JOB_MAX_ATTEMPTS; los trabajos que quedaron en
+curso al reiniciarse el proceso vuelven a la cola pasado el timeout.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from app.config import get_settings
+from app.schemas.chat import ChatRequest
+from app.schemas.requests import AskRequest
+from app.services.gemini_client import get_gemini_client
+from app.services.sessions import get_session_store
+from app.utils.deadline import Deadline
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+logger = get_logger("agro.jobs")
+
+JOB_EVENTS = REGISTRY.counter(
+    "agro_jobs_total",
+    "Eventos de la cola de trabajos asíncronos.",
+    ("event",),
+)
+JOB_SECONDS = REGISTRY.histogram(
+    "agro_job_seconds",
+    "Tiempo de los trabajos asíncronos: espera en cola y ejecución.",
+    ("stage",),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+)
+JOB_WORKERS_BUSY = REGISTRY.gauge(
+    "agro_job_workers_busy",
+    "Workers de trabajos asíncronos ejecutando un trabajo.",
+)
+
+# Cada cuánto un worker ocioso revisa la cola aunque nadie lo despierte
+# (trabajos encolados por otro proceso o devueltos a la cola tras un reinicio)
+_IDLE_POLL_S = 5.0
+
+
+def job_to_dict(job: Any) -> Dict[str, Any]:
+    """Representación pública de un trabajo (sin la IP del cliente)."""
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "attempts": job.attempts,
+        "result": job.result_json,
+        "error": job.error,
+        "chat_id": job.chat_id,
+    }
+
+
+class JobWorkerPool:
+    """Hilos que consumen la cola durable de trabajos."""
+
+    def __init__(self, workers: int = 2, timeout_s: float = 120.0, max_attempts: int = 3):
+        self.workers = max(1, workers)
+        self.timeout_s = timeout_s
+        self.max_attempts = max(1, max_attempts)
+        self._threads: List[threading.Thread] = []
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return any(t.is_alive() for t in self._threads)
+
+    def start(self) -> None:
+        """Arranca los workers (idempotente) y recupera trabajos huérfanos."""
+        with self._start_lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._requeue_stale()
+            self._threads = [
+                threading.Thread(target=self._loop, name=f"agro-job-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+        logger.info("Workers de trabajos iniciados (%d)", self.workers)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Detiene los workers; un trabajo en curso se recupera en el próximo arranque."""
+        self._stop.set()
+        self.notify()
+        for t in self._threads:
+            t.join(timeout)
+
+    def notify(self) -> None:
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def submit(self, req: ChatRequest, user_ip: Optional[str]) -> Any:
+        """Encola la consulta y despierta a un worker."""
+        from app.db.database import SessionLocal
+        from app.db.job_service import JobService
+
+        db = SessionLocal()
+        try:
+            job = JobService.create(db, request=req.model_dump(), user_ip=user_ip)
+        finally:
+            db.close()
+        JOB_EVENTS.inc(event="submitted")
+        self.start()
+        self.notify()
+        return job
+
+    def _requeue_stale(self) -> None:
+        from app.db.database import SessionLocal
+        from app.db.job_service import JobService
+
+        db = SessionLocal()
+        try:
+            stale = JobService.requeue_stale(db, datetime.utcnow() - timedelta(seconds=self.timeout_s * 2))
+        finally:
+            db.close()
+        if stale:
+            JOB_EVENTS.inc(stale, event="recovered")
+            logger.info("Trabajos huérfanos devueltos a la cola: %d", stale)
+
+    def _loop(self) -> None:
+        from app.db.database import SessionLocal
+        from app.db.job_service import JobService
+
+        last_recovery = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                db = SessionLocal()
+                try:
+                    job = JobService.claim_next(db)
+                    if job is not None:
+                        self._run(db, job)
+                finally:
+                    db.close()
+            except Exception as e:  # el worker no debe morir por un error de DB
+                logger.exception("Error en worker de trabajos: %s", e)
+                job = None
+            if job is None:
+                if time.monotonic() - last_recovery > self.timeout_s:
+                    last_recovery = time.monotonic()
+                    self._requeue_stale()
+                with self._wakeup:
+                    if not self._stop.is_set():
+                        self._wakeup.wait(_IDLE_POLL_S)
+
+    def _run(self, db: Any, job: Any) -> None:
+        from app.db.history_service import HistoryService
+        from app.db.job_service import JobService
+
+        JOB_EVENTS.inc(event="started")
+        JOB_SECONDS.observe((job.started_at - job.created_at).total_seconds(), stage="queue")
+        if job.attempts > self.max_attempts:
+            JobService.fail(db, job.id, job.error or "Se agotaron los intentos.", retry=False)
+            JOB_EVENTS.inc(event="failed")
+            return
+        req = ChatRequest(**job.request_json)
+        session = get_session_store().get(db, req.session_id) if req.session_id else None
+        if req.session_id and session is None:
+            JobService.fail(db, job.id, "Sesión no encontrada.", retry=False)
+            JOB_EVENTS.inc(event="failed")
+            return
+        context = get_session_store().context(session) if session is not None else None
+        ask_req = AskRequest(
+            question=req.question,
+            crop=req.crop,
+            stage=req.stage,
+            length=req.length,
+            safe_mode=req.safe_mode,
+        )
+        start = time.perf_counter()
+        with JOB_WORKERS_BUSY.track_inprogress():
+            try:
+                resp = get_gemini_client().ask(ask_req, Deadline(self.timeout_s), context)
+            except ValueError as e:
+                JobService.fail(db, job.id, str(e), retry=False)
+                JOB_EVENTS.inc(event="failed")
+                return
+            except Exception as e:
+                retry = job.attempts < self.max_attempts
+                logger.warning("Trabajo %s falló (intento %d): %s", job.id, job.attempts, e)
+                JobService.fail(db, job.id, "Error al consultar el modelo.", retry=retry)
+                JOB_EVENTS.inc(event="retried" if retry else "failed")
+                return
+        elapsed = time.perf_counter() - start
+        JOB_SECONDS.observe(elapsed, stage="run")
+
+        chat_id = None
+        try:
+            chat = HistoryService.save_chat(
+                db=db,
+                endpoint="/v1/agro/jobs",
+                question=req.question,
+                crop=req.crop,
+                stage=req.stage,
+                parameter=None,
+                value=None,
+                unit=None,
+                length=req.length,
+                answer=resp.answer,
+                model=resp.model,
+                recommendation=None,
+                response_time_ms=int(elapsed * 1000),
+                user_ip=job.user_ip,
+                session_id=req.session_id,
+            )
+            chat_id = chat.id
+            if session is not None:
+                get_session_store().record(db, session, chat.id, req.question, resp.answer)
+        except Exception as e:
+            db.rollback()
+            logger.warning("Error guardando historial del trabajo %s: %s", job.id, e)
+        JobService.finish(db, job.id, {"answer": resp.answer, "model": resp.model, "tips": resp.tips}, chat_id)
+        JOB_EVENTS.inc(event="done")
+
+
+_pool: Optional[JobWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_job_pool() -> JobWorkerPool:
+    """Pool de workers compartido del proceso (los hilos arrancan con start() o el primer submit)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                _pool = JobWorkerPool(
+                    workers=settings.job_workers,
+                    timeout_s=settings.job_timeout_s,
+                    max_attempts=settings.job_max_attempts,
+                )
+    return _pool
@@ -0,0 +1,221 @@
+"""
+Pool de claves de API de Gemini.
+
+Reparte las llamadas entre varias claves (GEMINI_API_KEYS) para sumar sus cuotas
+de RPM/TPM, en round-robin o a la menos cargada. Por clave se cuentan peticiones
+y tokens (desde `usage_metadata`) en una ventana de 60 s; una clave que recibe un
+429 queda en pausa durante KEY_BENCH_S (o el Retry-After, si es mayor). En las
+métricas las claves se identifican como key1, key2, ... según su orden en la
+configuración, nunca por su valor.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.utils.metrics import REGISTRY
+
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+_WINDOW_S = 60.0
+
+KEY_REQUESTS = REGISTRY.counter(
+    "agro_api_key_requests_total",
+    "Llamadas al modelo por clave de API y resultado.",
+    ("key", "outcome"),
+)
+KEY_TOKENS = REGISTRY.counter(
+    "agro_api_key_tokens_total",
+    "Tokens consumidos por clave de API (según usage_metadata).",
+    ("key", "kind"),
+)
+KEY_INFLIGHT = REGISTRY.gauge(
+    "agro_api_key_inflight",
+    "Llamadas en curso por clave de API.",
+    ("key",),
+)
+KEY_BENCHED = REGISTRY.gauge(
+    "agro_api_key_benched",
+    "1 si la clave está en pausa tras un 429.",
+    ("key",),
+)
+KEY_UTILIZATION = REGISTRY.gauge(
+    "agro_api_key_utilization",
+    "Uso de la cuota por minuto de cada clave (fracción de KEY_RPM_LIMIT / KEY_TPM_LIMIT; sin límite, valor absoluto).",
+    ("key", "resource"),
+)
+
+
+class KeyPoolExhausted(RuntimeError):
+    """Todas las claves están en pausa. El mensaje empieza con 429 para que se trate como cuota agotada."""
+
+
+@dataclass(eq=False)
+class ApiKey:
+    label: str
+    secret: str = field(repr=False)
+    inflight: int = 0
+    benched_until: float = 0.0
+    # (instante, tokens) de las llamadas del último minuto
+    recent: Deque[Tuple[float, int]] = field(default_factory=deque)
+
+    def _trim(self, now: float) -> None:
+        while self.recent and now - self.recent[0][0] > _WINDOW_S:
+            self.recent.popleft()
+
+    def requests_per_minute(self, now: float) -> int:
+        self._trim(now)
+        return len(self.recent)
+
+    def tokens_per_minute(self, now: float) -> int:
+        self._trim(now)
+        return sum(tokens for _, tokens in self.recent)
+
+
+class KeyPool:
+    def __init__(
+        self,
+        keys: List[str],
+        *,
+        strategy: str = ROUND_ROBIN,
+        bench_s: float = 60.0,
+        rpm_limit: int = 0,
+        tpm_limit: int = 0,
+    ):
+        if not keys:
+            raise ValueError("El pool necesita al menos una clave de API.")
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"Estrategia de pool desconocida: {strategy}")
+        self.keys = [ApiKey(label=f"key{i}", secret=k) for i, k in enumerate(keys, start=1)]
+        self.strategy = strategy
+        self.bench_s = bench_s
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _saturated(self, key: ApiKey, now: float) -> bool:
+        """Cuota local del minuto agotada (solo si hay límites configurados)."""
+        if self.rpm_limit and key.requests_per_minute(now) + key.inflight >= self.rpm_limit:
+            return True
+        return bool(self.tpm_limit) and key.tokens_per_minute(now) >= self.tpm_limit
+
+    def acquire(self) -> ApiKey:
+        """Clave para la próxima llamada; KeyPoolExhausted si todas están en pausa."""
+        now = time.monotonic()
+        with self._lock:
+            ready = [k for k in self.keys if k.benched_until <= now]
+            for k in self.keys:
+                if k.benched_until and k.benched_until <= now:
+                    k.benched_until = 0.0
+                    KEY_BENCHED.set(0, key=k.label)
+            if not ready:
+                wait = min(k.benched_until for k in self.keys) - now
+                raise KeyPoolExhausted(
+                    f"429 Todas las claves de API están en pausa por cuota (retry in {wait:.1f}s)"
+                )
+            # Las claves con cuota local agotada quedan al final (se usan solo si no hay otra)
+            ready = [k for k in ready if not self._saturated(k, now)] or ready
+            if self.strategy == LEAST_LOADED:
+                key = min(ready, key=lambda k: (k.inflight, k.requests_per_minute(now)))
+            else:
+                n = len(self.keys)
+                order = [self.keys[(self._next + i) % n] for i in range(n)]
+                key = next(k for k in order if k in ready)
+                self._next = (self.keys.index(key) + 1) % n
+            key.inflight += 1
+        KEY_INFLIGHT.inc(key=key.label)
+        return key
+
+    def cancel(self, key: ApiKey) -> None:
+        """Devuelve una clave tomada con acquire() sin haber llamado al modelo."""
+        with self._lock:
+            key.inflight -= 1
+        KEY_INFLIGHT.dec(key=key.label)
+
+    def release(
+        self,
+        key: ApiKey,
+        *,
+        outcome: str,
+        usage: Any = None,
+        status: Optional[int] = None,
+        retry_after_s: Optional[float] = None,
+    ) -> None:
+        """Registra el resultado de la llamada hecha con `key` (tokens, 429 → pausa)."""
+        now = time.monotonic()
+        prompt_tokens = int(getattr(usage, "prompt_token_count", 0) or 0)
+        output_tokens = int(getattr(usage, "candidates_token_count", 0) or 0)
+        total = int(getattr(usage, "total_token_count", 0) or 0) or prompt_tokens + output_tokens
+        with self._lock:
+            key.inflight -= 1
+            key.recent.append((now, total))
+            if status == 429:
+                key.benched_until = now + max(self.bench_s, retry_after_s or 0.0)
+            rpm = key.requests_per_minute(now)
+            tpm = key.tokens_per_minute(now)
+        KEY_INFLIGHT.dec(key=key.label)
+        KEY_REQUESTS.inc(key=key.label, outcome=outcome)
+        if prompt_tokens:
+            KEY_TOKENS.inc(prompt_tokens, key=key.label, kind="prompt")
+        if output_tokens:
+            KEY_TOKENS.inc(output_tokens, key=key.label, kind="output")
+        if status == 429:
+            KEY_BENCHED.set(1, key=key.label)
+        KEY_UTILIZATION.set(rpm / self.rpm_limit if self.rpm_limit else rpm, key=key.label, resource="rpm")
+        KEY_UTILIZATION.set(tpm / self.tpm_limit if self.tpm_limit else tpm, key=key.label, resource="tpm")
+
+    def status(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "key": k.label,
+                    "inflight": k.inflight,
+                    "requests_per_minute": k.requests_per_minute(now),
+                    "tokens_per_minute": k.tokens_per_minute(now),
+                    "benched_s": round(max(0.0, k.benched_until - now), 1),
+                }
+                for k in self.keys
+            ]
+
+
+def configured_keys() -> List[str]:
+    """Claves de GEMINI_API_KEYS (separadas por comas) o, si no hay, GEMINI_API_KEY."""
+    settings = get_settings()
+    keys = [k.strip() for k in (settings.gemini_api_keys or "").split(",") if k.strip()]
+    if not keys and settings.gemini_api_key:
+        keys = [settings.gemini_api_key]
+    return keys
+
+
+_pool: Optional[KeyPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool() -> Optional[KeyPool]:
+    """Pool compartido del proceso (None si no hay ninguna clave configurada)."""
+    global _pool
+    if _pool is None:
+        keys = configured_keys()
+        if not keys:
+            return None
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                _pool = KeyPool(
+                    keys,
+                    strategy=settings.key_pool_strategy,
+                    bench_s=settings.key_bench_s,
+                    rpm_limit=settings.key_rpm_limit,
+                    tpm_limit=settings.key_tpm_limit,
+                )
+    return _pool
@@ -0,0 +1,181 @@
+"""
+Enrutador de modelos por clase de petición.
+
+Cada clase (salida estructurada JSON, respuesta corta, chat) tiene una lista de
+modelos en orden de preferencia (el más barato/rápido que alcance primero,
+p. ej. flash para JSON y pro para chat medio). Por modelo se lleva un promedio
+móvil exponencial (EWMA) de la latencia y de la tasa de error de las llamadas
+reales; un modelo que se degrada (error o latencia por encima del umbral) cede
+el tráfico al siguiente de la lista. Pasado `probe_after_s` sin llamadas, un
+modelo degradado recibe una sola petición de prueba (las demás siguen yendo al
+siguiente mientras tanto); si sale bien, sus promedios se reinician y vuelve a
+ser el preferido de inmediato, sin esperar a que la EWMA baje llamada a llamada.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from app.config import get_settings
+from app.utils.metrics import REGISTRY
+
+STRUCTURED = "structured"
+SHORT = "short"
+CHAT = "chat"
+
+MODEL_ROUTES = REGISTRY.counter(
+    "agro_model_routes_total",
+    "Modelo elegido por el enrutador, por clase de petición y motivo.",
+    ("route", "model", "reason"),
+)
+
+
+def route_for(*, json_output: bool = False, length: Optional[str] = None) -> str:
+    """Clase de petición: JSON estructurado, respuesta corta o chat (medio/largo)."""
+    if json_output:
+        return STRUCTURED
+    if length == "short":
+        return SHORT
+    return CHAT
+
+
+def parse_model_list(value: str) -> List[str]:
+    return [m.strip() for m in (value or "").split(",") if m.strip()]
+
+
+@dataclass
+class ModelStats:
+    latency_s: Optional[float] = None
+    error_rate: float = 0.0
+    calls: int = 0
+    last_at: float = 0.0
+    # Momento en que salió la sonda en curso (None: ninguna)
+    probe_at: Optional[float] = None
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        routes: Dict[str, List[str]],
+        *,
+        alpha: float = 0.2,
+        min_calls: int = 3,
+        max_error_rate: float = 0.3,
+        max_latency_s: float = 15.0,
+        probe_after_s: float = 60.0,
+    ):
+        self.routes = {name: list(models) for name, models in routes.items()}
+        self.alpha = alpha
+        self.min_calls = max(1, min_calls)
+        self.max_error_rate = max_error_rate
+        self.max_latency_s = max_latency_s
+        self.probe_after_s = probe_after_s
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, latency_s: float, ok: bool) -> None:
+        """Actualiza las EWMA del modelo con una llamada observada."""
+        a = self.alpha
+        with self._lock:
+            s = self._stats.setdefault(model, ModelStats())
+            if s.probe_at is not None:
+                s.probe_at = None
+                if ok:
+                    # Sonda exitosa: lo anterior a la falla ya no describe al modelo
+                    self._stats[model] = ModelStats(latency_s=latency_s, calls=1, last_at=time.monotonic())
+                    return
+            s.latency_s = latency_s if s.latency_s is None else (1 - a) * s.latency_s + a * latency_s
+            s.error_rate = (1 - a) * s.error_rate + a * (0.0 if ok else 1.0)
+            s.calls += 1
+            s.last_at = time.monotonic()
+
+    def disable(self, model: str) -> None:
+        """Marca el modelo como no disponible (p. ej. 404) hasta la próxima sonda."""
+        with self._lock:
+            s = self._stats.setdefault(model, ModelStats())
+            s.error_rate = 1.0
+            s.calls = max(s.calls, self.min_calls)
+            s.last_at = time.monotonic()
+            s.probe_at = None
+
+    def _healthy(self, s: Optional[ModelStats]) -> bool:
+        if s is None or s.calls < self.min_calls:
+            return True
+        return s.error_rate <= self.max_error_rate and (s.latency_s or 0.0) <= self.max_latency_s
+
+    def _can_probe(self, s: ModelStats, now: float) -> bool:
+        """Modelo degradado sin llamadas recientes y sin otra sonda en curso (o con una que nunca volvió)."""
+        if now - s.last_at < self.probe_after_s:
+            return False
+        return s.probe_at is None or now - s.probe_at >= self.probe_after_s
+
+    def _score(self, s: Optional[ModelStats]) -> float:
+        # Menor es mejor: latencia esperada penalizada por la tasa de error
+        if s is None:
+            return 0.0
+        return (s.latency_s or 0.0) + s.error_rate * self.max_latency_s
+
+    def choose(self, route: str, available: Iterable[str] = (), default: Optional[str] = None) -> Optional[str]:
+        """Primer modelo sano de la clase `route` (entre los disponibles, si se conocen).
+
+        Si todos están degradados se elige el de mejor puntaje; si la clase no tiene
+        modelos utilizables se devuelve `default`.
+        """
+        avail = set(available)
+        candidates = [m for m in self.routes.get(route, ()) if not avail or m in avail]
+        if not candidates:
+            return default
+        now = time.monotonic()
+        with self._lock:
+            for i, model in enumerate(candidates):
+                s = self._stats.get(model)
+                if self._healthy(s):
+                    MODEL_ROUTES.inc(route=route, model=model, reason="preferred" if i == 0 else "shifted")
+                    return model
+                if self._can_probe(s, now):
+                    s.probe_at = now
+                    MODEL_ROUTES.inc(route=route, model=model, reason="probe")
+                    return model
+            model = min(candidates, key=lambda m: self._score(self._stats.get(m)))
+        MODEL_ROUTES.inc(route=route, model=model, reason="degraded")
+        return model
+
+    def status(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                model: {
+                    "latency_ms": round((s.latency_s or 0.0) * 1000, 1),
+                    "error_rate": round(s.error_rate, 3),
+                    "calls": s.calls,
+                    "healthy": self._healthy(s),
+                    "probing": s.probe_at is not None,
+                }
+                for model, s in self._stats.items()
+            }
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """Enrutador compartido del proceso (rutas y umbrales desde la configuración)."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                settings = get_settings()
+                _router = ModelRouter(
+                    {
+                        STRUCTURED: parse_model_list(settings.model_route_structured),
+                        SHORT: parse_model_list(settings.model_route_short),
+                        CHAT: parse_model_list(settings.model_route_chat),
+                    },
+                    alpha=settings.model_router_alpha,
+                    max_error_rate=settings.model_router_max_error_rate,
+                    max_latency_s=settings.model_router_max_latency_s,
+                    probe_after_s=settings.model_router_probe_s,
+                )
+    return _router
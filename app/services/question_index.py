@@ -0,0 +1,413 @@
+"""
+Índice vectorial en memoria de las preguntas de chat_history ("preguntas similares").
+
+Cada pregunta se representa como un vector TF-IDF disperso de palabras y
+trigramas de caracteres, con hashing a un espacio fijo (sin vocabulario ni
+servicios externos); los trigramas toleran errores de tipeo y palabras a medio
+escribir. La búsqueda usa un índice invertido: se recorren las listas de los
+rasgos más raros de la consulta hasta un tope de entradas y los mejores
+candidatos se reordenan con el coseno exacto, así el costo no crece con las
+listas de rasgos muy frecuentes (p. ej. "de", "en"). Las preguntas repetidas (mismo texto
+normalizado) ocupan una sola entrada que apunta a la conversación más reciente.
+
+El índice se construye desde SQLite la primera vez, se actualiza con cada
+pregunta guardada y se persiste en QUESTION_INDEX_PATH (formato binario propio,
+sin pickle): al reiniciar se carga el archivo y solo se indexan las filas nuevas.
+"""
+from __future__ import annotations
+
+import hashlib
+import heapq
+import math
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import Counter
+from itertools import repeat
+from operator import mul
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.config import get_settings
+from app.utils.jsonio import dumps, loads
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+logger = get_logger("agro.question_index")
+
+# Sube si cambia el formato del archivo o la extracción de rasgos (se reconstruye)
+FORMAT_VERSION = 1
+BUCKETS = 1 << 20
+
+# Entradas de listas invertidas recorridas por búsqueda (de los rasgos más raros a los más comunes)
+_CANDIDATE_POSTINGS = 40_000
+# Candidatos (los que comparten más rasgos raros) que se reordenan con el coseno exacto
+_RERANK_CANDIDATES = 200
+_SYNC_BATCH = 5000
+
+_WORD_RE = re.compile(r"[a-z0-9ñ]+")
+
+INDEX_SECONDS = REGISTRY.histogram(
+    "agro_question_index_seconds",
+    "Tiempo de operaciones del índice de preguntas similares.",
+    ("op",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+INDEX_SIZE = REGISTRY.gauge(
+    "agro_question_index_entries",
+    "Preguntas distintas en el índice de preguntas similares.",
+)
+
+
+def normalize(text: str) -> List[str]:
+    """Palabras en minúsculas y sin tildes (la ñ se conserva)."""
+    text = (text or "").lower().replace("ñ", "\0")
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return _WORD_RE.findall(text.replace("\0", "ñ"))
+
+
+def _bucket(token: str) -> int:
+    # crc32 y no hash(): debe ser estable entre procesos para poder persistir el índice
+    return zlib.crc32(token.encode("utf-8")) & (BUCKETS - 1)
+
+
+def features(text: str) -> Dict[int, float]:
+    """Vector de términos (TF sublineal) con palabras y trigramas de caracteres por palabra."""
+    counts: Counter = Counter()
+    for word in normalize(text):
+        counts[_bucket("w:" + word)] += 1
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            counts[_bucket(padded[i:i + 3])] += 1
+    return {f: 1.0 + math.log(c) for f, c in counts.items()}
+
+
+def _text_hash(words: Iterable[str]) -> int:
+    digest = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class QuestionIndex:
+    """Índice invertido de vectores unitarios TF-IDF (los pesos se fijan al insertar).
+
+    Además de las listas invertidas guarda cada vector completo (índice directo),
+    para recalcular el coseno exacto de los candidatos.
+    """
+
+    def __init__(self) -> None:
+        self._chat_ids = array("q")  # entrada → chat_history.id más reciente con ese texto
+        self._hashes = array("Q")  # entrada → hash del texto normalizado
+        self._by_hash: Dict[int, int] = {}
+        # Índice directo: rasgos y pesos de la entrada i en [offsets[i], offsets[i + 1])
+        self._fwd_offsets = array("Q", [0])
+        self._fwd_features = array("I")
+        self._fwd_weights = array("f")
+        # Índice invertido: rasgo → (entradas, pesos)
+        self._postings: Dict[int, Tuple[array, array]] = {}
+        self.last_chat_id = 0  # filas de SQLite ya revisadas por sync()
+        self.dirty = False
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._chat_ids)
+
+    def _idf(self, feature: int, n: int) -> float:
+        postings = self._postings.get(feature)
+        df = len(postings[0]) if postings else 0
+        return math.log((n + 1) / (df + 1)) + 1.0
+
+    def add(self, chat_id: int, question: Optional[str]) -> bool:
+        """Indexa la pregunta; si el texto ya existe solo actualiza la conversación a la que apunta."""
+        words = normalize(question or "")
+        if not words:
+            return False
+        h = _text_hash(words)
+        with self._lock:
+            doc = self._by_hash.get(h)
+            if doc is not None:
+                if chat_id > self._chat_ids[doc]:
+                    self._chat_ids[doc] = chat_id
+                    self.dirty = True
+                return False
+            tf = features(question or "")
+            n = len(self._chat_ids) + 1
+            weights = {f: w * self._idf(f, n) for f, w in tf.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            doc = len(self._chat_ids)
+            self._chat_ids.append(chat_id)
+            self._hashes.append(h)
+            self._by_hash[h] = doc
+            for f, w in weights.items():
+                postings = self._postings.get(f)
+                if postings is None:
+                    postings = self._postings[f] = (array("I"), array("f"))
+                postings[0].append(doc)
+                postings[1].append(w / norm)
+                self._fwd_features.append(f)
+                self._fwd_weights.append(w / norm)
+            self._fwd_offsets.append(len(self._fwd_features))
+            self.dirty = True
+        INDEX_SIZE.set(len(self._chat_ids))
+        return True
+
+    def search(self, query: str, k: int = 5, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """Top-k (chat_id, similitud coseno) para la consulta.
+
+        Los candidatos salen de las listas de los rasgos más raros de la consulta
+        (hasta _CANDIDATE_POSTINGS entradas recorridas); los que comparten más
+        rasgos se reordenan con el coseno exacto usando el índice directo.
+        """
+        start = time.perf_counter()
+        tf = features(query)
+        with self._lock:
+            n = len(self._chat_ids)
+            if not tf or not n:
+                return []
+            q = {f: w * self._idf(f, n) for f, w in tf.items()}
+            qnorm = math.sqrt(sum(w * w for w in q.values())) or 1.0
+            q = {f: w / qnorm for f, w in q.items()}
+
+            # Candidatos: entradas que comparten más rasgos raros con la consulta (conteo en C con Counter)
+            shared: Counter = Counter()
+            visited = 0
+            for f in sorted((f for f in q if f in self._postings), key=lambda f: len(self._postings[f][0])):
+                docs = self._postings[f][0]
+                if visited and visited + len(docs) > _CANDIDATE_POSTINGS:
+                    break
+                visited += len(docs)
+                shared.update(docs)
+
+            offsets, feats, fweights = self._fwd_offsets, self._fwd_features, self._fwd_weights
+            q_get = q.get
+            scored = []
+            for doc, _ in shared.most_common(_RERANK_CANDIDATES):
+                lo, hi = offsets[doc], offsets[doc + 1]
+                # Producto punto con map/operator (en C): Σ q[f] · w sobre los rasgos de la entrada
+                score = sum(map(mul, map(q_get, feats[lo:hi], repeat(0.0)), fweights[lo:hi]))
+                if score >= min_score:
+                    scored.append((score, doc))
+            top = heapq.nlargest(k, scored)
+            result = [(self._chat_ids[doc], round(score, 4)) for score, doc in top]
+        INDEX_SECONDS.observe(time.perf_counter() - start, op="search")
+        return result
+
+    # ------------------------------------------------------------------
+    # Sincronización con SQLite
+    # ------------------------------------------------------------------
+
+    def sync(self, db) -> int:
+        """Indexa las filas de chat_history posteriores a `last_chat_id` (propias o de otros procesos)."""
+        from sqlalchemy import select
+
+        from app.db.database import ChatHistory
+
+        start = time.perf_counter()
+        added = 0
+        while True:
+            rows = db.execute(
+                select(ChatHistory.id, ChatHistory.question)
+                .where(ChatHistory.id > self.last_chat_id)
+                .order_by(ChatHistory.id)
+                .limit(_SYNC_BATCH)
+            ).all()
+            if not rows:
+                break
+            for chat_id, question in rows:
+                added += self.add(chat_id, question)
+            with self._lock:
+                self.last_chat_id = max(self.last_chat_id, rows[-1][0])
+                self.dirty = True
+        INDEX_SECONDS.observe(time.perf_counter() - start, op="sync")
+        return added
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+
+    # Tipos de los arreglos del archivo, en orden: chat_ids, hashes, índice directo
+    # (offsets, rasgos, pesos) e invertido (rasgos, offsets, entradas, pesos)
+    _LAYOUT = ("q", "Q", "Q", "I", "f", "I", "Q", "I", "f")
+
+    def save(self, path: Path) -> None:
+        """Escribe el índice de forma atómica: cabecera JSON + arreglos binarios.
+
+        Las listas invertidas se guardan concatenadas (rasgos ordenados + offsets) y
+        al cargar se recortan en rebanadas, sin volver a tokenizar ni recalcular pesos.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            keys = array("I", sorted(self._postings))
+            offsets = array("Q", [0])
+            docs, weights = array("I"), array("f")
+            for f in keys:
+                d, w = self._postings[f]
+                docs.extend(d)
+                weights.extend(w)
+                offsets.append(len(docs))
+            arrays = (
+                array("q", self._chat_ids),
+                array("Q", self._hashes),
+                array("Q", self._fwd_offsets),
+                array("I", self._fwd_features),
+                array("f", self._fwd_weights),
+                keys,
+                offsets,
+                docs,
+                weights,
+            )
+            header = {
+                "format": FORMAT_VERSION,
+                "buckets": BUCKETS,
+                "byteorder": sys.byteorder,
+                "itemsizes": [a.itemsize for a in arrays],
+                "last_chat_id": self.last_chat_id,
+                "entries": len(self._chat_ids),
+                "features": len(keys),
+                "postings": len(self._fwd_features),
+            }
+            self.dirty = False
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "wb") as fh:
+                fh.write(dumps(header) + b"\n")
+                for arr in arrays:
+                    arr.tofile(fh)
+            os.replace(tmp, path)
+        except Exception:
+            with self._lock:
+                self.dirty = True
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            raise
+        INDEX_SECONDS.observe(time.perf_counter() - start, op="save")
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["QuestionIndex"]:
+        """Carga un índice guardado con save(); None si falta, es de otro formato o está dañado."""
+        start = time.perf_counter()
+        arrays = [array(t) for t in cls._LAYOUT]
+        try:
+            with open(path, "rb") as fh:
+                header = loads(fh.readline())
+                if (
+                    header.get("format") != FORMAT_VERSION
+                    or header.get("buckets") != BUCKETS
+                    or header.get("byteorder") != sys.byteorder
+                    or header.get("itemsizes") != [a.itemsize for a in arrays]
+                ):
+                    return None
+                n, m, p = header["entries"], header["features"], header["postings"]
+                for arr, count in zip(arrays, (n, n, n + 1, p, p, m, m + 1, p, p)):
+                    arr.fromfile(fh, count)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Índice de preguntas ilegible en %s: %s", path, e)
+            return None
+        chat_ids, hashes, fwd_offsets, fwd_features, fwd_weights, keys, offsets, docs, weights = arrays
+        index = cls()
+        index._chat_ids, index._hashes = chat_ids, hashes
+        index._by_hash = {h: i for i, h in enumerate(hashes)}
+        index._fwd_offsets, index._fwd_features, index._fwd_weights = fwd_offsets, fwd_features, fwd_weights
+        index._postings = {
+            f: (docs[offsets[i]:offsets[i + 1]], weights[offsets[i]:offsets[i + 1]])
+            for i, f in enumerate(keys)
+        }
+        index.last_chat_id = int(header.get("last_chat_id") or 0)
+        INDEX_SIZE.set(len(chat_ids))
+        INDEX_SECONDS.observe(time.perf_counter() - start, op="load")
+        return index
+
+
+class QuestionIndexStore:
+    """Índice compartido del proceso: carga o construcción perezosa, sync y guardado periódicos."""
+
+    def __init__(self, path: Optional[Path], *, save_interval_s: float = 60.0, sync_interval_s: float = 30.0):
+        self.path = path
+        self.save_interval_s = save_interval_s
+        self.sync_interval_s = sync_interval_s
+        self.index: Optional[QuestionIndex] = None
+        self._last_sync = 0.0
+        self._last_save = time.monotonic()
+        self._saving = False
+        self._lock = threading.Lock()
+
+    def get(self, db) -> QuestionIndex:
+        """Índice listo para consultar: lo carga del archivo (o lo construye) y trae las filas nuevas."""
+        index = self.index
+        if index is None:
+            with self._lock:
+                if self.index is None:
+                    loaded = QuestionIndex.load(self.path) if self.path else None
+                    logger.info(
+                        "Índice de preguntas %s", f"cargado ({len(loaded)} entradas)" if loaded else "vacío: se construye desde SQLite"
+                    )
+                    self.index = loaded or QuestionIndex()
+                    self._last_sync = 0.0
+                index = self.index
+        if time.monotonic() - self._last_sync >= self.sync_interval_s:
+            with self._lock:
+                if time.monotonic() - self._last_sync >= self.sync_interval_s:
+                    added = index.sync(db)
+                    self._last_sync = time.monotonic()
+                    if added:
+                        logger.info("Índice de preguntas: %d entradas nuevas desde SQLite", added)
+            self.maybe_save()
+        return index
+
+    def on_saved(self, chat_id: int, question: Optional[str]) -> None:
+        """Actualización incremental al guardar una conversación (solo si el índice ya está en memoria)."""
+        index = self.index
+        if index is None:
+            return
+        start = time.perf_counter()
+        index.add(chat_id, question)
+        INDEX_SECONDS.observe(time.perf_counter() - start, op="add")
+        self.maybe_save()
+
+    def maybe_save(self, *, force: bool = False) -> None:
+        """Guarda en segundo plano si hay cambios y pasó el intervalo (no bloquea la petición)."""
+        index = self.index
+        if self.path is None or index is None or not index.dirty:
+            return
+        with self._lock:
+            if self._saving or (not force and time.monotonic() - self._last_save < self.save_interval_s):
+                return
+            self._saving = True
+            self._last_save = time.monotonic()
+        threading.Thread(target=self._save, args=(index,), name="agro-question-index-save", daemon=True).start()
+
+    def _save(self, index: QuestionIndex) -> None:
+        try:
+            index.save(self.path)
+        except Exception as e:
+            logger.warning("No se pudo guardar el índice de preguntas en %s: %s", self.path, e)
+        finally:
+            self._saving = False
+
+
+_store: Optional[QuestionIndexStore] = None
+_store_lock = threading.Lock()
+
+
+def get_question_index_store() -> QuestionIndexStore:
+    """Store compartido del proceso (sin QUESTION_INDEX_PATH el índice no se persiste)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = get_settings()
+                _store = QuestionIndexStore(
+                    Path(settings.question_index_path) if settings.question_index_path else None,
+                    save_interval_s=settings.question_index_save_interval_s,
+                    sync_interval_s=settings.question_index_sync_interval_s,
+                )
+    return _store
@@ -0,0 +1,322 @@
+"""
+Caché de respuestas de GeminiClient.
+
+La clave se deriva de la petición normalizada más una versión (hash del prompt de
+sistema y nombre del modelo), de modo que cambiar cualquiera de los dos invalida
+las entradas anteriores sin borrarlas explícitamente. Las entradas vencidas no se
+sirven en operación normal, pero pueden usarse como respaldo (allow_stale) cuando
+el modelo no está disponible.
+
+Backends (RESPONSE_CACHE_BACKEND): `memory`, un LRU por proceso, y `sqlite`, un
+archivo compartido por todos los workers del host (RESPONSE_CACHE_PATH), para
+que agregar workers no divida ni enfríe la caché.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.utils.jsonio import dumps, loads
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+logger = get_logger("agro.response_cache")
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "agro_response_cache_lookups_total",
+    "Consultas a la caché de respuestas.",
+    ("result",),
+)
+
+
+def cache_version(prompt_text: str, model: str) -> str:
+    """Versión de las entradas: cambia con el prompt de sistema o el modelo."""
+    digest = hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:10]
+    return f"{digest}:{model}"
+
+
+def cache_key(version: str, **fields: Any) -> str:
+    """Clave estable a partir de campos de la petición (texto normalizado en minúsculas)."""
+    norm = {}
+    for k, v in sorted(fields.items()):
+        if isinstance(v, str):
+            v = " ".join(v.lower().split())
+        norm[k] = v
+    payload = dumps(norm, sort_keys=True)
+    return f"{version}|{hashlib.sha1(payload).hexdigest()}"
+
+
+class ResponseCache(ABC):
+    """Interfaz de la caché de respuestas (valores: dict serializable en JSON)."""
+
+    @abstractmethod
+    def get(self, key: str, *, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        """Valor vigente de `key` (o vencido, con allow_stale); None si no está."""
+
+    @abstractmethod
+    def set(self, key: str, value: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        """Guarda `value` por `ttl_s` segundos (por defecto, el TTL de la caché)."""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Borra todas las entradas."""
+
+    def snapshot(self, limit: int) -> List[List[Any]]:
+        """Hasta `limit` entradas vigentes, de la más usada a la menos: [clave, vence_en, valor]."""
+        return []
+
+    def restore(self, entries: List[List[Any]]) -> int:
+        """Carga entradas de snapshot() conservando su vencimiento; devuelve cuántas cargó."""
+        return 0
+
+
+class MemoryResponseCache(ResponseCache):
+    """LRU en memoria con TTL por entrada."""
+
+    def __init__(self, max_entries: int = 1000, default_ttl_s: float = 3600.0):
+        self.max_entries = max_entries
+        self.default_ttl_s = default_ttl_s
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, *, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            expires_at, value = item
+            if expires_at < time.time() and not allow_stale:
+                CACHE_LOOKUPS.inc(result="expired")
+                return None
+            self._data.move_to_end(key)
+        CACHE_LOOKUPS.inc(result="stale" if expires_at < time.time() else "hit")
+        return value
+
+    def set(self, key: str, value: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        ttl = self.default_ttl_s if ttl_s is None else ttl_s
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self, limit: int) -> List[List[Any]]:
+        now = time.time()
+        out: List[List[Any]] = []
+        with self._lock:
+            # El final del OrderedDict es lo usado más recientemente
+            for key in reversed(self._data):
+                expires_at, value = self._data[key]
+                if expires_at >= now:
+                    out.append([key, expires_at, value])
+                    if len(out) >= limit:
+                        break
+        return out
+
+    def restore(self, entries: List[List[Any]]) -> int:
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            # De la menos a la más usada, para que el orden LRU quede igual que al guardar
+            for key, expires_at, value in reversed(entries):
+                if expires_at < now or key in self._data:
+                    continue
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key, last=False)
+                loaded += 1
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return loaded
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Caché en un archivo SQLite compartido por los procesos del host.
+
+    Cada operación es una sentencia (atómica); con WAL las lecturas no esperan a
+    las escrituras de otros workers. El orden LRU es aproximado: un acierto
+    actualiza `last_used` como mucho cada `_TOUCH_INTERVAL_S`, y el tamaño se
+    recorta a `max_entries` cada `_EVICT_EVERY` escrituras de cada proceso. Un
+    error de SQLite (archivo bloqueado, disco lleno) cuenta como fallo de caché
+    y nunca llega a la petición.
+    """
+
+    _TOUCH_INTERVAL_S = 60.0
+    _EVICT_EVERY = 64
+
+    def __init__(self, path: str, max_entries: int = 1000, default_ttl_s: float = 3600.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.default_ttl_s = default_ttl_s
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_last_used ON response_cache (last_used)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una conexión por hilo y por proceso (un worker creado con fork no reusa la del padre)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str, *, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, expires_at, last_used FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            value, expires_at, last_used = row
+            if expires_at < now and not allow_stale:
+                CACHE_LOOKUPS.inc(result="expired")
+                return None
+            if now - last_used > self._TOUCH_INTERVAL_S:
+                conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.debug("Caché SQLite no disponible (get): %s", e)
+            CACHE_LOOKUPS.inc(result="error")
+            return None
+        CACHE_LOOKUPS.inc(result="stale" if expires_at < now else "hit")
+        return loads(value)
+
+    def set(self, key: str, value: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        ttl = self.default_ttl_s if ttl_s is None else ttl_s
+        now = time.time()
+        with self._writes_lock:
+            self._writes += 1
+            evict = self._writes % self._EVICT_EVERY == 0
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, dumps(value), now + ttl, now),
+            )
+            if evict:
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logger.debug("Caché SQLite no disponible (set): %s", e)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Borra las entradas menos usadas por encima de max_entries."""
+        conn.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        try:
+            self._conn().execute("DELETE FROM response_cache")
+        except sqlite3.Error as e:
+            logger.debug("Caché SQLite no disponible (clear): %s", e)
+
+    def snapshot(self, limit: int) -> List[List[Any]]:
+        try:
+            rows = self._conn().execute(
+                "SELECT key, expires_at, value FROM response_cache WHERE expires_at >= ? "
+                "ORDER BY last_used DESC LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.debug("Caché SQLite no disponible (snapshot): %s", e)
+            return []
+        return [[key, expires_at, loads(value)] for key, expires_at, value in rows]
+
+    def restore(self, entries: List[List[Any]]) -> int:
+        now = time.time()
+        rows = [
+            # De la más a la menos usada: last_used decreciente conserva el orden LRU
+            (key, dumps(value), expires_at, now - i * 1e-6)
+            for i, (key, expires_at, value) in enumerate(entries)
+            if expires_at >= now
+        ]
+        if not rows:
+            return 0
+        try:
+            conn = self._conn()
+            # Las entradas que ya están (de otro worker) tienen precedencia
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO response_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            loaded = conn.total_changes - before
+            self._evict(conn)
+        except sqlite3.Error as e:
+            logger.debug("Caché SQLite no disponible (restore): %s", e)
+            return 0
+        return loaded
+
+    def __len__(self) -> int:
+        try:
+            return self._conn().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Caché compartida del proceso (o de todos los procesos, con el backend sqlite)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                settings = get_settings()
+                backend = (settings.response_cache_backend or MEMORY).strip().lower()
+                if backend not in (MEMORY, SQLITE):
+                    raise ValueError(f"Backend de caché desconocido: {backend}")
+                if backend == SQLITE:
+                    try:
+                        _cache = SQLiteResponseCache(
+                            settings.response_cache_path,
+                            max_entries=settings.response_cache_max_entries,
+                            default_ttl_s=settings.response_cache_ttl_s,
+                        )
+                    except (OSError, sqlite3.Error) as e:
+                        # Ruta no escribible o archivo corrupto: caché por proceso antes que un 5xx por petición
+                        logger.warning(
+                            "Caché SQLite no disponible en %s (%s); se usa la caché en memoria",
+                            settings.response_cache_path,
+                            e,
+                        )
+                if _cache is None:
+                    _cache = MemoryResponseCache(
+                        max_entries=settings.response_cache_max_entries,
+                        default_ttl_s=settings.response_cache_ttl_s,
+                    )
+    return _cache
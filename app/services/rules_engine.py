@@ -0,0 +1,403 @@
+"""
+Motor de reglas de rangos orientativos por cultivo × etapa × parámetro.
+
+Las reglas viven en un archivo de datos versionado (app/rules/crop_ranges.json) y
+se cargan una sola vez por proceso. Cada regla se compila en una lista ordenada de
+límites (crítico mínimo, mínimo, máximo, crítico máximo) sobre la que se ubica el
+valor con bisect; la unidad de la lectura se normaliza antes a la unidad canónica
+del parámetro (°F → °C, µS/cm → dS/m, fracción → %, hPa → kPa...).
+
+La búsqueda va de lo más específico a lo más genérico: (cultivo, etapa),
+(cultivo, cualquier etapa), (cualquier cultivo, etapa) y finalmente el rango
+genérico. Solo las coincidencias por cultivo con unidad reconocida se consideran
+confiables para responder sin llamar al modelo (RULES_FIRST).
+"""
+from __future__ import annotations
+
+import json
+import math
+import re
+import threading
+import unicodedata
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.schemas.responses import Recommendation, TargetRange
+from app.utils.metrics import REGISTRY
+
+DEFAULT_RULES_PATH = Path(__file__).resolve().parents[1] / "rules" / "crop_ranges.json"
+
+ANY = "*"
+
+RULE_EVALUATIONS = REGISTRY.counter(
+    "agro_rule_evaluations_total",
+    "Evaluaciones del motor de reglas por resultado.",
+    ("result",),
+)
+
+_BAND_ACTIONS = {
+    "muy_bajo": "aumentar",
+    "bajo": "aumentar",
+    "optimo": "mantener",
+    "alto": "disminuir",
+    "muy_alto": "disminuir",
+}
+
+_GENERIC_WARNING = (
+    "Rangos genéricos de referencia; ajustar según cultivo, etapa fenológica, tipo de suelo y sistema de manejo."
+)
+
+
+# Los valores de cultivo/etapa/unidad se repiten mucho: se memoriza la normalización
+@lru_cache(maxsize=4096)
+def _norm_text(value: str) -> str:
+    """Minúsculas, sin tildes y con espacios colapsados."""
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def _norm_unit(unit: str) -> str:
+    # No se usa NFKD: convertiría "º" en "o" y "µ" en "μ"
+    return unit.strip().lower().replace(" ", "").replace("º", "°").replace("μ", "µ")
+
+
+@dataclass(frozen=True)
+class RangeRule:
+    crop: str
+    stage: str
+    parameter: str
+    min: Optional[float]
+    max: Optional[float]
+    critical_min: Optional[float] = None
+    critical_max: Optional[float] = None
+    # Compilado: límites ordenados y la banda correspondiente a cada intervalo
+    bounds: Tuple[float, ...] = ()
+    bands: Tuple[str, ...] = ()
+
+    @classmethod
+    def compile(cls, data: Dict[str, Any]) -> "RangeRule":
+        lo, hi = data.get("min"), data.get("max")
+        cmin, cmax = data.get("critical_min"), data.get("critical_max")
+        if lo is not None and hi is not None and lo > hi:
+            raise ValueError(f"Regla inválida (min > max): {data}")
+        bounds: List[float] = []
+        bands: List[str] = []
+        if cmin is not None:
+            bands.append("muy_bajo")
+            bounds.append(float(cmin))
+        if lo is not None:
+            bands.append("bajo")
+            bounds.append(float(lo))
+        bands.append("optimo")
+        # Los máximos son inclusivos: el límite real es el siguiente flotante
+        if hi is not None:
+            bounds.append(math.nextafter(float(hi), math.inf))
+            bands.append("alto")
+        if cmax is not None:
+            bounds.append(math.nextafter(float(cmax), math.inf))
+            bands.append("muy_alto")
+        if bounds != sorted(bounds):
+            raise ValueError(f"Regla inválida (límites desordenados): {data}")
+        return cls(
+            crop=data.get("crop") or ANY,
+            stage=data.get("stage") or ANY,
+            parameter=data["parameter"],
+            min=lo,
+            max=hi,
+            critical_min=cmin,
+            critical_max=cmax,
+            bounds=tuple(bounds),
+            bands=tuple(bands),
+        )
+
+    @property
+    def has_range(self) -> bool:
+        return self.min is not None or self.max is not None
+
+    def band(self, value: float) -> Optional[str]:
+        if not self.has_range:
+            return None
+        return self.bands[bisect_right(self.bounds, value)]
+
+    @property
+    def specificity(self) -> str:
+        if self.crop != ANY:
+            return "crop_stage" if self.stage != ANY else "crop"
+        return "stage" if self.stage != ANY else "generic"
+
+
+@dataclass(frozen=True)
+class NormalizedValue:
+    value: float
+    unit: Optional[str]
+    # ok: unidad reconocida | assumed: sin unidad, se asume la canónica | unknown: no convertible
+    status: str
+
+
+@dataclass
+class RuleMatch:
+    parameter: str
+    label: str
+    observed: float
+    observed_unit: Optional[str]
+    normalized: NormalizedValue
+    rule: RangeRule
+    band: Optional[str]
+    crop: Optional[str]
+    stage: Optional[str]
+    # Nombres para mostrar de la regla aplicada (p. ej. "maíz", "floración")
+    crop_name: Optional[str] = None
+    stage_name: Optional[str] = None
+    warnings: Tuple[str, ...] = ()
+
+    @property
+    def action(self) -> str:
+        return _BAND_ACTIONS.get(self.band or "", "mantener")
+
+    @property
+    def confident(self) -> bool:
+        """Regla específica del cultivo, con rango y unidad reconocida."""
+        return (
+            self.rule.has_range
+            and self.rule.crop != ANY
+            and self.normalized.status == "ok"
+        )
+
+    def to_recommendation(self) -> Recommendation:
+        rule = self.rule
+        norm = self.normalized
+        unit = norm.unit if norm.status != "unknown" else self.observed_unit
+        u = f" {unit}" if unit else ""
+
+        observed = f"{self.observed}{' ' + self.observed_unit if self.observed_unit else ''}"
+        if norm.status == "ok" and norm.value != self.observed:
+            observed += f" ≈ {norm.value}{u}"
+        if rule.min is not None and rule.max is not None:
+            rationale = f"El valor observado ({observed}) se compara con un rango orientativo de {rule.min}–{rule.max}{u}."
+        elif rule.min is not None:
+            rationale = f"El valor observado ({observed}) se compara con un mínimo orientativo de {rule.min}{u}."
+        elif rule.max is not None:
+            rationale = f"El valor observado ({observed}) se compara con un máximo orientativo de {rule.max}{u}."
+        else:
+            rationale = "No hay rango genérico confiable; se sugiere monitoreo adicional y contextualizar según cultivo y etapa."
+        if self.band in ("muy_bajo", "muy_alto"):
+            rationale += " La lectura está fuera del umbral crítico; conviene verificar el sensor y actuar con prioridad."
+
+        warns: List[str] = []
+        if rule.crop == ANY:
+            warns.append(_GENERIC_WARNING)
+        else:
+            warns.append(
+                f"Rango orientativo para {self.crop_name or rule.crop} ({self.stage_name or 'cualquier etapa'}); "
+                "ajustar según tipo de suelo, clima y sistema de manejo."
+            )
+        if norm.status == "assumed" and norm.unit:
+            warns.append(f"No se indicó unidad; se asumió {norm.unit}.")
+        elif norm.status == "unknown":
+            warns.append(f"Unidad '{self.observed_unit}' no reconocida; se comparó el valor sin convertir.")
+        warns.extend(self.warnings)
+
+        return Recommendation(
+            action=self.action,
+            parameter=self.label,
+            target_range=TargetRange(min=rule.min, max=rule.max, unit=unit),
+            rationale=rationale,
+            warnings=warns,
+        )
+
+
+class RulesEngine:
+    def __init__(self, data: Dict[str, Any]):
+        self.version: str = str(data.get("version") or "0")
+
+        # Unidades: dimensión → alias normalizado → (escala, desplazamiento)
+        self._canonical: Dict[str, Optional[str]] = {}
+        self._unitless: set[str] = set()
+        self._conversions: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        for dim, spec in (data.get("units") or {}).items():
+            self._canonical[dim] = spec.get("canonical")
+            if spec.get("unitless"):
+                self._unitless.add(dim)
+            table: Dict[str, Tuple[float, float]] = {}
+            for conv in spec.get("conversions") or []:
+                for alias in conv["aliases"]:
+                    table[_norm_unit(alias)] = (float(conv.get("scale", 1.0)), float(conv.get("offset", 0.0)))
+            if spec.get("canonical"):
+                table.setdefault(_norm_unit(spec["canonical"]), (1.0, 0.0))
+            self._conversions[dim] = table
+
+        self._params: Dict[str, Dict[str, Any]] = {}
+        for name, spec in (data.get("parameters") or {}).items():
+            dim = spec.get("dimension")
+            if dim is not None and dim not in self._conversions:
+                raise ValueError(f"Parámetro {name}: dimensión desconocida {dim}")
+            self._params[name] = spec
+        self._param_aliases: Dict[str, str] = {_norm_text(k): v for k, v in (data.get("parameter_aliases") or {}).items()}
+        for name, spec in self._params.items():
+            self._param_aliases.setdefault(_norm_text(spec.get("label") or name), name)
+
+        # Cultivos y etapas: alias normalizado → clave; el primer alias es el nombre para mostrar
+        self._crops: Dict[str, str] = {}
+        self._names: Dict[str, str] = {}
+        for crop, aliases in (data.get("crops") or {}).items():
+            self._names[crop] = aliases[0] if aliases else crop
+            for alias in [crop, *aliases]:
+                self._crops[_norm_text(alias)] = crop
+
+        # Etapas: además de alias exactos, prefijos con numeración (p. ej. "v*" → V1, V6...)
+        self._stages: Dict[str, str] = {}
+        self._stage_prefixes: List[Tuple[re.Pattern[str], str]] = []
+        for stage, aliases in (data.get("stages") or {}).items():
+            self._names[stage] = aliases[0] if aliases else stage
+            for alias in [stage, *aliases]:
+                a = _norm_text(alias)
+                if a.endswith("*"):
+                    self._stage_prefixes.append((re.compile(rf"{re.escape(a[:-1])}\d+$"), stage))
+                else:
+                    self._stages[a] = stage
+
+        self._rules: Dict[Tuple[str, str, str], RangeRule] = {}
+        for raw in data.get("rules") or []:
+            rule = RangeRule.compile(raw)
+            if rule.parameter not in self._params:
+                raise ValueError(f"Regla con parámetro desconocido: {raw}")
+            key = (rule.crop, rule.stage, rule.parameter)
+            if key in self._rules:
+                raise ValueError(f"Regla duplicada: {key}")
+            self._rules[key] = rule
+
+    @classmethod
+    def from_file(cls, path: Path | str) -> "RulesEngine":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    # --- Normalización ---------------------------------------------------
+    def parameter(self, name: Optional[str]) -> Optional[str]:
+        if not name:
+            return None
+        if name in self._params:
+            return name
+        return self._param_aliases.get(_norm_text(name))
+
+    def label(self, name: Optional[str]) -> Optional[str]:
+        """Nombre en español del parámetro (o el mismo valor si no se conoce)."""
+        param = self.parameter(name)
+        if param is None:
+            return name
+        return self._params[param].get("label") or param
+
+    def crop(self, name: Optional[str]) -> Optional[str]:
+        if not name:
+            return None
+        text = _norm_text(name)
+        if text in self._crops:
+            return self._crops[text]
+        # "tomate cherry", "maíz amarillo": basta con que una palabra coincida
+        for word in text.split():
+            if word in self._crops:
+                return self._crops[word]
+        return None
+
+    def stage(self, name: Optional[str]) -> Optional[str]:
+        if not name:
+            return None
+        text = _norm_text(name)
+        if text in self._stages:
+            return self._stages[text]
+        for pattern, stage in self._stage_prefixes:
+            if pattern.match(text):
+                return stage
+        for word in text.split():
+            if word in self._stages:
+                return self._stages[word]
+        return None
+
+    def normalize(self, parameter: str, value: float, unit: Optional[str]) -> NormalizedValue:
+        dim = self._params.get(parameter, {}).get("dimension")
+        if dim is None:
+            # Parámetros sin dimensión definida (luz, nutrientes...): el valor se usa tal cual
+            return NormalizedValue(value, unit, "ok")
+        canonical = self._canonical.get(dim)
+        if not unit or not unit.strip():
+            status = "ok" if dim in self._unitless else "assumed"
+            return NormalizedValue(value, canonical, status)
+        conv = self._conversions[dim].get(_norm_unit(unit))
+        if conv is None:
+            return NormalizedValue(value, unit, "unknown")
+        scale, offset = conv
+        return NormalizedValue(round(value * scale + offset, 4), canonical, "ok")
+
+    # --- Búsqueda --------------------------------------------------------
+    def lookup(self, parameter: str, crop: Optional[str] = None, stage: Optional[str] = None) -> Optional[RangeRule]:
+        """Regla más específica para (cultivo, etapa, parámetro) ya normalizados."""
+        c = crop or ANY
+        s = stage or ANY
+        rules = self._rules
+        for key in ((c, s, parameter), (c, ANY, parameter), (ANY, s, parameter), (ANY, ANY, parameter)):
+            rule = rules.get(key)
+            if rule is not None:
+                return rule
+        return None
+
+    def evaluate(
+        self,
+        parameter: Optional[str],
+        value: Optional[float],
+        *,
+        unit: Optional[str] = None,
+        crop: Optional[str] = None,
+        stage: Optional[str] = None,
+    ) -> Optional[RuleMatch]:
+        """Ubica la lectura en las bandas de la regla aplicable (None si no hay regla)."""
+        param = self.parameter(parameter)
+        if param is None or value is None:
+            RULE_EVALUATIONS.inc(result="no_rule")
+            return None
+        crop_key = self.crop(crop)
+        stage_key = self.stage(stage)
+        rule = self.lookup(param, crop_key, stage_key)
+        if rule is None:
+            RULE_EVALUATIONS.inc(result="no_rule")
+            return None
+        norm = self.normalize(param, float(value), unit)
+        spec = self._params[param]
+        match = RuleMatch(
+            parameter=param,
+            label=spec.get("label") or param,
+            observed=float(value),
+            observed_unit=unit or None,
+            normalized=norm,
+            rule=rule,
+            band=rule.band(norm.value),
+            crop=crop_key,
+            stage=stage_key,
+            crop_name=self._names.get(rule.crop),
+            stage_name=self._names.get(rule.stage),
+            warnings=tuple(spec.get("warnings") or ()),
+        )
+        RULE_EVALUATIONS.inc(result="confident" if match.confident else rule.specificity)
+        return match
+
+
+_engine: Optional[RulesEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_rules_engine() -> RulesEngine:
+    """Motor compartido del proceso (se carga una vez desde RULES_PATH)."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                path = get_settings().rules_path or DEFAULT_RULES_PATH
+                _engine = RulesEngine.from_file(path)
+    return _engine
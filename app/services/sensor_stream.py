@@ -0,0 +1,328 @@
+"""
+Ingesta continua de lecturas de sensores con recomendaciones por cambio de estado.
+
+Los gateways envían lecturas sin pausa (NDJSON por chunks o WebSocket). Cada
+lectura se ubica en las bandas del motor de reglas (muy_bajo … muy_alto) y solo
+se pide una recomendación nueva cuando el (cultivo, parámetro) cambia de banda
+o de etapa; mientras tanto se reutiliza la última. Para no oscilar alrededor de
+un límite, el cambio de banda se acepta recién cuando el valor lo supera por un
+margen de SENSOR_STREAM_HYSTERESIS × ancho del rango óptimo. Los parámetros sin
+rango configurado usan el mismo umbral como variación relativa del valor.
+
+Así las llamadas al modelo escalan con los cambios de estado y no con la
+frecuencia de muestreo. Cada recomendación corre en su propia tarea: la conexión
+sigue leyendo y guardando lecturas mientras el modelo responde, y el evento sale
+cuando la tarea termina. Las lecturas se guardan en sensor_readings por lotes
+(SENSOR_STREAM_BATCH_SIZE filas o cada SENSOR_STREAM_FLUSH_S segundos).
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.config import get_settings
+from app.schemas.requests import AskRequest, SensorStreamReading
+from app.services.admission import model_slot
+from app.services.gemini_client import get_gemini_client
+from app.services.rules_engine import RuleMatch, get_rules_engine
+from app.utils.deadline import Deadline
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+logger = get_logger("agro.sensor_stream")
+
+STREAM_READINGS = REGISTRY.counter(
+    "agro_sensor_stream_readings_total",
+    "Lecturas recibidas por flujo continuo, según si dispararon una recomendación nueva.",
+    ("outcome",),
+)
+STREAM_STATES = REGISTRY.gauge(
+    "agro_sensor_stream_states",
+    "Pares (cultivo, parámetro) con estado de recomendación en memoria.",
+)
+
+
+@dataclass
+class StreamState:
+    """Última recomendación emitida para un (cultivo, parámetro)."""
+
+    band: Optional[str]
+    stage: Optional[str]
+    value: float  # valor normalizado de la lectura que la disparó
+    recommendation: Optional[Dict[str, Any]] = None
+    model: Optional[str] = None
+    updated_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class Decision:
+    key: Tuple[str, str]
+    # first | band_change | stage_change | value_change; None = se reutiliza la última
+    reason: Optional[str]
+    band: Optional[str]
+    state: StreamState
+
+
+class SensorStateTracker:
+    """Estado por (cultivo, parámetro) compartido por todas las conexiones del proceso."""
+
+    def __init__(self, hysteresis: float = 0.05, max_keys: int = 10_000):
+        self.hysteresis = hysteresis
+        self.max_keys = max_keys
+        self._states: "OrderedDict[Tuple[str, str], StreamState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _margin(self, match: RuleMatch) -> float:
+        rule = match.rule
+        if rule.min is not None and rule.max is not None and rule.max > rule.min:
+            return self.hysteresis * (rule.max - rule.min)
+        return self.hysteresis * abs(rule.min if rule.min is not None else rule.max or 1.0)
+
+    def observe(self, reading: SensorStreamReading, parameter: str) -> Decision:
+        """Decide si la lectura necesita una recomendación nueva (y reserva el cambio de estado)."""
+        engine = get_rules_engine()
+        match = engine.evaluate(parameter, reading.value, unit=reading.unit, crop=reading.crop, stage=reading.stage)
+        crop_key = engine.crop(reading.crop) or " ".join(reading.crop.lower().split())
+        stage_key = engine.stage(reading.stage) if reading.stage else None
+        key = (crop_key, match.parameter if match else parameter)
+        value = match.normalized.value if match else reading.value
+        band = match.band if match else None
+
+        with self._lock:
+            state = self._states.get(key)
+            reason = None
+            if state is None:
+                reason = "first"
+            elif stage_key != state.stage:
+                reason = "stage_change"
+            elif band is not None:
+                if band != state.band:
+                    # Cambio de banda con histéresis: el valor debe quedar a más de `margin` del límite
+                    margin = self._margin(match)
+                    if match.rule.band(value - margin) == band == match.rule.band(value + margin):
+                        reason = "band_change"
+            elif abs(value - state.value) > self.hysteresis * (abs(state.value) or 1.0):
+                reason = "value_change"
+
+            if reason is None:
+                self._states.move_to_end(key)
+            else:
+                # Se registra ya el nuevo estado (con la recomendación anterior mientras llega la nueva)
+                # para que otras lecturas del mismo par no disparen llamadas duplicadas
+                state = StreamState(
+                    band=band,
+                    stage=stage_key,
+                    value=value,
+                    recommendation=state.recommendation if state else None,
+                    model=state.model if state else None,
+                )
+                self._states[key] = state
+                self._states.move_to_end(key)
+                while len(self._states) > self.max_keys:
+                    self._states.popitem(last=False)
+            size = len(self._states)
+        STREAM_STATES.set(size)
+        return Decision(key=key, reason=reason, band=band, state=state)
+
+    def record(self, decision: Decision, recommendation: Optional[Dict[str, Any]], model: Optional[str]) -> None:
+        with self._lock:
+            decision.state.recommendation = recommendation
+            decision.state.model = model
+            decision.state.updated_at = time.monotonic()
+
+
+class SensorStream:
+    """Una conexión de ingesta: valida, decide, recomienda si hace falta y guarda por lotes."""
+
+    def __init__(
+        self,
+        db: Any,
+        tracker: SensorStateTracker,
+        *,
+        batch_size: int = 500,
+        flush_interval_s: float = 2.0,
+        max_months: int = 3,
+    ):
+        self.db = db
+        self.tracker = tracker
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_s = flush_interval_s
+        self.max_months = max(1, max_months)
+        # Meses (AAAAMM) de las lecturas de la conexión: cada uno puede crear una partición
+        self._months: Set[int] = set()
+        # Recomendaciones en curso y eventos listos para enviar (ready avisa que hay alguno)
+        self._tasks: Set["asyncio.Task[None]"] = set()
+        self._events: List[Dict[str, Any]] = []
+        self.ready = asyncio.Event()
+        self.stats: Counter = Counter()
+        self._buffer: List[Dict[str, Any]] = []
+        self._last_flush = time.monotonic()
+
+    async def _recommend(self, reading: SensorStreamReading) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        req = AskRequest(
+            crop=reading.crop,
+            stage=reading.stage,
+            parameter=reading.parameter,
+            value=reading.value,
+            unit=reading.unit,
+        )
+        client = get_gemini_client()
+        try:
+            async with model_slot():
+                resp = await run_in_threadpool(client.ask, req, Deadline(get_settings().timeout_s))
+            rec, model = resp.recommendation, resp.model
+        except Exception as e:
+            # Servicio saturado o modelo caído: la heurística del motor de reglas alcanza para el flujo
+            logger.warning("Recomendación por heurística en flujo de sensores: %s", e)
+            rec, model = client._heuristic_recommendation(req), f"rules:{get_rules_engine().version}"
+        return (rec.model_dump() if rec else None), model
+
+    async def handle(self, payload: Any) -> None:
+        """Procesa una lectura sin esperar al modelo: si hace falta una recomendación nueva,
+        la pide en una tarea y el evento queda en take_events() cuando termina.
+
+        Lanza pydantic.ValidationError si la lectura no es válida y ValueError si su mes
+        excede los que puede tocar una conexión (SENSOR_STREAM_MAX_MONTHS).
+        """
+        reading = SensorStreamReading.model_validate(payload)
+        if reading.timestamp is None:
+            reading.timestamp = datetime.utcnow()
+        month = reading.timestamp.year * 100 + reading.timestamp.month
+        if month not in self._months:
+            if len(self._months) >= self.max_months:
+                raise ValueError(f"timestamp: más de {self.max_months} meses distintos en una conexión")
+            self._months.add(month)
+        parameter = AskRequest._map_parameter(reading.parameter)
+        decision = self.tracker.observe(reading, parameter)
+        self.stats["received"] += 1
+        if decision.reason is not None:
+            task = asyncio.create_task(self._recommend_and_buffer(reading, parameter, decision))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            STREAM_READINGS.inc(outcome="reused")
+            self.stats["reused"] += 1
+            self._buffer_row(reading, parameter, decision.state.recommendation)
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval_s:
+            await self.flush()
+
+    async def _recommend_and_buffer(self, reading: SensorStreamReading, parameter: str, decision: Decision) -> None:
+        """Pide la recomendación, publica el evento y encola la lectura con esa recomendación."""
+        try:
+            rec, model = await self._recommend(reading)
+        except Exception as e:
+            # La lectura se guarda igual, con la recomendación anterior
+            logger.warning("Recomendación fallida en flujo de sensores: %s", e)
+            self._buffer_row(reading, parameter, decision.state.recommendation)
+            return
+        self.tracker.record(decision, rec, model)
+        STREAM_READINGS.inc(outcome="recommended")
+        self.stats["recommended"] += 1
+        self._events.append({
+            "type": "recommendation",
+            "reason": decision.reason,
+            "crop": reading.crop,
+            "stage": reading.stage,
+            "parameter": reading.parameter,
+            "value": reading.value,
+            "unit": reading.unit,
+            "band": decision.band,
+            "model": model,
+            "recommendation": rec,
+        })
+        self.ready.set()
+        self._buffer_row(reading, parameter, rec)
+
+    def _buffer_row(self, reading: SensorStreamReading, parameter: str, rec: Optional[Dict[str, Any]]) -> None:
+        rec = rec or {}
+        target = rec.get("target_range") or {}
+        self._buffer.append({
+            "timestamp": reading.timestamp,
+            "crop": reading.crop,
+            "stage": reading.stage,
+            "parameter": parameter,
+            "value": reading.value,
+            "unit": reading.unit,
+            "action": rec.get("action"),
+            "target_min": target.get("min"),
+            "target_max": target.get("max"),
+            "target_unit": target.get("unit"),
+            "rationale": rec.get("rationale"),
+        })
+
+    def take_events(self) -> List[Dict[str, Any]]:
+        """Eventos de recomendación ya listos (y los quita de la cola)."""
+        events, self._events = self._events, []
+        self.ready.clear()
+        return events
+
+    async def drain(self) -> List[Dict[str, Any]]:
+        """Espera las recomendaciones en curso (al cerrar la conexión) y devuelve los eventos pendientes."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        return self.take_events()
+
+    def cancel(self) -> None:
+        """Cancela las recomendaciones en curso (la respuesta ya no tiene a quién llegar)."""
+        for task in self._tasks:
+            task.cancel()
+
+    def invalid(self, line: int, detail: str) -> Dict[str, Any]:
+        STREAM_READINGS.inc(outcome="invalid")
+        self.stats["invalid"] += 1
+        return {"type": "error", "line": line, "detail": detail}
+
+    async def flush(self) -> None:
+        """Guarda las lecturas pendientes en un solo INSERT por lote."""
+        from app.db.history_service import HistoryService
+
+        rows, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if rows:
+            self.stats["stored"] += await run_in_threadpool(HistoryService.save_sensor_readings, self.db, rows)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "type": "summary",
+            "received": self.stats["received"],
+            "stored": self.stats["stored"],
+            "recommended": self.stats["recommended"],
+            "reused": self.stats["reused"],
+            "invalid": self.stats["invalid"],
+        }
+
+
+_tracker: Optional[SensorStateTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_sensor_tracker() -> SensorStateTracker:
+    """Estado de recomendaciones compartido del proceso."""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                settings = get_settings()
+                _tracker = SensorStateTracker(
+                    hysteresis=settings.sensor_stream_hysteresis,
+                    max_keys=settings.sensor_stream_max_keys,
+                )
+    return _tracker
+
+
+def open_stream(db: Any) -> SensorStream:
+    settings = get_settings()
+    return SensorStream(
+        db,
+        get_sensor_tracker(),
+        batch_size=settings.sensor_stream_batch_size,
+        flush_interval_s=settings.sensor_stream_flush_s,
+        max_months=settings.sensor_stream_max_months,
+    )
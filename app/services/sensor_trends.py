@@ -0,0 +1,405 @@
+"""
+Estadísticas móviles y tendencia por (cultivo, parámetro) de las lecturas de sensores.
+
+Para cada par se mantiene en memoria una ventana de las últimas
+SENSOR_TRENDS_WINDOW lecturas con sumas acumuladas, de modo que cada lectura
+nueva actualiza en O(1) la media, el desvío, la pendiente (regresión lineal
+sobre el tiempo, por hora) y el z-score de la última lectura; el mínimo y el
+máximo de la ventana usan colas monótonas. La EWMA (SENSOR_TRENDS_ALPHA)
+recorre todas las lecturas, no solo la ventana.
+
+El estado se reconstruye desde sensor_readings la primera vez que se consulta
+(últimas SENSOR_TRENDS_LOOKBACK_H horas; la EWMA se vectoriza con NumPy si está
+instalado) y después se actualiza con cada lectura guardada. Es por proceso: con
+varios workers, cada uno ve las lecturas que guardó desde su reconstrucción.
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+try:  # dependencia opcional: solo acelera la reconstrucción
+    import numpy as np
+except ImportError:  # pragma: no cover - depende del entorno
+    np = None  # type: ignore[assignment]
+
+logger = get_logger("agro.sensor_trends")
+
+TRENDS_SECONDS = REGISTRY.histogram(
+    "agro_sensor_trends_seconds",
+    "Tiempo de reconstrucción y actualización de las estadísticas de sensores.",
+    ("op",),
+    buckets=(0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+TRENDS_SERIES = REGISTRY.gauge(
+    "agro_sensor_trends_series",
+    "Pares (cultivo, parámetro) con estadísticas en memoria.",
+)
+
+# Tope de pares en memoria (el cultivo es texto libre del cliente)
+_MAX_SERIES = 10_000
+# Cada cuántas ventanas se recalculan las sumas desde cero (evita la deriva numérica)
+_RESUM_WINDOWS = 16
+_REBUILD_BATCH = 10_000
+
+
+def _ewma(values: Sequence[float], alpha: float, start: Optional[float] = None) -> Optional[float]:
+    """EWMA de una serie (ponderación exponencial vectorizada si hay NumPy)."""
+    if not len(values):
+        return start
+    if np is not None:
+        v = np.asarray(values, dtype=float)
+        n = len(v)
+        weights = alpha * (1.0 - alpha) ** np.arange(n - 1, -1, -1, dtype=float)
+        # El primer valor (o el estado previo) se lleva el peso restante
+        carry = (1.0 - alpha) ** n if start is not None else (1.0 - alpha) ** (n - 1)
+        if start is None:
+            weights[0] = carry
+            return float(weights @ v)
+        return float(weights @ v + carry * start)
+    acc = start
+    for x in values:
+        acc = x if acc is None else acc + alpha * (x - acc)
+    return acc
+
+
+class TrendState:
+    """Ventana deslizante de un (cultivo, parámetro) con sumas acumuladas."""
+
+    __slots__ = (
+        "window", "alpha", "points", "t0", "s_t", "s_v", "s_tt", "s_tv", "s_vv",
+        "_minq", "_maxq", "seq", "ewma", "unit", "crop", "parameter", "last_ts",
+    )
+
+    def __init__(self, window: int, alpha: float, crop: str = "", parameter: str = ""):
+        self.window = max(2, window)
+        self.alpha = alpha
+        self.crop = crop
+        self.parameter = parameter
+        self.points: Deque[Tuple[datetime, float]] = deque()
+        self.t0: Optional[datetime] = None
+        self.s_t = self.s_v = self.s_tt = self.s_tv = self.s_vv = 0.0
+        self._minq: Deque[Tuple[int, float]] = deque()
+        self._maxq: Deque[Tuple[int, float]] = deque()
+        self.seq = 0  # lecturas observadas en total
+        self.ewma: Optional[float] = None
+        self.unit: Optional[str] = None
+        self.last_ts: Optional[datetime] = None
+
+    def _hours(self, ts: datetime) -> float:
+        return (ts - self.t0).total_seconds() / 3600.0
+
+    def _resum(self) -> None:
+        """Recalcula las sumas con el origen de tiempo en la lectura más vieja de la ventana."""
+        self.t0 = self.points[0][0]
+        self.s_t = self.s_v = self.s_tt = self.s_tv = self.s_vv = 0.0
+        for ts, v in self.points:
+            t = self._hours(ts)
+            self.s_t += t
+            self.s_v += v
+            self.s_tt += t * t
+            self.s_tv += t * v
+            self.s_vv += v * v
+
+    def observe(self, ts: datetime, value: float, unit: Optional[str] = None) -> None:
+        if self.t0 is None:
+            self.t0 = ts
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        if len(self.points) == self.window:
+            old_ts, old_v = self.points.popleft()
+            t = self._hours(old_ts)
+            self.s_t -= t
+            self.s_v -= old_v
+            self.s_tt -= t * t
+            self.s_tv -= t * old_v
+            self.s_vv -= old_v * old_v
+        t = self._hours(ts)
+        self.points.append((ts, value))
+        self.s_t += t
+        self.s_v += value
+        self.s_tt += t * t
+        self.s_tv += t * value
+        self.s_vv += value * value
+
+        i = self.seq
+        while self._minq and self._minq[-1][1] >= value:
+            self._minq.pop()
+        self._minq.append((i, value))
+        while self._maxq and self._maxq[-1][1] <= value:
+            self._maxq.pop()
+        self._maxq.append((i, value))
+        oldest = i - self.window
+        while self._minq[0][0] <= oldest:
+            self._minq.popleft()
+        while self._maxq[0][0] <= oldest:
+            self._maxq.popleft()
+
+        self.seq += 1
+        if unit:
+            self.unit = unit
+        if self.last_ts is None or ts > self.last_ts:
+            self.last_ts = ts
+        if self.seq % (self.window * _RESUM_WINDOWS) == 0:
+            self._resum()
+
+    @classmethod
+    def from_series(
+        cls,
+        window: int,
+        alpha: float,
+        times: Sequence[datetime],
+        values: Sequence[float],
+        *,
+        crop: str = "",
+        parameter: str = "",
+        unit: Optional[str] = None,
+    ) -> "TrendState":
+        """Estado tras observar toda la serie: la EWMA de las lecturas previas a la ventana va en bloque."""
+        state = cls(window, alpha, crop, parameter)
+        head = max(0, len(values) - state.window)
+        if head:
+            state.ewma = _ewma(values[:head], alpha)
+            state.seq = head
+        for ts, v in zip(times[head:], values[head:]):
+            state.observe(ts, v)
+        state.unit = unit
+        return state
+
+    def snapshot(self) -> Dict[str, Any]:
+        n = len(self.points)
+        mean = self.s_v / n
+        std = math.sqrt(max(self.s_vv / n - mean * mean, 0.0))
+        last_ts, last = self.points[-1]
+        mean_t = self.s_t / n
+        var_t = self.s_tt / n - mean_t * mean_t
+        slope = (self.s_tv / n - mean_t * mean) / var_t if var_t > 1e-12 else None
+        span_h = self._hours(last_ts) - self._hours(self.points[0][0])
+        zscore = (last - mean) / std if std > 1e-12 else None
+        # Tendencia: el cambio ajustado a lo largo de la ventana supera un desvío de las lecturas
+        trend = "estable"
+        if slope is not None and n >= 3 and abs(slope * span_h) > max(std, 1e-12):
+            trend = "subiendo" if slope > 0 else "bajando"
+        return {
+            "crop": self.crop,
+            "parameter": self.parameter,
+            "unit": self.unit,
+            "count": n,
+            "observed": self.seq,
+            "last": {"value": last, "timestamp": last_ts},
+            "ewma": self.ewma,
+            "mean": mean,
+            "std": std,
+            "min": self._minq[0][1],
+            "max": self._maxq[0][1],
+            "slope_per_hour": slope,
+            "window_hours": span_h,
+            "zscore": zscore,
+            "trend": trend,
+        }
+
+
+def _crop_key(crop: Optional[str]) -> str:
+    from app.services.rules_engine import get_rules_engine
+
+    text = " ".join((crop or "").lower().split())
+    return get_rules_engine().crop(text) or text
+
+
+def _parameter_key(parameter: Optional[str]) -> str:
+    from app.schemas.requests import AskRequest
+
+    return AskRequest._map_parameter(" ".join((parameter or "").lower().split())) or ""
+
+
+class SensorTrends:
+    """Estadísticas de todas las series del proceso."""
+
+    def __init__(self, *, window: int = 120, alpha: float = 0.2, lookback_h: float = 168.0):
+        self.window = window
+        self.alpha = alpha
+        self.lookback_h = lookback_h
+        self._series: Dict[Tuple[str, str], TrendState] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # empty: aún no se reconstruyó (las lecturas nuevas ya están en la base)
+        # loading: las lecturas se guardan aparte y se aplican al terminar si no entraron en la lectura
+        self._status = "empty"
+        self._pending: List[Tuple[int, str, str, str, str, float, Optional[str], datetime]] = []
+
+    @staticmethod
+    def key(crop: Optional[str], parameter: Optional[str]) -> Tuple[str, str]:
+        return _crop_key(crop), _parameter_key(parameter)
+
+    @property
+    def ready(self) -> bool:
+        return self._status == "ready"
+
+    def _apply(self, key: Tuple[str, str], crop: str, parameter: str, value: float, unit: Optional[str], ts: datetime) -> None:
+        state = self._series.get(key)
+        if state is None:
+            if len(self._series) >= _MAX_SERIES:
+                return
+            state = self._series[key] = TrendState(self.window, self.alpha, crop, parameter)
+        state.observe(ts, value, unit)
+
+    def observe_many(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Actualiza con lecturas ya guardadas (dicts con id, crop, parameter, value, unit y timestamp)."""
+        if self._status == "empty":
+            return
+        start = time.perf_counter()
+        items = []
+        for r in rows:
+            if r.get("value") is None:
+                continue
+            key = self.key(r.get("crop"), r.get("parameter"))
+            items.append((
+                r.get("id") or 0, key[0], key[1], r.get("crop") or "", r.get("parameter") or "",
+                float(r["value"]), r.get("unit"), r.get("timestamp") or datetime.utcnow(),
+            ))
+        with self._lock:
+            if self._status == "loading":
+                self._pending.extend(items)
+                return
+            for _, c, p, crop, parameter, value, unit, ts in items:
+                self._apply((c, p), crop, parameter, value, unit, ts)
+            size = len(self._series)
+        TRENDS_SERIES.set(size)
+        TRENDS_SECONDS.observe(time.perf_counter() - start, op="update")
+
+    def observe(self, reading: Any) -> None:
+        """Actualiza con una fila de sensor_readings recién guardada."""
+        self.observe_many([{
+            "id": reading.id,
+            "crop": reading.crop,
+            "parameter": reading.parameter,
+            "value": reading.value,
+            "unit": reading.unit,
+            "timestamp": reading.timestamp,
+        }])
+
+    @staticmethod
+    def _iter_rows(db: Any, tables: Sequence[Any], since: datetime) -> Iterable[Any]:
+        from sqlalchemy import select
+
+        for table in tables:
+            stmt = (
+                select(table.c.id, table.c.crop, table.c.parameter, table.c.value, table.c.unit, table.c.timestamp)
+                .where(table.c.timestamp >= since, table.c.value.is_not(None))
+                .order_by(table.c.id)
+                .execution_options(yield_per=_REBUILD_BATCH)
+            )
+            yield from db.execute(stmt)
+
+    def rebuild(self, db: Any) -> int:
+        """Reconstruye todas las series desde las particiones de sensor_readings (últimas lookback_h horas)."""
+        from app.db.history_service import HistoryService
+
+        start = time.perf_counter()
+        with self._lock:
+            self._status = "loading"
+            self._pending = []
+        groups: Dict[Tuple[str, str], Tuple[List[datetime], List[float], List[Any]]] = {}
+        max_id = 0
+        rows = 0
+        try:
+            since = datetime.utcnow() - timedelta(hours=self.lookback_h)
+            keys: Dict[Tuple[Optional[str], Optional[str]], Tuple[str, str]] = {}
+            # Particiones de la más antigua a la más nueva: los ids crecen de una a la siguiente
+            for rid, crop, parameter, value, unit, ts in self._iter_rows(db, HistoryService.sensor_tables(db, since), since):
+                raw = (crop, parameter)
+                key = keys.get(raw)
+                if key is None:
+                    key = keys[raw] = self.key(crop, parameter)
+                group = groups.get(key)
+                if group is None:
+                    if len(groups) >= _MAX_SERIES:
+                        continue
+                    group = groups[key] = ([], [], [crop or "", parameter or "", None])
+                group[0].append(ts)
+                group[1].append(value)
+                if unit:
+                    group[2][2] = unit
+                max_id = rid
+                rows += 1
+            series = {
+                key: TrendState.from_series(
+                    self.window, self.alpha, times, values, crop=meta[0], parameter=meta[1], unit=meta[2]
+                )
+                for key, (times, values, meta) in groups.items()
+            }
+        except Exception:
+            with self._lock:
+                self._status = "empty"
+                self._pending = []
+            raise
+        with self._lock:
+            self._series = series
+            # Lecturas guardadas durante la reconstrucción que la consulta no alcanzó a ver
+            for rid, c, p, crop, parameter, value, unit, ts in sorted(self._pending, key=lambda it: it[0]):
+                if rid > max_id:
+                    self._apply((c, p), crop, parameter, value, unit, ts)
+            self._pending = []
+            self._status = "ready"
+            size = len(self._series)
+        TRENDS_SERIES.set(size)
+        elapsed = time.perf_counter() - start
+        TRENDS_SECONDS.observe(elapsed, op="rebuild")
+        logger.info("Tendencias de sensores reconstruidas: %d lecturas, %d series en %.2f s", rows, size, elapsed)
+        return rows
+
+    def ensure_loaded(self, db: Any) -> None:
+        if self._status == "ready":
+            return
+        with self._load_lock:
+            if self._status != "ready":
+                self.rebuild(db)
+
+    def peek(self, crop: Optional[str], parameter: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Estadísticas de una serie si ya están en memoria (no toca la base)."""
+        if not self.ready or not parameter:
+            return None
+        key = self.key(crop, parameter)
+        with self._lock:
+            state = self._series.get(key)
+            return state.snapshot() if state is not None and state.points else None
+
+    def query(self, db: Any, crop: Optional[str] = None, parameter: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Estadísticas de las series que coinciden con los filtros (reconstruye si hace falta)."""
+        self.ensure_loaded(db)
+        crop_key = _crop_key(crop) if crop else None
+        param_key = _parameter_key(parameter) if parameter else None
+        with self._lock:
+            out = [
+                state.snapshot()
+                for (c, p), state in self._series.items()
+                if state.points and (crop_key is None or c == crop_key) and (param_key is None or p == param_key)
+            ]
+        out.sort(key=lambda s: (s["crop"], s["parameter"]))
+        return out
+
+
+_trends: Optional[SensorTrends] = None
+_trends_lock = threading.Lock()
+
+
+def get_sensor_trends() -> SensorTrends:
+    """Estadísticas de sensores compartidas del proceso."""
+    global _trends
+    if _trends is None:
+        with _trends_lock:
+            if _trends is None:
+                settings = get_settings()
+                _trends = SensorTrends(
+                    window=settings.sensor_trends_window,
+                    alpha=settings.sensor_trends_alpha,
+                    lookback_h=settings.sensor_trends_lookback_h,
+                )
+    return _trends
@@ -0,0 +1,241 @@
+"""
+Sesiones de chat multi-turno con contexto acotado.
+
+El cliente abre una sesión (POST /v1/agro/sessions) y envía `session_id` en
+/v1/agro/chat. Los turnos se guardan en chat_history y el prompt de cada
+seguimiento incluye la conversación previa: los turnos recientes completos y,
+para los más viejos, un resumen acumulado (una línea por turno). Cuando el
+contexto supera SESSION_CONTEXT_TOKENS, los turnos más antiguos se pliegan en el
+resumen, que a su vez se limita a SESSION_SUMMARY_TOKENS descartando sus líneas
+más viejas. El resumen se persiste en chat_sessions.
+
+El estado de cada sesión se cachea en memoria (LRU con TTL): un seguimiento no
+vuelve a leer la conversación de SQLite. Antes de usar la copia en caché se
+compara el último chat_history.id de la sesión con el último que conoce la copia
+(una búsqueda en el índice); si otro proceso escribió un turno, la sesión se
+recarga. Al registrar un turno se leen también los turnos ajenos posteriores al
+último conocido, así que una compactación nunca salta un turno que no vio.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+from app.config import get_settings
+from app.utils.metrics import REGISTRY
+
+SESSION_EVENTS = REGISTRY.counter(
+    "agro_session_events_total",
+    "Eventos de las sesiones de chat (hit/stale/load/miss en caché, create, compact).",
+    ("event",),
+)
+SESSION_CONTEXT_TOKENS = REGISTRY.histogram(
+    "agro_session_context_tokens",
+    "Tokens estimados del contexto de sesión agregado al prompt.",
+    buckets=(0, 100, 250, 500, 1000, 1500, 2000, 3000, 4000),
+)
+
+# Recortes de cada turno al armar el contexto y el resumen (caracteres)
+_TURN_QUESTION_CHARS = 600
+_TURN_ANSWER_CHARS = 1200
+_SUMMARY_QUESTION_CHARS = 160
+_SUMMARY_ANSWER_CHARS = 240
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens (~4 caracteres por token), sin llamar al tokenizador del modelo."""
+    return (len(text) + 3) // 4
+
+
+def _clip(text: str, max_chars: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= max_chars else text[: max_chars - 3] + "..."
+
+
+def _first_sentence(text: str) -> str:
+    text = " ".join((text or "").split())
+    for sep in (". ", "? ", "! "):
+        idx = text.find(sep)
+        if idx > 0:
+            text = text[: idx + 1]
+    return text
+
+
+@dataclass
+class Turn:
+    chat_id: int
+    question: str
+    answer: str
+
+
+@dataclass
+class SessionState:
+    session_id: str
+    summary: str = ""
+    summarized_through: int = 0
+    turns: List[Turn] = field(default_factory=list)
+    # Último chat_history.id de la sesión que refleja este estado (turnos o resumen)
+    last_chat_id: int = 0
+    loaded_at: float = field(default_factory=time.monotonic)
+    # Serializa la actualización de turnos y resumen (dos pestañas enviando a la vez)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+
+class SessionStore:
+    """Caché en memoria de sesiones sobre SQLite como almacenamiento durable."""
+
+    def __init__(
+        self,
+        *,
+        max_sessions: int = 1000,
+        ttl_s: float = 1800.0,
+        context_tokens: int = 2000,
+        summary_tokens: int = 500,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        self.context_tokens = context_tokens
+        self.summary_tokens = summary_tokens
+        self._cache: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, state: SessionState) -> None:
+        with self._lock:
+            self._cache[state.session_id] = state
+            self._cache.move_to_end(state.session_id)
+            while len(self._cache) > self.max_sessions:
+                self._cache.popitem(last=False)
+
+    def create(self, db: Any) -> SessionState:
+        from app.db.session_service import SessionService
+
+        row = SessionService.create(db)
+        state = SessionState(session_id=row.id)
+        self._remember(state)
+        SESSION_EVENTS.inc(event="create")
+        return state
+
+    def get(self, db: Any, session_id: str) -> Optional[SessionState]:
+        """Estado de la sesión desde la caché o, si no está, venció u otro proceso agregó turnos, desde SQLite.
+
+        None si la sesión no existe.
+        """
+        from app.db.session_service import SessionService
+
+        with self._lock:
+            state = self._cache.get(session_id)
+            if state is not None and time.monotonic() - state.loaded_at > self.ttl_s:
+                state = None
+        if state is not None:
+            if SessionService.last_turn_id(db, session_id) <= state.last_chat_id:
+                with self._lock:
+                    if session_id in self._cache:
+                        self._cache.move_to_end(session_id)
+                SESSION_EVENTS.inc(event="hit")
+                return state
+            SESSION_EVENTS.inc(event="stale")
+
+        row = SessionService.get(db, session_id)
+        if row is None:
+            SESSION_EVENTS.inc(event="miss")
+            return None
+        rows = SessionService.turns_after(db, session_id, row.summarized_through or 0)
+        state = SessionState(
+            session_id=session_id,
+            summary=row.summary or "",
+            summarized_through=row.summarized_through or 0,
+            turns=[Turn(r.id, r.question or "", r.answer or "") for r in rows],
+        )
+        state.last_chat_id = max([state.summarized_through] + [t.chat_id for t in state.turns])
+        SESSION_EVENTS.inc(event="load")
+        # Turnos que se acumularon sin compactar (p. ej. escritos por otro proceso)
+        if self._compact(state):
+            SessionService.save_summary(db, session_id, state.summary, state.summarized_through)
+        self._remember(state)
+        return state
+
+    @staticmethod
+    def _render_turns(turns: List[Turn]) -> List[str]:
+        return [
+            f"Usuario: {_clip(t.question, _TURN_QUESTION_CHARS)}\nAsistente: {_clip(t.answer, _TURN_ANSWER_CHARS)}"
+            for t in turns
+        ]
+
+    def _render(self, state: SessionState) -> str:
+        parts: List[str] = []
+        if state.summary:
+            parts.append("Resumen de turnos anteriores:\n" + state.summary)
+        parts.extend(self._render_turns(state.turns))
+        return "\n\n".join(parts)
+
+    def context(self, state: SessionState) -> Optional[str]:
+        """Conversación previa para el prompt (resumen + turnos recientes); None si la sesión está vacía."""
+        text = self._render(state)
+        if not text:
+            return None
+        SESSION_CONTEXT_TOKENS.observe(estimate_tokens(text))
+        return text
+
+    def _fold(self, summary: str, turn: Turn) -> str:
+        line = (
+            f"- {_clip(turn.question, _SUMMARY_QUESTION_CHARS)} → "
+            f"{_clip(_first_sentence(turn.answer), _SUMMARY_ANSWER_CHARS)}"
+        )
+        lines = [ln for ln in summary.splitlines() if ln] + [line]
+        # El resumen también tiene presupuesto: se pierden primero los turnos más viejos
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def _compact(self, state: SessionState) -> bool:
+        """Pliega en el resumen los turnos más antiguos hasta que el contexto entre en el presupuesto."""
+        changed = False
+        while len(state.turns) > 1 and estimate_tokens(self._render(state)) > self.context_tokens:
+            turn = state.turns.pop(0)
+            state.summary = self._fold(state.summary, turn)
+            state.summarized_through = turn.chat_id
+            changed = True
+        if changed:
+            SESSION_EVENTS.inc(event="compact")
+        return changed
+
+    def record(self, db: Any, state: SessionState, chat_id: int, question: str, answer: str) -> None:
+        """Agrega el turno ya guardado en chat_history y persiste el resumen si hubo compactación.
+
+        También agrega los turnos que otro proceso escribió desde el último conocido (normalmente
+        ninguno), en orden de id, para que la compactación no pase por encima de ellos.
+        """
+        from app.db.session_service import SessionService
+
+        with state.lock:
+            rows = SessionService.turns_after(db, state.session_id, state.last_chat_id)
+            turns = [Turn(r.id, r.question or "", r.answer or "") for r in rows]
+            if chat_id > state.last_chat_id and all(t.chat_id != chat_id for t in turns):
+                turns.append(Turn(chat_id, question, answer))
+            state.turns.extend(sorted(turns, key=lambda t: t.chat_id))
+            state.last_chat_id = max([state.last_chat_id] + [t.chat_id for t in turns])
+            if self._compact(state):
+                SessionService.save_summary(db, state.session_id, state.summary, state.summarized_through)
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Caché de sesiones compartida del proceso."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = get_settings()
+                _store = SessionStore(
+                    max_sessions=settings.session_cache_size,
+                    ttl_s=settings.session_cache_ttl_s,
+                    context_tokens=settings.session_context_tokens,
+                    summary_tokens=settings.session_summary_tokens,
+                )
+    return _store
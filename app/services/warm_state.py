@@ -0,0 +1,176 @@
+"""
+Estado "tibio" persistido entre arranques en frío (p. ej. instancias nuevas en Vercel).
+
+Guarda en un archivo local (WARM_STATE_PATH, típicamente bajo /tmp) el modelo
+resuelto, el conjunto de modelos disponibles con la hora en que se consultó y,
+opcionalmente, las entradas más usadas de la caché de respuestas. Una instancia
+nueva lo lee al crear el cliente: evita el `list_models()` de la configuración
+mientras el snapshot esté vigente y arranca con parte de la caché caliente.
+
+El archivo es solo una optimización: si falta, está corrupto o es de otra versión
+se ignora, y los errores al escribirlo solo se registran en el log.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, List, Optional
+
+from app.config import get_settings
+from app.services.response_cache import get_response_cache
+from app.utils.jsonio import dumps, loads
+from app.utils.logger import get_logger
+from app.utils.metrics import REGISTRY
+
+logger = get_logger("agro.warm_state")
+
+# Sube si cambia el formato del archivo (los snapshots anteriores se descartan)
+FORMAT_VERSION = 1
+
+WARM_STATE_EVENTS = REGISTRY.counter(
+    "agro_warm_state_events_total",
+    "Lecturas y escrituras del snapshot de estado tibio.",
+    ("event",),
+)
+
+
+@dataclass
+class WarmState:
+    """Contenido del snapshot."""
+
+    requested_model: Optional[str] = None
+    model: Optional[str] = None
+    available_models: List[str] = field(default_factory=list)
+    models_checked_at: float = 0.0
+    # Entradas de la caché de respuestas: [clave, vence_en (epoch), valor]
+    cache_entries: List[List[Any]] = field(default_factory=list)
+
+    def models_fresh(self, requested: str, max_age_s: float) -> bool:
+        """True si la lista de modelos sirve para `requested` y no es más vieja que `max_age_s`."""
+        return (
+            bool(self.available_models)
+            and self.requested_model == requested
+            and time.time() - self.models_checked_at <= max_age_s
+        )
+
+
+def load_warm_state(path: Path) -> Optional[WarmState]:
+    """Lee el snapshot; None si no existe o no es válido."""
+    try:
+        data = loads(path.read_bytes())
+    except FileNotFoundError:
+        WARM_STATE_EVENTS.inc(event="missing")
+        return None
+    except Exception as e:
+        WARM_STATE_EVENTS.inc(event="invalid")
+        logger.warning("Snapshot de estado tibio ilegible en %s: %s", path, e)
+        return None
+    if not isinstance(data, dict) or data.get("format") != FORMAT_VERSION:
+        WARM_STATE_EVENTS.inc(event="invalid")
+        return None
+    WARM_STATE_EVENTS.inc(event="loaded")
+    return WarmState(
+        requested_model=data.get("requested_model"),
+        model=data.get("model"),
+        available_models=list(data.get("available_models") or []),
+        models_checked_at=float(data.get("models_checked_at") or 0.0),
+        cache_entries=list(data.get("cache_entries") or []),
+    )
+
+
+def save_warm_state(path: Path, state: WarmState) -> bool:
+    """Escribe el snapshot de forma atómica (archivo temporal + rename)."""
+    payload = {
+        "format": FORMAT_VERSION,
+        "saved_at": time.time(),
+        "requested_model": state.requested_model,
+        "model": state.model,
+        "available_models": sorted(state.available_models),
+        "models_checked_at": state.models_checked_at,
+        "cache_entries": state.cache_entries,
+    }
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_bytes(dumps(payload))
+        os.replace(tmp, path)
+    except Exception as e:
+        WARM_STATE_EVENTS.inc(event="save_error")
+        logger.warning("No se pudo guardar el estado tibio en %s: %s", path, e)
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return False
+    WARM_STATE_EVENTS.inc(event="saved")
+    return True
+
+
+class WarmStateStore:
+    """Snapshot del proceso: se carga una vez y se reescribe como máximo cada `min_interval_s`."""
+
+    def __init__(self, path: Optional[Path], *, min_interval_s: float = 30.0, cache_entries: int = 50):
+        self.path = path
+        self.min_interval_s = min_interval_s
+        self.cache_entries = cache_entries
+        self.state = (load_warm_state(path) if path else None) or WarmState()
+        self._last_save = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record_models(self, requested: str, available: List[str]) -> None:
+        """Registra el resultado de una consulta real de modelos disponibles."""
+        with self._lock:
+            self.state.requested_model = requested
+            self.state.available_models = list(available)
+            self.state.models_checked_at = time.time()
+
+    def record_model(self, model: str) -> None:
+        with self._lock:
+            self.state.model = model
+
+    def save(self, *, force: bool = False) -> bool:
+        """Guarda el snapshot (con las entradas calientes de la caché) si pasó el intervalo mínimo."""
+        if self.path is None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_save < self.min_interval_s:
+                return False
+            self._last_save = now
+            if self.cache_entries > 0:
+                self.state.cache_entries = get_response_cache().snapshot(self.cache_entries)
+            state = WarmState(**vars(self.state))
+        return save_warm_state(self.path, state)
+
+    def restore_cache(self) -> int:
+        """Carga en la caché de respuestas las entradas del snapshot (las vencidas se descartan)."""
+        if not self.state.cache_entries:
+            return 0
+        return get_response_cache().restore(self.state.cache_entries)
+
+
+_store: Optional[WarmStateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_warm_state() -> WarmStateStore:
+    """Snapshot compartido del proceso (deshabilitado si WARM_STATE_PATH está vacío)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = get_settings()
+                path = Path(settings.warm_state_path) if settings.warm_state_path else None
+                _store = WarmStateStore(
+                    path,
+                    min_interval_s=settings.warm_state_save_interval_s,
+                    cache_entries=settings.warm_state_cache_entries,
+                )
+    return _store
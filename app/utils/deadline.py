@@ -0,0 +1,36 @@
+"""
+Presupuesto de tiempo por petición.
+
+Un Deadline se crea al recibir la petición (a partir de Settings.timeout_s) y se
+propaga hasta cada intento de llamada al modelo, que solo recibe el tiempo que
+queda. Cuando se agota, el cliente devuelve la mejor respuesta degradada en vez
+de seguir esperando.
+"""
+from __future__ import annotations
+
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    """Se agotó el presupuesto de tiempo de la petición."""
+
+
+class Deadline:
+    def __init__(self, budget_s: float):
+        self.budget_s = budget_s
+        self.expires_at = time.monotonic() + budget_s
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def check(self, min_remaining_s: float = 0.0) -> None:
+        """Lanza DeadlineExceeded si no quedan al menos `min_remaining_s` segundos (o ya venció)."""
+        if self.expired or self.remaining() < min_remaining_s:
+            raise DeadlineExceeded(f"Presupuesto de {self.budget_s:.1f}s agotado")
+
+    def __repr__(self) -> str:
+        return f"Deadline(budget_s={self.budget_s}, remaining={self.remaining():.3f})"
@@ -0,0 +1,57 @@
+"""
+Validadores HTTP (ETag / If-None-Match) para los endpoints de lectura que se consultan por polling.
+
+El ETag no sale del cuerpo sino de una versión barata de los datos (max(id) de
+chat_history, que es de solo inserción, y el contador de escrituras de las lecturas;
+ver HistoryService.chats_version / sensors_version):
+si coincide con If-None-Match se responde 304 sin ejecutar la consulta completa.
+Cache-Control deja que el navegador y el CDN delante de Vercel sirvan la misma
+respuesta unos segundos (HTTP_CACHE_MAX_AGE_S / HTTP_CACHE_CDN_MAX_AGE_S).
+"""
+import hashlib
+from typing import Any, Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app.config import get_settings
+
+# Subir al cambiar el formato de una respuesta cacheable: invalida los ETag ya emitidos
+ETAG_FORMAT = 1
+
+
+def make_etag(*parts: Any) -> str:
+    """ETag débil (la misma versión de datos, no necesariamente los mismos bytes: gzip, orden de claves)."""
+    digest = hashlib.blake2b(repr((ETAG_FORMAT,) + parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    """ETag y Cache-Control (sin max-age configurado: no-cache, el cliente revalida cada vez)."""
+    settings = get_settings()
+    max_age = max(0, settings.http_cache_max_age_s)
+    cdn_max_age = max(0, settings.http_cache_cdn_max_age_s)
+    if max_age == 0 and cdn_max_age == 0:
+        control = "no-cache"
+    else:
+        # s-maxage: solo cachés compartidas (CDN); stale-while-revalidate: el CDN sirve la copia
+        # vieja mientras revalida en segundo plano, así el polling no espera a la base
+        control = f"public, max-age={max_age}, s-maxage={cdn_max_age}, stale-while-revalidate={cdn_max_age}"
+    return {"ETag": etag, "Cache-Control": control}
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110): se ignora el prefijo W/; "*" coincide siempre."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Respuesta 304 si el cliente ya tiene esta versión; None si hay que generar el cuerpo."""
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    return None
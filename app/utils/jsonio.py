@@ -0,0 +1,119 @@
+"""
+Capa JSON del servicio.
+
+Usa orjson si está instalado (serialización directa a bytes, datetime nativo) y,
+si no, la librería estándar con el mismo formato compacto. Incluye la respuesta
+HTTP por defecto de la app y un extractor tolerante del primer objeto JSON en la
+salida del modelo (con cercas ```json, texto alrededor, etc.).
+"""
+from __future__ import annotations
+
+import json
+import re
+from datetime import date, datetime
+from typing import Any, Optional
+
+from fastapi.responses import Response
+
+try:  # dependencia opcional
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None  # type: ignore[assignment]
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Tipo no serializable a JSON: {type(obj).__name__}")
+
+
+if orjson is not None:
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any, *, sort_keys: bool = False) -> bytes:
+        opts = _ORJSON_OPTS | orjson.OPT_SORT_KEYS if sort_keys else _ORJSON_OPTS
+        return orjson.dumps(obj, default=_default, option=opts)
+
+    def loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    JSONDecodeError = orjson.JSONDecodeError
+else:
+
+    def dumps(obj: Any, *, sort_keys: bool = False) -> bytes:
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=_default
+        ).encode("utf-8")
+
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+    JSONDecodeError = json.JSONDecodeError  # type: ignore[misc]
+
+
+def dumps_str(obj: Any) -> str:
+    """Como dumps, pero devuelve str (p. ej. para columnas JSON de SQLAlchemy)."""
+    return dumps(obj).decode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """Respuesta JSON serializada con orjson (o stdlib si no está disponible)."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+# Tokens que importan para balancear llaves: cadenas completas (se saltan de una
+# vez, con sus escapes y llaves internas) y las propias llaves
+_TOKENS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}]')
+
+
+def extract_json_object(text: str) -> Optional[Any]:
+    """Primer objeto JSON válido dentro de `text` (None si no hay ninguno).
+
+    Primero prueba el tramo entre la primera y la última llave; si no es válido,
+    recorre el texto una vez saltando de llave en llave (las cadenas se consumen
+    enteras) y llevando la profundidad, y al cerrar el primer objeto balanceado
+    intenta parsearlo. Tolera cercas de Markdown, prosa antes o después y llaves
+    dentro de cadenas. Si un candidato no es JSON válido (p. ej. "{x}" en el
+    texto), sigue con la siguiente llave de apertura.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    # Caso habitual (cercas o prosa sin llaves): el objeto va de la primera a la última llave
+    stop = text.rfind("}")
+    if stop > start:
+        try:
+            value = loads(text[start:stop + 1])
+            if isinstance(value, dict):
+                return value
+        except (JSONDecodeError, ValueError):
+            pass
+    while start != -1:
+        depth = 0
+        end = -1
+        for m in _TOKENS.finditer(text, start):
+            ch = m.group()
+            if ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    end = m.end()
+                    break
+        if end == -1:
+            return None  # objeto sin cerrar (salida truncada)
+        try:
+            value = loads(text[start:end])
+        except (JSONDecodeError, ValueError):
+            start = text.find("{", start + 1)
+            continue
+        if isinstance(value, dict):
+            return value
+        start = text.find("{", end)
+    return None
@@ -0,0 +1,114 @@
+"""
+Perfilador por muestreo bajo demanda.
+
+Un hilo en segundo plano toma `sys._current_frames()` cada `interval` segundos y
+acumula las pilas en formato "folded" (raíz;...;hoja conteo), compatible con
+flamegraph.pl y speedscope. Se activa para las próximas N peticiones o durante
+una ventana de tiempo y se detiene solo; fuera de una sesión no tiene costo.
+"""
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._interval = 0.005
+        self._deadline: Optional[float] = None
+        self._remaining_requests: Optional[int] = None
+        self._started_at: Optional[float] = None
+        self._stopped_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, *, requests: Optional[int] = None, seconds: Optional[float] = None, interval_ms: float = 5.0) -> None:
+        """Inicia una sesión nueva (descarta la anterior). Sin límites, corre hasta stop()."""
+        with self._lock:
+            if self.running:
+                raise RuntimeError("Ya hay una sesión de perfilado en curso.")
+            self._stacks = Counter()
+            self._samples = 0
+            self._interval = max(interval_ms, 1.0) / 1000.0
+            self._remaining_requests = requests
+            self._started_at = time.time()
+            self._stopped_at = None
+            self._deadline = time.monotonic() + seconds if seconds else None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="agro-sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=1.0)
+
+    def request_finished(self) -> None:
+        """Llamado al terminar cada petición; cierra la sesión al agotar el cupo de peticiones."""
+        if self._remaining_requests is None or not self.running:
+            return
+        with self._lock:
+            if self._remaining_requests is None:
+                return
+            self._remaining_requests -= 1
+            done = self._remaining_requests <= 0
+        if done:
+            self.stop()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        try:
+            while not self._stop.wait(self._interval):
+                if self._deadline is not None and time.monotonic() >= self._deadline:
+                    break
+                self._sample(own)
+        finally:
+            self._stopped_at = time.time()
+
+    def _sample(self, own_ident: int) -> None:
+        frames = sys._current_frames()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+            stack = []
+            f = frame
+            while f is not None:
+                code = f.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                f = f.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            self._stacks[";".join(stack)] += 1
+        self._samples += 1
+
+    def folded(self) -> str:
+        """Pilas acumuladas en formato folded, una por línea."""
+        stacks = list(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "samples": self._samples,
+            "distinct_stacks": len(self._stacks),
+            "interval_ms": round(self._interval * 1000, 3),
+            "remaining_requests": self._remaining_requests,
+            "seconds_left": round(max(0.0, self._deadline - time.monotonic()), 3) if self._deadline and self.running else None,
+            "started_at": self._started_at,
+            "stopped_at": self._stopped_at,
+        }
+
+
+PROFILER = SamplingProfiler()
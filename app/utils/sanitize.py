@@ -1,33 +1,200 @@
 from __future__ import annotations
 
+import json
 import re
-from typing import Any, Dict
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+from app.config import get_settings
 
-_EMAIL = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
-_PHONE = re.compile(r"\b(?:\+?\d{1,3}[\s-]?)?(?:\(\d{2,4}\)|\d{2,4})[\s-]?\d{3,4}[\s-]?\d{3,4}\b")
-_IDLIKE = re.compile(r"\b\d{6,}\b")
-_URL = re.compile(r"https?://\S+")
 
+# Caracteres válidos en la parte local de un email
+_LOCAL = "[A-Za-z0-9._%+-]"
+_DOMAIN = r"@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"
+_PHONE_TAIL = r"[\s-]?\d{3,4}[\s-]?\d{3,4}\b"
+# El email tiene prioridad (antes era la primera pasada): ninguna otra máscara puede
+# terminar dentro de la parte local de un email, p. ej. "987 654 321@hotmail.com".
+# Se mira hasta 64 caracteres (el máximo de una parte local) para que muchas
+# coincidencias seguidas en una palabra larga sin "@" no la recorran cada una entera;
+# una parte local más larga la completa Sanitizer.mask. Sin cuantificador posesivo
+# (Python 3.11+): como _LOCAL no incluye "@", retroceder no encuentra otro dominio
+_NOT_EMAIL = rf"(?!{_LOCAL}{{0,64}}{_DOMAIN})"
+
+# Todas las máscaras van en una sola alternancia. Cada rama empieza con un literal
+# o una clase de caracteres (así `re` descarta rápido las posiciones que no
+# pueden empezar una coincidencia) y los `\b` / lookbehind van después del primer
+# carácter. El orden define la prioridad en una misma posición: email, teléfono,
+# id, url y términos sensibles, igual que las pasadas sucesivas de antes.
+#
+# La tercera columna es la rama tal como la veían esas pasadas justo después de un
+# reemplazo ("[email]", "[phone]", ...): el "]" previo es un límite de palabra, así
+# que sobra el lookbehind (None: la rama no puede empezar ahí).
+# Teléfono: \b(?:\+?\d{1,3}[\s-]?)?(?:\(\d{2,4}\)|\d{2,4})[\s-]?\d{3,4}[\s-]?\d{3,4}\b
+# desglosado según el primer carácter (+, paréntesis o dígito)
+_PHONE_DIGITS = rf"(?:\d{{0,2}}[\s-]?(?:\(\d{{2,4}}\)|\d{{2,4}})|\d{{1,3}}){_PHONE_TAIL}{_NOT_EMAIL}"
+_PHONES = [
+    rf"\+(?<=\w\+)\d{{1,3}}[\s-]?(?:\(\d{{2,4}}\)|\d{{2,4}}){_PHONE_TAIL}{_NOT_EMAIL}",
+    rf"\((?<=\w\()\d{{2,4}}\){_PHONE_TAIL}{_NOT_EMAIL}",
+    rf"\d(?<!\w\d){_PHONE_DIGITS}",
+]
+# El lookbehind evita reintentar desde cada carácter de una palabra larga sin "@"
+# (sin él, el peor caso es cuadrático)
+_EMAIL = rf"{_LOCAL}(?<!{_LOCAL}{_LOCAL}){_LOCAL}*{_DOMAIN}"
+_PHONE_GLUED = rf"\d{_PHONE_DIGITS}"
+_ID_GLUED = rf"\d{{6,}}\b{_NOT_EMAIL}"
+# La pasada de urls corría después de las de email y teléfonos: lo ya reemplazado
+# ("[email][phone]", sin espacios) quedaba dentro de la url y esta seguía de largo
+_URL = "https?://(?:{}(?:{}|{})?|{}|\\S)+".format(_EMAIL, _PHONE_GLUED, _ID_GLUED, "|".join(_PHONES))
+_MASKS: List[Tuple[str, str, Optional[str]]] = [
+    ("email", _EMAIL, rf"{_LOCAL}+{_DOMAIN}"),
+    ("phone", _PHONES[0], None),
+    ("phone", _PHONES[1], None),
+    ("phone", _PHONES[2], _PHONE_GLUED),
+    ("id", rf"\d(?<!\w\d)\d{{5,}}\b{_NOT_EMAIL}", _ID_GLUED),
+    ("url", _URL, _URL),
+]
+# Orden de las pasadas originales: tras un reemplazo solo podían coincidir las posteriores
+_ORDER = ("email", "phone", "id", "url", "term")
+_LOCAL_RUN = re.compile(f"{_LOCAL}*")
+_DOMAIN_AT = re.compile(_DOMAIN)
+
+# Términos literales (sin distinguir mayúsculas; los espacios admiten cualquier blanco)
 _SENSITIVE_TERMS = [
-    r"(?i)veneno",
-    r"(?i)venenoso",
-    r"(?i)matar",
-    r"(?i)expl(osiv|osivo)",
-    r"(?i)arma",
-    r"(?i)químico\s+peligroso",
-    r"(?i)gramoxone",
+    "veneno",
+    "venenoso",
+    "matar",
+    "explosiv",
+    "explosivo",
+    "arma",
+    "químico peligroso",
+    "gramoxone",
 ]
 
+_REPLACEMENTS = {
+    "email": "[email]",
+    "phone": "[phone]",
+    "id": "[id]",
+    "url": "[url]",
+    "term": "[término sensible]",
+}
+
+
+def _char_pattern(ch: str) -> str:
+    if ch == " ":
+        return r"\s+"
+    lo, up = ch.lower(), ch.upper()
+    if lo != up and len(lo) == len(up) == 1:
+        return f"[{re.escape(lo)}{re.escape(up)}]"
+    return re.escape(ch)
+
+
+def _terms_pattern(terms: Iterable[str]) -> str:
+    """Trie de términos como regex: una rama por primera letra y el término más largo gana."""
+    trie: Dict[str, Any] = {}
+    for term in terms:
+        node = trie
+        for ch in " ".join(term.lower().split()):
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        alts = [_char_pattern(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class Sanitizer:
+    """Enmascara datos personales y términos sensibles en una sola pasada.
+
+    `extra_terms` son términos literales adicionales (p. ej. desde SANITIZE_EXTRA_TERMS).
+    """
+
+    def __init__(self, extra_terms: Iterable[str] = ()):
+        terms = [t for t in [*_SENSITIVE_TERMS, *extra_terms] if t and t.strip()]
+        terms_pattern = _terms_pattern(terms) + _NOT_EMAIL
+        masks = [*_MASKS, ("term", terms_pattern, terms_pattern)]
+        self.pattern, self._kinds = _alternation([(kind, p) for kind, p, _ in masks])
+        # Por tipo de reemplazo: lo que puede venir pegado detrás (ver _MASKS)
+        self._glued = {}
+        for rank, kind in enumerate(_ORDER):
+            # Tras un email, otro email: la misma pasada seguía desde ahí y el patrón
+            # original no tenía lookbehind
+            later = [(k, g) for k, _, g in masks if g is not None and (_ORDER.index(k) > rank or k == kind == "email")]
+            if later:
+                self._glued[kind] = _alternation(later)
+
+    def mask(self, text: str) -> str:
+        parts: List[str] = []
+        pos = 0
+        search = self.pattern.search
+        # Palabra (caracteres de parte local) que sigue a un reemplazo: dónde termina y si
+        # le sigue un dominio. Se mide una vez por palabra, no una vez por coincidencia
+        run_end, run_domain = -1, None
+        while True:
+            m = search(text, pos)
+            if m is None:
+                break
+            parts.append(text[pos:m.start()])
+            kind = self._kinds[m.lastindex]
+            parts.append(_REPLACEMENTS[kind])
+            pos = m.end()
+            while True:
+                if kind != "email":
+                    # Resto de un email cuya parte local pasa de lo que mira _NOT_EMAIL
+                    if pos >= run_end:
+                        run_end = _LOCAL_RUN.match(text, pos).end()
+                        run_domain = _DOMAIN_AT.match(text, run_end) if run_end > pos else None
+                    if run_domain is not None:
+                        kind = "email"
+                        parts.append(_REPLACEMENTS[kind])
+                        pos = run_domain.end()
+                        continue
+                glued = None
+                if kind in self._glued:
+                    pattern, kinds = self._glued[kind]
+                    glued = pattern.match(text, pos)
+                if glued is None:
+                    # Tras "[email]" un teléfono no empieza en "+" ni "(" (sin \b antes); el
+                    # lookbehind de esas ramas vería el email original, así que el carácter queda
+                    if kind == "email" and text.startswith(("+", "("), pos):
+                        parts.append(text[pos])
+                        pos += 1
+                    break
+                kind = kinds[glued.lastindex]
+                parts.append(_REPLACEMENTS[kind])
+                pos = glued.end()
+        parts.append(text[pos:])
+        return "".join(parts)
+
+
+def _alternation(masks: List[Tuple[str, str]]) -> Tuple["re.Pattern[str]", Dict[int, str]]:
+    # Un grupo vacío al final de cada rama indica cuál coincidió (m.lastindex)
+    # sin añadir grupos delante del primer carácter
+    pattern = re.compile("|".join(f"{p}()" for _, p in masks))
+    return pattern, {i: kind for i, (kind, _) in enumerate(masks, start=1)}
+
+
+_sanitizer: Optional[Sanitizer] = None
+_sanitizer_lock = threading.Lock()
+
+
+def get_sanitizer() -> Sanitizer:
+    """Sanitizador compartido del proceso (términos extra desde la configuración)."""
+    global _sanitizer
+    if _sanitizer is None:
+        with _sanitizer_lock:
+            if _sanitizer is None:
+                extra = get_settings().sanitize_extra_terms.split(",")
+                _sanitizer = Sanitizer(extra_terms=extra)
+    return _sanitizer
+
 
 def _mask_basic(text: str) -> str:
-    text = _EMAIL.sub("[email]", text)
-    text = _PHONE.sub("[phone]", text)
-    text = _IDLIKE.sub("[id]", text)
-    text = _URL.sub("[url]", text)
-    for pat in _SENSITIVE_TERMS:
-        text = re.sub(pat, "[término sensible]", text)
-    return text
+    return get_sanitizer().mask(text)
 
 
 def sanitize_question(text: str, max_len: int = 2000) -> str:
@@ -40,8 +207,6 @@ def sanitize_question(text: str, max_len: int = 2000) -> str:
 
 def sanitize_data_preview(data: Dict[str, Any], max_chars: int = 2000) -> str:
     try:
-        import json
-
         s = json.dumps(data, ensure_ascii=False)
     except Exception:
         return "[datos no serializables]"
@@ -0,0 +1,91 @@
+"""
+Spans de traza en memoria exportables en formato Chrome Trace (chrome://tracing, Perfetto).
+
+Cada span registra nombre, categoría, inicio, duración, hilo y atributos en un
+buffer circular acotado. Cuando la traza está deshabilitada, `span()` solo
+consulta un booleano, por lo que los puntos de instrumentación pueden quedarse
+en el código de producción.
+"""
+from __future__ import annotations
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+_request_id: ContextVar[Optional[int]] = ContextVar("agro_trace_request_id", default=None)
+_request_ids = itertools.count(1)
+
+_PID = os.getpid()
+_EPOCH = time.perf_counter()
+
+
+class Tracer:
+    def __init__(self, max_events: int = 20_000, enabled: bool = False):
+        self.enabled = enabled
+        self._events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+
+    def configure(self, *, enabled: Optional[bool] = None, max_events: Optional[int] = None) -> None:
+        if max_events is not None and max_events != self._events.maxlen:
+            with self._lock:
+                self._events = deque(self._events, maxlen=max_events)
+        if enabled is not None:
+            self.enabled = enabled
+
+    @contextmanager
+    def span(self, name: str, cat: str = "app", **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """Registra la duración del bloque; los atributos pueden completarse dentro del bloque."""
+        if not self.enabled:
+            yield attrs
+            return
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            rid = _request_id.get()
+            if rid is not None:
+                attrs["request_id"] = rid
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": round((start - _EPOCH) * 1e6, 1),
+                "dur": round((end - start) * 1e6, 1),
+                "pid": _PID,
+                "tid": threading.get_ident(),
+                "args": attrs,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def events(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._events)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._events.clear()
+
+    def export_chrome_trace(self) -> Dict[str, Any]:
+        """Documento JSON cargable en chrome://tracing o ui.perfetto.dev."""
+        return {"traceEvents": self.events(), "displayTimeUnit": "ms"}
+
+
+TRACER = Tracer()
+
+
+def span(name: str, cat: str = "app", **attrs: Any):
+    return TRACER.span(name, cat, **attrs)
+
+
+def begin_request() -> int:
+    """Asigna un id de petición al contexto actual para agrupar sus spans."""
+    rid = next(_request_ids)
+    _request_id.set(rid)
+    return rid
@@ -0,0 +1,443 @@
+"""
+Microbenchmarks de los componentes del camino caliente de una petición.
+
+Cubre sanitización (incluido su peor caso), construcción de prompts, heurística de recomendación,
+extracción de candidatas, parseo del JSON estructurado y las escrituras/consultas
+de HistoryService sobre un SQLite sembrado (no toca data/chat_history.db), el índice de
+preguntas similares construido desde esas filas y las tendencias de sensores.
+
+Uso:
+    python scripts/benchmark.py                      # ejecutar y mostrar resultados
+    python scripts/benchmark.py --save               # guardar como baseline
+    python scripts/benchmark.py --check              # fallar si algún caso empeora
+    python scripts/benchmark.py --rows 1000000 -k history
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+
+# Agregar directorio raíz al path
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# Los benchmarks nunca deben llamar al modelo real
+os.environ.setdefault("MOCK_MODE", "true")
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app.db.database import Base, ChatHistory
+from app.db.history_service import HistoryService
+from app.db.migrations import migrate
+from app.db.partitions import create_partition, month_key, partition_table
+from app.schemas.requests import AskRequest
+from app.services.gemini_client import GeminiClient
+from app.services.question_index import QuestionIndex
+from app.services.response_cache import MemoryResponseCache, SQLiteResponseCache
+from app.services.sensor_trends import SensorTrends, TrendState
+from app.services.rules_engine import get_rules_engine
+from app.utils.jsonio import dumps
+from app.utils.sanitize import sanitize_data_preview, sanitize_question
+
+BASELINE_PATH = Path(__file__).resolve().parent / "bench_baseline.json"
+PROMPT_PATH = ROOT / "app" / "prompts" / "agriculture_system_prompt.md"
+
+CROPS = ["maíz", "tomate", "papa", "café", "arroz", "trigo", "frijol", "quinua"]
+PARAMETERS = ["humedad_suelo", "temperatura_aire", "ph_suelo", "humedad_aire", "ec", "vpd"]
+ENDPOINTS = ["/v1/agro/chat", "/v1/agro/ask"]
+
+QUESTION = (
+    "Tengo maíz en V6 con hojas amarillas en los bordes. Mi correo es productor@example.com "
+    "y mi teléfono +51 987 654 321. Revisé https://example.com/guia?id=12345678 pero no sé "
+    "si es un problema de nitrógeno o de riego. ¿Qué factores debería considerar?"
+)
+
+
+# ---------------------------------------------------------------------------
+# Medición
+# ---------------------------------------------------------------------------
+
+def measure(fn: Callable[[], object], min_time: float = 0.2, repeat: int = 5) -> Dict[str, float]:
+    """Mide el tiempo por llamada en microsegundos (mejor y mediana de `repeat` rondas)."""
+    # Calibrar número de iteraciones por ronda
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time / repeat or loops >= 1_000_000:
+            break
+        loops *= 2
+
+    rounds: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        rounds.append((time.perf_counter() - t0) / loops * 1e6)
+    return {
+        "best_us": round(min(rounds), 3),
+        "median_us": round(statistics.median(rounds), 3),
+        "loops": loops,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Datos sintéticos
+# ---------------------------------------------------------------------------
+
+def _adversarial_text(n: int) -> str:
+    """Peor caso del sanitizador: rachas largas sin "@", dígitos sin separar y "@" repetidas."""
+    tail = ("a@" * 50 + " " + ".-_" * 20 + " 9" * 30 + " ") * (n // 1000 + 1)
+    return ("a" * (n // 2) + " " + "1" * (n // 4) + " " + tail)[:n]
+
+
+def _fake_response(text: str, finish_reason: int = 1) -> SimpleNamespace:
+    """Respuesta con la misma forma que la del SDK de Gemini (candidates → content → parts)."""
+    parts = [SimpleNamespace(text=chunk) for chunk in text.split("\n\n")]
+    candidate = SimpleNamespace(content=SimpleNamespace(parts=parts), finish_reason=finish_reason)
+    return SimpleNamespace(candidates=[candidate], usage_metadata=None)
+
+
+def _seed_database(path: Path, rows: int) -> None:
+    """Crea un SQLite con `rows` conversaciones y `rows` lecturas de sensor."""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    rnd = random.Random(42)
+    now = datetime.utcnow()
+    batch = 10_000
+    with engine.begin() as conn:
+        for offset in range(0, rows, batch):
+            n = min(batch, rows - offset)
+            chats = []
+            sensors = []
+            for i in range(n):
+                ts = now - timedelta(seconds=(offset + i) * 7)
+                crop = rnd.choice(CROPS)
+                parameter = rnd.choice(PARAMETERS)
+                chats.append({
+                    "timestamp": ts,
+                    "endpoint": rnd.choice(ENDPOINTS),
+                    "question": f"¿Cómo manejar {parameter} en {crop}? consulta {offset + i}",
+                    "crop": crop,
+                    "stage": "floración",
+                    "parameter": parameter,
+                    "value": rnd.uniform(0, 100),
+                    "unit": "%",
+                    "length": "medium",
+                    "answer": "Respuesta educativa de ejemplo " * 8,
+                    "model": "gemini-2.5-flash",
+                    "response_time_ms": rnd.randint(200, 5000),
+                    "user_ip": "127.0.0.1",
+                })
+                sensors.append({
+                    "timestamp": ts,
+                    "crop": crop,
+                    "stage": "floración",
+                    "parameter": parameter,
+                    "value": rnd.uniform(0, 100),
+                    "unit": "%",
+                    "action": rnd.choice(["aumentar", "disminuir", "mantener"]),
+                    "target_min": 20.0,
+                    "target_max": 30.0,
+                    "target_unit": "%",
+                    "rationale": "Comparación con rango orientativo.",
+                })
+            conn.execute(insert(ChatHistory), chats)
+            # Lecturas en su partición mensual, como las guarda HistoryService
+            by_month = {}
+            for reading in sensors:
+                by_month.setdefault(month_key(reading["timestamp"]), []).append(reading)
+            for key, group in by_month.items():
+                create_partition(conn, key)
+                conn.execute(insert(partition_table(key)), group)
+    engine.dispose()
+
+
+def _open_seeded_session(db_dir: Path, rows: int):
+    """Sesión sobre una copia de trabajo del SQLite sembrado (las escrituras no se acumulan entre corridas)."""
+    pristine = db_dir / f"bench_history_{rows}.db"
+    if not pristine.exists():
+        print(f"🔧 Sembrando {pristine} con {rows} filas por tabla...")
+        t0 = time.perf_counter()
+        _seed_database(pristine, rows)
+        print(f"✅ Base sembrada en {time.perf_counter() - t0:.1f}s")
+    # Bases sembradas con un esquema anterior: tablas nuevas y migraciones pendientes, como init_db()
+    # (sobre la copia prístina, para migrar una sola vez y no en cada corrida)
+    engine = create_engine(f"sqlite:///{pristine}")
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+    engine.dispose()
+    work = db_dir / f"bench_history_{rows}.work.db"
+    shutil.copyfile(pristine, work)
+    engine = create_engine(f"sqlite:///{work}", connect_args={"check_same_thread": False})
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+
+# ---------------------------------------------------------------------------
+# Casos
+# ---------------------------------------------------------------------------
+
+def build_cases(rows: int, db_dir: Path) -> List[Tuple[str, Callable[[], Callable[[], object]]]]:
+    """Lista de (nombre, fábrica); cada fábrica prepara el caso y devuelve la función a medir."""
+    rules = get_rules_engine()
+    client = GeminiClient(prompt_path=PROMPT_PATH)
+    long_text = (QUESTION + " ") * 60  # ~12000 caracteres (max_input_chars por defecto)
+    worst_3k, worst_12k = _adversarial_text(3000), _adversarial_text(12000)
+    preview = {
+        "cultivo": "maíz",
+        "parametro": "soil_moisture",
+        "valor": 18.5,
+        "unidad": "%",
+        "etapa": "V6",
+        "temperatura": 26,
+        "nota": "contacto productor@example.com",
+    }
+    chat_req = AskRequest(question=QUESTION, crop="maíz", stage="V6", length="medium")
+    user_req = AskRequest(question=QUESTION, crop="maíz", temperature=26, parameter="humedad_suelo")
+    sensor_req = AskRequest(crop="maíz", stage="V6", parameter="humedad_suelo", value=18.5, unit="%", temperature=26)
+
+    text_response = _fake_response("Resumen educativo.\n\n- Factor 1\n- Factor 2\n\nMonitoreo sugerido." * 4)
+    structured = json.dumps({
+        "action": "increase",
+        "parameter": "soil_moisture",
+        "target_range": {"min": 20, "max": 30, "unit": "%"},
+        "rationale": "El valor está por debajo del rango orientativo.",
+        "warnings": ["Rangos genéricos de referencia."],
+    }, ensure_ascii=False)
+    structured_fenced = "```json\n" + structured + "\n```"
+    structured_noisy = "Claro, aquí tienes la recomendación {resumida}:\n" + structured_fenced + "\nEspero que sirva."
+    history_page = {
+        "total": 50,
+        "chats": [
+            {
+                "id": i, "timestamp": datetime(2025, 1, 1) + timedelta(minutes=i), "endpoint": "/v1/agro/chat",
+                "question": QUESTION, "crop": "maíz", "stage": "V6", "parameter": None, "value": None, "unit": None,
+                "answer_preview": QUESTION[:100] + "...", "model": "gemini-2.5-flash", "response_time_ms": 850,
+            }
+            for i in range(50)
+        ],
+    }
+    structured_response = _fake_response(structured)
+
+    tag = f"{rows // 1000}k" if rows < 1_000_000 else f"{rows // 1_000_000}M"
+
+    sessions = []
+
+    def history_case(fn_name: str):
+        def factory():
+            if not sessions:
+                sessions.append(_open_seeded_session(db_dir, rows))
+            db = sessions[0]
+            if fn_name == "save_chat":
+                return lambda: HistoryService.save_chat(
+                    db=db, endpoint="/v1/agro/chat", question=QUESTION, crop="maíz", stage="V6",
+                    parameter=None, value=None, unit=None, length="medium", answer="Respuesta " * 40,
+                    model="gemini-2.5-flash", recommendation=None, response_time_ms=420, user_ip="127.0.0.1",
+                )
+            if fn_name == "save_sensor_reading":
+                return lambda: HistoryService.save_sensor_reading(
+                    db=db, crop="maíz", stage="V6", parameter="humedad_suelo", value=18.5, unit="%",
+                    action="aumentar", target_min=20.0, target_max=30.0, target_unit="%", rationale="Prueba",
+                )
+            if fn_name == "get_recent_chats":
+                return lambda: HistoryService.get_recent_chats(db, limit=50)
+            if fn_name == "get_chats_by_crop":
+                return lambda: HistoryService.get_chats_by_crop(db, crop="tomate", limit=50)
+            if fn_name == "get_sensor_history":
+                return lambda: HistoryService.get_sensor_history(db, crop="maíz", parameter="humedad_suelo", hours=24, limit=100)
+            if fn_name == "get_stats":
+                return lambda: HistoryService.get_stats(db)
+            if fn_name == "search_chats":
+                return lambda: HistoryService.search_chats(db, query="nitrógeno", limit=20)
+            raise KeyError(fn_name)
+        return factory
+
+    indexes = []
+
+    def similar_case(fn_name: str):
+        def factory():
+            if not sessions:
+                sessions.append(_open_seeded_session(db_dir, rows))
+            if not indexes:
+                indexes.append(QuestionIndex())
+                indexes[0].sync(sessions[0])
+            index = indexes[0]
+            if fn_name == "search":
+                return lambda: index.search("manejo de humedad del suelo en maíz", k=5)
+            if fn_name == "search_prefix":
+                return lambda: index.search("ph_suelo en tom", k=5)
+            if fn_name == "add":
+                counter = iter(range(10**9))
+                return lambda: index.add(10**9 + next(counter), f"{QUESTION} variante {next(counter)}")
+            raise KeyError(fn_name)
+        return factory
+
+    def cache_case(backend: str, op: str):
+        def factory():
+            if backend == "sqlite":
+                path = db_dir / "bench_response_cache.db"
+                for suffix in ("", "-wal", "-shm"):
+                    Path(f"{path}{suffix}").unlink(missing_ok=True)
+                cache = SQLiteResponseCache(str(path), max_entries=1000)
+            else:
+                cache = MemoryResponseCache(max_entries=1000)
+            value = {"answer": "Respuesta " * 80, "model": "gemini-2.5-flash", "tips": ["a", "b"]}
+            for i in range(1000):
+                cache.set(f"v|{i}", value)
+            if op == "get":
+                return lambda: cache.get("v|500")
+            counter = iter(range(10**9))
+            return lambda: cache.set(f"v|{next(counter) % 2000}", value)
+        return factory
+
+    def trends_case(fn_name: str):
+        def factory():
+            if fn_name == "observe":
+                state = TrendState(120, 0.2)
+                start = datetime(2025, 1, 1)
+                counter = iter(range(10**9))
+
+                def observe():
+                    i = next(counter)
+                    state.observe(start + timedelta(seconds=30 * i), 20.0 + (i % 17) * 0.3)
+                return observe
+            if not sessions:
+                sessions.append(_open_seeded_session(db_dir, rows))
+            # Ventana de reconstrucción amplia: las filas sembradas pueden ser viejas
+            trends = SensorTrends(lookback_h=24 * 365 * 50)
+            return lambda: trends.rebuild(sessions[0])
+        return factory
+
+    cases: List[Tuple[str, Callable[[], Callable[[], object]]]] = [
+        ("sanitize.question[short]", lambda: lambda: sanitize_question(QUESTION, max_len=800)),
+        ("sanitize.question[12k]", lambda: lambda: sanitize_question(long_text, max_len=12000)),
+        ("sanitize.data_preview", lambda: lambda: sanitize_data_preview(preview, max_chars=800)),
+        # El tiempo de [12k] debe ser ~4× el de [3k] (lineal); un crecimiento ~16× delata backtracking
+        ("sanitize.worst_case[3k]", lambda: lambda: sanitize_question(worst_3k, max_len=12000)),
+        ("sanitize.worst_case[12k]", lambda: lambda: sanitize_question(worst_12k, max_len=12000)),
+        ("prompt.compose_chat", lambda: lambda: client._compose_chat_prompt(chat_req)),
+        ("prompt.compose_user", lambda: lambda: client._compose_user_prompt(user_req)),
+        ("prompt.compose_adjustment", lambda: lambda: client._compose_adjustment_prompt(sensor_req)),
+        ("heuristic.recommendation", lambda: lambda: client._heuristic_recommendation(sensor_req)),
+        ("rules.evaluate", lambda: lambda: rules.evaluate("temperatura_aire", 77.0, unit="°F", crop="tomate", stage="floración")),
+        ("response.extract_text", lambda: lambda: GeminiClient._extract_text(text_response)),
+        ("structured.extract_and_parse", lambda: lambda: GeminiClient._parse_structured(
+            GeminiClient._extract_structured_raw(structured_response))),
+        ("structured.parse_fenced", lambda: lambda: GeminiClient._parse_structured(structured_fenced)),
+        ("structured.parse_invalid", lambda: lambda: GeminiClient._parse_structured("no es json {")),
+        ("structured.parse_noisy", lambda: lambda: GeminiClient._parse_structured(structured_noisy)),
+        ("json.history_page[50]", lambda: lambda: dumps(history_page)),
+    ]
+    for name in (
+        "get_recent_chats",
+        "get_chats_by_crop",
+        "get_sensor_history",
+        "get_stats",
+        "search_chats",
+        "save_chat",
+        "save_sensor_reading",
+    ):
+        cases.append((f"history.{name}[{tag}]", history_case(name)))
+    for name in ("search", "search_prefix", "add"):
+        cases.append((f"similar.{name}[{tag}]", similar_case(name)))
+    for backend in ("memory", "sqlite"):
+        for op in ("get", "set"):
+            cases.append((f"cache.{backend}_{op}", cache_case(backend, op)))
+    cases.append(("trends.observe", trends_case("observe")))
+    cases.append((f"trends.rebuild[{tag}]", trends_case("rebuild")))
+    return cases
+
+
+# ---------------------------------------------------------------------------
+# Baselines
+# ---------------------------------------------------------------------------
+
+def load_baseline(path: Path) -> Dict[str, Dict[str, float]]:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8")).get("cases", {})
+
+
+def save_baseline(path: Path, results: Dict[str, Dict[str, float]]) -> None:
+    merged = load_baseline(path)
+    merged.update(results)
+    payload = {
+        "python": sys.version.split()[0],
+        "updated_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "cases": dict(sorted(merged.items())),
+    }
+    path.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+
+def check_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> List[str]:
+    """Casos cuyo mejor tiempo supera al baseline en más de `threshold` (p. ej. 0.25 = +25%)."""
+    failures = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = res["best_us"] / base["best_us"] if base["best_us"] else 1.0
+        if ratio > 1.0 + threshold:
+            failures.append(f"{name}: {base['best_us']:.2f}µs → {res['best_us']:.2f}µs (x{ratio:.2f})")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks del camino caliente")
+    parser.add_argument("-k", dest="pattern", default=None, help="Ejecutar solo casos que contengan este texto")
+    parser.add_argument("--rows", type=int, default=10_000, help="Filas por tabla del SQLite sembrado (p. ej. 10000, 1000000)")
+    parser.add_argument("--db-dir", type=Path, default=Path(tempfile.gettempdir()), help="Directorio para los SQLite sembrados")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Tiempo mínimo por caso en segundos")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="Guardar resultados como baseline")
+    parser.add_argument("--check", action="store_true", help="Comparar contra el baseline y fallar si hay regresión")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Regresión tolerada (0.25 = +25%%)")
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, factory in build_cases(args.rows, args.db_dir):
+        if args.pattern and args.pattern not in name:
+            continue
+        fn = factory()
+        results[name] = measure(fn, min_time=args.min_time)
+        print(f"{name:45s} {results[name]['best_us']:12.2f} µs  (mediana {results[name]['median_us']:.2f} µs)")
+
+    small, large = results.get("sanitize.worst_case[3k]"), results.get("sanitize.worst_case[12k]")
+    if small and large:
+        print(f"\nsanitize.worst_case 12k/3k = {large['best_us'] / small['best_us']:.1f}× (lineal ≈ 4×)")
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"\n💾 Baseline actualizado en {args.baseline}")
+
+    if args.check:
+        failures = check_regressions(results, load_baseline(args.baseline), args.threshold)
+        if failures:
+            print("\n❌ Regresiones detectadas:")
+            for line in failures:
+                print(f"   {line}")
+            return 1
+        print("\n✅ Sin regresiones respecto al baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
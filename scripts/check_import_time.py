@@ -0,0 +1,116 @@
+"""
+Presupuesto de arranque en frío del punto de entrada serverless (api/index.py).
+
+Importa `api.index` en procesos nuevos (sin módulos en caché), toma el mejor de
+varios intentos y falla si supera el presupuesto o si al importar se cargan
+módulos pesados que deben ser perezosos (SQLAlchemy, google.generativeai, grpc).
+También informa el tiempo de la primera petición a /health.
+
+Uso:
+    python scripts/check_import_time.py                   # presupuesto por defecto
+    python scripts/check_import_time.py --budget-ms 400 --runs 7
+    python scripts/check_import_time.py --top 15          # importaciones más lentas
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Módulos que no deben cargarse al importar la app (se importan en el primer uso)
+FORBIDDEN_PREFIXES = ("sqlalchemy", "google.generativeai", "grpc")
+
+_PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import api.index
+t1 = time.perf_counter()
+loaded = sorted(m for m in sys.modules if m.split(".")[0] in {"sqlalchemy", "google", "grpc"})
+first_ms = None
+try:
+    from fastapi.testclient import TestClient
+    t2 = time.perf_counter()
+    TestClient(api.index.app).get("/health")
+    first_ms = (time.perf_counter() - t2) * 1000
+except Exception:
+    pass
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "first_request_ms": first_ms, "loaded": loaded}))
+"""
+
+
+def _env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = str(ROOT) + os.pathsep + env.get("PYTHONPATH", "")
+    # Nunca llamar al modelo real desde el chequeo
+    env.setdefault("MOCK_MODE", "true")
+    return env
+
+
+def probe() -> Dict:
+    out = subprocess.run(
+        [sys.executable, "-c", _PROBE], cwd=ROOT, env=_env(), capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(top: int) -> List[Tuple[int, str]]:
+    """Importaciones con mayor tiempo acumulado según `python -X importtime`."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.index"],
+        cwd=ROOT, env=_env(), capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Presupuesto de arranque en frío de api/index.py")
+    parser.add_argument("--budget-ms", type=float, default=600.0, help="Máximo tiempo de importación (mejor de --runs)")
+    parser.add_argument("--runs", type=int, default=5, help="Procesos nuevos a medir")
+    parser.add_argument("--top", type=int, default=0, help="Mostrar las N importaciones más lentas")
+    args = parser.parse_args()
+
+    # Una corrida previa para que los .pyc estén generados y no cuenten como arranque
+    probe()
+    results = [probe() for _ in range(args.runs)]
+    best = min(r["import_ms"] for r in results)
+    first = [r["first_request_ms"] for r in results if r["first_request_ms"] is not None]
+    loaded = sorted({
+        prefix for r in results for m in r["loaded"] for prefix in FORBIDDEN_PREFIXES
+        if m == prefix or m.startswith(prefix + ".")
+    })
+
+    print(f"import api.index: mejor {best:.0f} ms, peor {max(r['import_ms'] for r in results):.0f} ms "
+          f"({args.runs} procesos, presupuesto {args.budget_ms:.0f} ms)")
+    if first:
+        print(f"primera petición /health: mejor {min(first):.1f} ms")
+
+    if args.top:
+        print("\nImportaciones más lentas (acumulado):")
+        for us, name in slowest_imports(args.top):
+            print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if loaded:
+        print(f"\n❌ Módulos pesados cargados al importar: {', '.join(loaded)}")
+        failed = True
+    if best > args.budget_ms:
+        print(f"\n❌ El arranque supera el presupuesto: {best:.0f} ms > {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("\n✅ Arranque dentro del presupuesto")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
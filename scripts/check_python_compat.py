@@ -0,0 +1,111 @@
+"""
+Compatibilidad con la versión mínima de Python del README (3.10).
+
+Con el intérprete indicado (por defecto `python3.10`, sin necesitar las
+dependencias de la app):
+- compila todos los .py de app/, api/ y scripts/ (sintaxis nueva);
+- compila los patrones del sanitizador (app/utils/sanitize.py) y compara las
+  coincidencias con las de este intérprete en los casos de check_sanitizer.py.
+  `re` suma sintaxis entre versiones (p. ej. cuantificadores posesivos en 3.11)
+  y un patrón que no compila rompe la importación de toda la app.
+
+Uso:
+    python scripts/check_python_compat.py
+    python scripts/check_python_compat.py --python /ruta/a/python3.10
+"""
+
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.utils.sanitize import Sanitizer
+from scripts.check_sanitizer import KNOWN, generate
+
+# Corre en el otro intérprete: compila cada patrón y devuelve los spans de cada texto
+_PROBE = r"""
+import json, re, sys
+data = json.load(sys.stdin)
+out = []
+for pattern in data["patterns"]:
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        out.append({"error": str(e)})
+        continue
+    out.append({"spans": [[list(m.span()) for m in compiled.finditer(t)] for t in data["texts"]]})
+json.dump(out, sys.stdout)
+"""
+
+
+def patterns(sanitizer: Sanitizer):
+    yield "pasada única", sanitizer.pattern
+    for kind, (pattern, _) in sanitizer._glued.items():
+        yield f"pegado tras {kind}", pattern
+
+
+def spans(pattern, texts):
+    return [[list(m.span()) for m in pattern.finditer(t)] for t in texts]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compatibilidad con la versión mínima de Python")
+    parser.add_argument("--python", default="python3.10", help="Intérprete a verificar")
+    parser.add_argument("--cases", type=int, default=2000, help="Textos aleatorios además de los casos conocidos")
+    args = parser.parse_args()
+
+    python = shutil.which(args.python) or args.python
+    try:
+        version = subprocess.run(
+            [python, "-c", "import sys; print(sys.version.split()[0])"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        print(f"❌ No se encontró el intérprete {args.python}")
+        return 2
+    print(f"Intérprete: {python} ({version})")
+
+    failures = 0
+    sources = [str(ROOT / d) for d in ("app", "api", "scripts")]
+    compiled = subprocess.run(
+        [python, "-m", "compileall", "-q", "-x", r"__pycache__", *sources], capture_output=True, text=True
+    )
+    if compiled.returncode != 0:
+        failures += 1
+        print(f"❌ Sintaxis no soportada:\n{compiled.stdout}{compiled.stderr}")
+    else:
+        print("✅ Todos los módulos compilan")
+
+    rnd = random.Random(1)
+    texts = KNOWN + [generate(rnd) for _ in range(args.cases)]
+    named = list(patterns(Sanitizer()))
+    payload = json.dumps({"patterns": [p.pattern for _, p in named], "texts": texts})
+    probe = subprocess.run([python, "-c", _PROBE], input=payload, capture_output=True, text=True)
+    if probe.returncode != 0:
+        print(f"❌ Falló la prueba de patrones:\n{probe.stderr}")
+        return 1
+    for (name, pattern), result in zip(named, json.loads(probe.stdout)):
+        if "error" in result:
+            failures += 1
+            print(f"❌ Sanitizador ({name}): no compila: {result['error']}")
+        elif result["spans"] != spans(pattern, texts):
+            failures += 1
+            print(f"❌ Sanitizador ({name}): coincidencias distintas a las de este intérprete")
+        else:
+            print(f"✅ Sanitizador ({name}): mismas coincidencias en {len(texts)} textos")
+
+    if failures:
+        print(f"\n❌ Incompatible con Python {version}")
+        return 1
+    print(f"\n✅ Compatible con Python {version}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+Planes de consulta de las consultas calientes del historial (EXPLAIN QUERY PLAN).
+
+Ejecuta los métodos reales de HistoryService / SessionService / JobService contra
+una base SQLite sembrada, captura el SQL que emiten y falla si alguno recorre una
+tabla completa (`SCAN <tabla>` sin índice) o, en las consultas con ORDER BY +
+LIMIT, si ordena en un B-tree temporal en lugar de leer el índice ya ordenado.
+
+Se revisan dos bases:
+  - nueva: `create_all` + migraciones, como la crea init_db() hoy;
+  - migrada: una copia de una base existente (por defecto data/chat_history.db,
+    con el esquema anterior) a la que se le aplican las migraciones pendientes.
+
+search_chats (LIKE '%texto%') y get_stats (agregados sobre toda la tabla)
+recorren la tabla por diseño y no se revisan.
+
+Uso:
+    python scripts/check_query_plans.py
+    python scripts/check_query_plans.py --db /ruta/copia_produccion.db --verbose
+"""
+
+import argparse
+import random
+import shutil
+import sys
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, List, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.db.database import Base, ChatHistory, ChatJob, DB_PATH
+from app.db.history_service import HistoryService
+from app.db.job_service import JobService
+from app.db.migrations import applied_versions, migrate
+from app.db.partitions import create_partition, month_key, partition_table
+from app.db.session_service import SessionService
+
+CROPS = ["tomate", "maíz", "papa", "lechuga", "fresa", "café"]
+PARAMETERS = ["soil_moisture", "air_temperature", "ph", "ec", "humidity"]
+ENDPOINTS = ["/v1/agro/chat", "/v1/agro/ask", "/v1/agro/jobs"]
+
+
+@dataclass
+class Case:
+    name: str
+    run: Callable[[Session], Any]
+    # El ORDER BY debe salir del índice (sin "USE TEMP B-TREE")
+    ordered: bool = True
+
+
+CASES: List[Case] = [
+    Case("get_sensor_history(crop, parameter)",
+         lambda db: HistoryService.get_sensor_history(db, crop="tomate", parameter="ph", hours=48)),
+    Case("get_sensor_history(parameter)",
+         lambda db: HistoryService.get_sensor_history(db, parameter="ph", hours=48)),
+    # Solo cultivo: busca por el prefijo del índice compuesto y ordena las filas del cultivo
+    Case("get_sensor_history(crop)",
+         lambda db: HistoryService.get_sensor_history(db, crop="tomate", hours=48), ordered=False),
+    Case("get_sensor_history()", lambda db: HistoryService.get_sensor_history(db, hours=48)),
+    Case("get_chats_by_crop", lambda db: HistoryService.get_chats_by_crop(db, "tomate")),
+    Case("get_recent_chats(endpoint)", lambda db: HistoryService.get_recent_chats(db, endpoint="/v1/agro/ask")),
+    Case("get_recent_chats()", lambda db: HistoryService.get_recent_chats(db)),
+    # Validadores de ETag: deben ser búsquedas puntuales, mucho más baratas que la consulta que evitan
+    Case("chats_version", lambda db: HistoryService.chats_version(db)),
+    Case("sensors_version", lambda db: HistoryService.sensors_version(db)),
+    Case("sensors_version(hours)", lambda db: HistoryService.sensors_version(db, hours=48)),
+    Case("iter_chats(crop)", lambda db: next(HistoryService.iter_chats(db, crop="tomate"), None)),
+    Case("SessionService.turns_after", lambda db: SessionService.turns_after(db, "a" * 32, 0)),
+    Case("SessionService.last_turn_id", lambda db: SessionService.last_turn_id(db, "a" * 32)),
+    Case("JobService.claim_next", lambda db: JobService.claim_next(db)),
+]
+
+
+def seed(engine, rows: int) -> None:
+    """Filas con varios cultivos/parámetros/endpoints para que el planificador tenga dónde elegir."""
+    rnd = random.Random(7)
+    now = datetime.utcnow()
+    chats, sensors = [], []
+    for i in range(rows):
+        ts = now - timedelta(minutes=i * 3)
+        crop = rnd.choice(CROPS)
+        parameter = rnd.choice(PARAMETERS)
+        chats.append({
+            "timestamp": ts, "endpoint": rnd.choice(ENDPOINTS), "question": f"consulta {i}",
+            "crop": crop, "answer": "respuesta", "model": "bench",
+            "session_id": ("%032x" % rnd.randrange(50)) if i % 10 == 0 else None,
+        })
+        sensors.append({
+            "timestamp": ts, "crop": crop, "parameter": parameter, "value": rnd.uniform(0, 100),
+            "unit": "%", "action": "mantener",
+        })
+    jobs = [
+        {"id": "%032x" % i, "status": "done" if i % 20 else "queued",
+         "created_at": now - timedelta(minutes=i), "request_json": {"question": "x"}}
+        for i in range(rows // 10)
+    ]
+    by_month = {}
+    for reading in sensors:
+        by_month.setdefault(month_key(reading["timestamp"]), []).append(reading)
+    with engine.begin() as conn:
+        conn.execute(insert(ChatHistory), chats)
+        for key, group in by_month.items():
+            create_partition(conn, key)
+            conn.execute(insert(partition_table(key)), group)
+        conn.execute(insert(ChatJob), jobs)
+
+
+def capture(engine, case: Case) -> List[Tuple[str, Any]]:
+    """SELECTs emitidos por el caso, con sus parámetros (la transacción se descarta)."""
+    statements: List[Tuple[str, Any]] = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", listener)
+    db = sessionmaker(bind=engine)()
+    try:
+        case.run(db)
+    finally:
+        db.rollback()
+        db.close()
+        event.remove(engine, "before_cursor_execute", listener)
+    return statements
+
+
+def problems(plan: List[str], case: Case) -> List[str]:
+    found = []
+    for line in plan:
+        # "SCAN t USING INDEX ..." recorre un índice en orden (válido); "SCAN t" a secas es la tabla completa
+        # sqlite_master: catálogo de particiones (unas pocas filas)
+        if line.startswith("SCAN ") and " USING " not in line and line != "SCAN sqlite_master":
+            found.append(line)
+        if case.ordered and line.startswith("USE TEMP B-TREE"):
+            found.append(line)
+    return found
+
+
+def check(label: str, path: Path, verbose: bool) -> int:
+    engine = create_engine(f"sqlite:///{path}")
+    failures = 0
+    with engine.connect() as conn:
+        versions = applied_versions(conn)
+    print(f"\n== {label}: {path.name} (migraciones {versions}) ==")
+    for case in CASES:
+        statements = capture(engine, case)
+        if not statements:
+            print(f"  ⚠️  {case.name}: no emitió SELECT")
+            continue
+        raw = engine.raw_connection()
+        try:
+            for statement, parameters in statements:
+                rows = raw.cursor().execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                plan = [row[-1] for row in rows]
+                bad = problems(plan, case)
+                mark = "❌" if bad else "✅"
+                print(f"  {mark} {case.name}: {' | '.join(plan)}")
+                if verbose:
+                    print(f"       {' '.join(statement.split())}")
+                failures += bool(bad)
+        finally:
+            raw.close()
+    engine.dispose()
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN de las consultas calientes del historial")
+    parser.add_argument("--rows", type=int, default=5000, help="Filas por tabla en la base nueva")
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="Base existente a copiar y migrar")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar también el SQL")
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        fresh = Path(tmp) / "fresh.db"
+        engine = create_engine(f"sqlite:///{fresh}")
+        Base.metadata.create_all(bind=engine)
+        migrate(engine)
+        seed(engine, args.rows)
+        engine.dispose()
+        failures += check("Base nueva", fresh, args.verbose)
+
+        if args.db and args.db.exists():
+            copy = Path(tmp) / "migrated.db"
+            shutil.copyfile(args.db, copy)
+            engine = create_engine(f"sqlite:///{copy}")
+            Base.metadata.create_all(bind=engine)
+            migrate(engine)
+            engine.dispose()
+            failures += check("Base migrada", copy, args.verbose)
+
+    if failures:
+        print(f"\n❌ {failures} consulta(s) recorren la tabla completa u ordenan sin índice")
+        return 1
+    print("\n✅ Todas las consultas calientes usan índices")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
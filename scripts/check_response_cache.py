@@ -0,0 +1,92 @@
+"""
+Verificación de la selección del backend de la caché de respuestas.
+
+Arma la caché compartida (get_response_cache) con cada RESPONSE_CACHE_BACKEND:
+`sqlite` en un directorio temporal (y una primera petición a /v1/agro/chat con el
+modelo falso, que debe responder 200 y quedar en la caché), `sqlite` sobre una
+ruta que no se puede abrir (cae a la caché en memoria), `memory` y un backend
+desconocido (ValueError). La base del historial también va a un directorio
+temporal, así que no toca data/chat_history.db.
+
+Uso:
+    python scripts/check_response_cache.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+TMP = tempfile.mkdtemp(prefix="agro-cache-")
+os.environ["DATABASE_URL"] = f"sqlite:///{TMP}/history.db"
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ["MOCK_MODE"] = "false"
+
+from app.config import get_settings
+from app.services import response_cache
+from app.services.response_cache import MemoryResponseCache, SQLiteResponseCache, get_response_cache
+
+
+def build(backend: str, path: str = ""):
+    """Caché nueva del proceso con el backend indicado."""
+    os.environ["RESPONSE_CACHE_BACKEND"] = backend
+    os.environ["RESPONSE_CACHE_PATH"] = path or f"{TMP}/response_cache.db"
+    get_settings.cache_clear()
+    response_cache._cache = None
+    return get_response_cache()
+
+
+def check(name: str, ok: bool, detail: str = "") -> bool:
+    print(f"{'✅' if ok else '❌'} {name}{f': {detail}' if detail else ''}")
+    return ok
+
+
+def main() -> int:
+    results = []
+
+    cache = build("sqlite")
+    cache.set("k", {"answer": "hola"})
+    results.append(check(
+        "sqlite",
+        isinstance(cache, SQLiteResponseCache) and cache.get("k") == {"answer": "hola"},
+        type(cache).__name__,
+    ))
+
+    # Primera petición de un worker con la caché SQLite: la arma el propio endpoint
+    response_cache._cache = None
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    with TestClient(app) as client:
+        resp = client.post("/v1/agro/chat", json={"question": "¿Cada cuánto riego el tomate?"})
+    results.append(check(
+        "sqlite: primera petición a /v1/agro/chat",
+        resp.status_code == 200 and isinstance(response_cache._cache, SQLiteResponseCache),
+        f"HTTP {resp.status_code}",
+    ))
+
+    cache = build("sqlite", "/proc/agro-no-existe/response_cache.db")
+    results.append(check("sqlite no disponible → memoria", isinstance(cache, MemoryResponseCache), type(cache).__name__))
+
+    cache = build("memory")
+    results.append(check("memory", isinstance(cache, MemoryResponseCache), type(cache).__name__))
+
+    try:
+        build("redis")
+        results.append(check("backend desconocido", False, "no lanzó ValueError"))
+    except ValueError as e:
+        results.append(check("backend desconocido", True, str(e)))
+
+    if not all(results):
+        print("\n❌ La selección del backend de caché falló")
+        return 1
+    print("\n✅ Backends de caché correctos")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
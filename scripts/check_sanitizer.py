@@ -0,0 +1,105 @@
+"""
+Prueba diferencial del sanitizador: la pasada única (app/utils/sanitize.py) contra
+las pasadas sucesivas originales (email, teléfono, id, url y términos, en ese orden).
+
+Genera textos aleatorios con fragmentos que se pegan entre sí (teléfonos e ids
+seguidos de la parte local de un email, urls, términos sensibles, signos de la
+parte local) más una lista fija de casos conocidos, y falla si alguna salida
+difiere. La única diferencia esperada es que el término más largo gana
+("venenoso" se enmascara completo), así que la referencia usa el mismo orden.
+
+Uso:
+    python scripts/check_sanitizer.py
+    python scripts/check_sanitizer.py --cases 400000 --seed 3
+"""
+
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.utils.sanitize import Sanitizer
+
+# Referencia: las pasadas del sanitizador anterior
+_EMAIL = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+_PHONE = re.compile(r"\b(?:\+?\d{1,3}[\s-]?)?(?:\(\d{2,4}\)|\d{2,4})[\s-]?\d{3,4}[\s-]?\d{3,4}\b")
+_IDLIKE = re.compile(r"\b\d{6,}\b")
+_URL = re.compile(r"https?://\S+")
+# Más largo primero: igual que el trie de la pasada única
+_TERMS = re.compile(r"(?i)venenoso|veneno|matar|explosivo|explosiv|arma|químico\s+peligroso|gramoxone")
+
+
+def reference(text: str) -> str:
+    text = _EMAIL.sub("[email]", text)
+    text = _PHONE.sub("[phone]", text)
+    text = _IDLIKE.sub("[id]", text)
+    text = _URL.sub("[url]", text)
+    return _TERMS.sub("[término sensible]", text)
+
+
+KNOWN = [
+    "abc 123 456 7890@gmail.com",
+    "escribe a juan.perez 987 654 321@hotmail.com",
+    "user+51 987654321@x.com",
+    "(555)1234567@b.com",
+    "555 123 4567.x@b.com",
+    "id 12345678@empresa.pe y 12345678 suelto",
+    "químico peligroso@x.com",
+    "llamar al +51 987 654 321 o a ana@campo.org",
+    "ver http://x.com/?u=a@b.com ahora",
+    "venenoso, Veneno y arma; armando@x.com",
+    "tel 987-654-321-ana@x.com",
+    "1234567@x",
+]
+
+_PIECES = [
+    "123", "4567", "987654321", "12345678", "+51", "(01)", "555", "0",
+    " ", "  ", "-", ".", "+", "_", "%", "@", "@gmail.com", "@x.pe", "@a.b", ".com",
+    "ana", "juan.perez", "x", "Z9", "í", "ñ", "[", ")", "/",
+    "http://", "https://campo.org/", "veneno", "venenoso", "arma", "matar",
+    "explosivo", "químico peligroso", "gramoxone",
+]
+
+
+def generate(rnd: random.Random) -> str:
+    if rnd.random() < 0.5:
+        # Teléfono o id pegado (o casi) a la parte local de un email
+        number = rnd.choice(["123 456 7890", "987 654 321", "+51 987654321", "(01)4567890", "12345678", "5551234"])
+        glue = rnd.choice(["", "", ".", "-", "+", "_", "%", "x", " ", "a."])
+        local = rnd.choice(["", "", "ana", "7", "x.y"])
+        domain = rnd.choice(["@gmail.com", "@hotmail.com", "@x.pe", "@a.b", "@"])
+        prefix = rnd.choice(["", "abc ", "user", "tel: ", "x+", "veneno ", "http://"])
+        return prefix + number + glue + local + domain + rnd.choice(["", " fin", ".", " 123456"])
+    return "".join(rnd.choice(_PIECES) for _ in range(rnd.randint(1, 12)))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Prueba diferencial del sanitizador contra las pasadas originales")
+    parser.add_argument("--cases", type=int, default=200000, help="Textos aleatorios a comparar")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    sanitizer = Sanitizer()
+    rnd = random.Random(args.seed)
+    failures = 0
+    texts = KNOWN + [generate(rnd) for _ in range(args.cases)]
+    for text in texts:
+        expected, got = reference(text), sanitizer.mask(text)
+        if expected != got:
+            failures += 1
+            if failures <= 20:
+                print(f"❌ {text!r}\n     esperado: {expected!r}\n     obtenido: {got!r}")
+    if failures:
+        print(f"\n❌ {failures} de {len(texts)} textos difieren de las pasadas originales")
+        return 1
+    print(f"✅ {len(texts)} textos idénticos a las pasadas originales")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""
+Generador de carga y reproductor de tráfico para la API.
+
+Ejecuta mezclas de escenarios (definidas en un archivo JSON) o reproduce tráfico
+capturado contra /v1/agro/ask, /v1/agro/chat y los endpoints de historial, en
+lazo abierto (tasa de llegada fija) o cerrado (N usuarios concurrentes), ya sea
+sobre HTTP o con la app en proceso. Reporta throughput, p50/p95/p99 y errores
+por endpoint.
+
+Ejemplos:
+    # En proceso, con backend de modelo simulado (números repetibles)
+    python scripts/load_test.py --fake-model --mode closed --concurrency 8 --duration 30
+
+    # Lazo abierto a 20 req/s contra un servidor levantado con MODEL_BACKEND=fake
+    python scripts/load_test.py --url http://127.0.0.1:8000 --mode open --rate 20 --duration 60
+
+    # Reproducir tráfico capturado (JSONL) o filas exportadas de chat_history
+    python scripts/load_test.py --fake-model --replay traffic.jsonl
+    python scripts/load_test.py --fake-model --replay-db data/chat_history.db --requests 500
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+DEFAULT_SCENARIOS = Path(__file__).resolve().parent / "load_scenarios.json"
+
+
+@dataclass
+class Call:
+    """Una petición a enviar."""
+    name: str
+    method: str
+    path: str
+    body: Optional[Dict[str, Any]] = None
+    params: Optional[Dict[str, Any]] = None
+
+
+@dataclass
+class EndpointStats:
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+    ok: int = 0
+    # Llegadas del lazo abierto no enviadas por --max-inflight (fuera de requests y de errores)
+    dropped: int = 0
+
+
+# ---------------------------------------------------------------------------
+# Fuentes de tráfico
+# ---------------------------------------------------------------------------
+
+def load_scenarios(path: Path) -> Iterator[Call]:
+    """Mezcla ponderada infinita a partir de {"scenarios": [{name, weight, method, path, body, params}]}."""
+    config = json.loads(path.read_text(encoding="utf-8"))
+    scenarios = config["scenarios"]
+    calls = [
+        Call(
+            name=s.get("name") or s["path"],
+            method=s.get("method", "GET").upper(),
+            path=s["path"],
+            body=s.get("body"),
+            params=s.get("params"),
+        )
+        for s in scenarios
+    ]
+    weights = [float(s.get("weight", 1)) for s in scenarios]
+    rnd = random.Random(config.get("seed", 1234))
+    while True:
+        yield rnd.choices(calls, weights=weights, k=1)[0]
+
+
+def load_replay_jsonl(path: Path) -> List[Call]:
+    """Tráfico capturado: una línea JSON por petición con {method, path|endpoint, body, params}."""
+    calls = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        rec = json.loads(line)
+        route = rec.get("path") or rec.get("endpoint")
+        if not route:
+            continue
+        body = rec.get("body")
+        calls.append(Call(
+            name=rec.get("name") or route,
+            method=(rec.get("method") or ("POST" if body is not None else "GET")).upper(),
+            path=route,
+            body=body,
+            params=rec.get("params"),
+        ))
+    return calls
+
+
+def load_replay_db(path: Path, limit: int = 10_000) -> List[Call]:
+    """Reconstruye peticiones desde filas exportadas de chat_history (en orden cronológico)."""
+    conn = sqlite3.connect(str(path))
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT endpoint, question, crop, stage, parameter, value, unit, length "
+            "FROM chat_history ORDER BY timestamp LIMIT ?",
+            (limit,),
+        ).fetchall()
+    finally:
+        conn.close()
+    calls = []
+    for r in rows:
+        endpoint = r["endpoint"] or "/v1/agro/ask"
+        if endpoint == "/v1/agro/chat":
+            body = {"question": r["question"] or "", "crop": r["crop"], "stage": r["stage"], "length": r["length"] or "medium"}
+        else:
+            body = {
+                "question": r["question"],
+                "crop": r["crop"],
+                "stage": r["stage"],
+                "parameter": r["parameter"],
+                "value": r["value"],
+                "unit": r["unit"],
+                "length": r["length"],
+            }
+        calls.append(Call(name=endpoint, method="POST", path=endpoint, body={k: v for k, v in body.items() if v is not None}))
+    return calls
+
+
+# ---------------------------------------------------------------------------
+# Ejecución
+# ---------------------------------------------------------------------------
+
+async def _send(client: httpx.AsyncClient, call: Call, stats: Dict[str, EndpointStats], started: float) -> None:
+    st = stats[call.name]
+    try:
+        resp = await client.request(call.method, call.path, json=call.body, params=call.params)
+        if resp.status_code >= 400:
+            st.errors[f"HTTP {resp.status_code}"] += 1
+        else:
+            st.ok += 1
+    except Exception as e:  # timeouts, conexión, etc.
+        st.errors[type(e).__name__] += 1
+    st.latencies_ms.append((time.perf_counter() - started) * 1000.0)
+
+
+async def run_closed(client, source: Iterator[Call], stats, concurrency: int, duration: float, max_requests: Optional[int]):
+    """Lazo cerrado: `concurrency` usuarios que envían la siguiente petición al recibir la anterior."""
+    deadline = time.perf_counter() + duration
+    counter = itertools.count()
+
+    async def user():
+        while time.perf_counter() < deadline:
+            if max_requests is not None and next(counter) >= max_requests:
+                return
+            try:
+                call = next(source)
+            except StopIteration:
+                return
+            await _send(client, call, stats, time.perf_counter())
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+
+
+async def run_open(client, source: Iterator[Call], stats, rate: float, duration: float, max_requests: Optional[int], max_inflight: int):
+    """Lazo abierto: llegadas a tasa fija; la latencia se mide desde la llegada programada."""
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    inflight: set = set()
+    for i in itertools.count():
+        if max_requests is not None and i >= max_requests:
+            break
+        scheduled = start + i * interval
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            call = next(source)
+        except StopIteration:
+            break
+        if len(inflight) >= max_inflight:
+            stats[call.name].dropped += 1
+            continue
+        task = asyncio.create_task(_send(client, call, stats, scheduled))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+    if inflight:
+        await asyncio.gather(*inflight)
+
+
+# ---------------------------------------------------------------------------
+# Reporte
+# ---------------------------------------------------------------------------
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(stats: Dict[str, EndpointStats], elapsed: float) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"elapsed_s": round(elapsed, 3), "endpoints": {}}
+    total = dropped = 0
+    for name, st in sorted(stats.items()):
+        lat = sorted(st.latencies_ms)
+        count = len(lat)
+        total += count
+        dropped += st.dropped
+        report["endpoints"][name] = {
+            "requests": count,
+            "ok": st.ok,
+            "errors": dict(st.errors),
+            "dropped": st.dropped,
+            "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(lat, 50), 2),
+            "p95_ms": round(percentile(lat, 95), 2),
+            "p99_ms": round(percentile(lat, 99), 2),
+            "max_ms": round(lat[-1], 2) if lat else 0.0,
+        }
+    report["total_requests"] = total
+    # No enviadas: el generador no dio abasto, no es un error del servidor
+    report["dropped"] = dropped
+    report["throughput_rps"] = round(total / elapsed, 2) if elapsed else 0.0
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"\n📊 {report['total_requests']} peticiones en {report['elapsed_s']}s ({report['throughput_rps']} req/s)\n")
+    header = f"{'endpoint':28s} {'reqs':>6s} {'rps':>8s} {'p50':>9s} {'p95':>9s} {'p99':>9s}  errores"
+    print(header)
+    print("-" * len(header))
+    for name, e in report["endpoints"].items():
+        errors = ", ".join(f"{k}: {v}" for k, v in e["errors"].items()) or "-"
+        print(f"{name:28s} {e['requests']:6d} {e['throughput_rps']:8.2f} {e['p50_ms']:9.1f} {e['p95_ms']:9.1f} {e['p99_ms']:9.1f}  {errors}")
+    if report["dropped"]:
+        print(
+            f"\n⚠️  {report['dropped']} llegadas descartadas por --max-inflight: no se enviaron y no cuentan"
+            " en peticiones ni en errores; la tasa ofrecida real fue menor que --rate"
+        )
+
+
+def _build_client(args) -> httpx.AsyncClient:
+    timeout = httpx.Timeout(args.timeout)
+    if args.url:
+        limits = httpx.Limits(max_connections=max(args.concurrency, args.max_inflight))
+        return httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits)
+    if args.fake_model:
+        os.environ["MODEL_BACKEND"] = "fake"
+        os.environ["MOCK_MODE"] = "false"
+        os.environ["FAKE_MODEL_LATENCY_MS"] = str(args.fake_latency_ms)
+        # Todo el tráfico sale de un mismo cliente: sin límite por cliente salvo que se indique
+        os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    from app.main import app
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=timeout)
+
+
+async def main_async(args) -> Dict[str, Any]:
+    if args.replay:
+        calls = load_replay_jsonl(args.replay)
+        source: Iterator[Call] = itertools.cycle(calls) if args.loop else iter(calls)
+    elif args.replay_db:
+        calls = load_replay_db(args.replay_db)
+        source = itertools.cycle(calls) if args.loop else iter(calls)
+    else:
+        source = load_scenarios(args.scenarios)
+
+    stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+    async with _build_client(args) as client:
+        t0 = time.perf_counter()
+        if args.mode == "open":
+            await run_open(client, source, stats, args.rate, args.duration, args.requests, args.max_inflight)
+        else:
+            await run_closed(client, source, stats, args.concurrency, args.duration, args.requests)
+        elapsed = time.perf_counter() - t0
+    return summarize(stats, elapsed)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generador de carga / reproducción de tráfico")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="URL base del servidor (por defecto: app en proceso)")
+    target.add_argument("--fake-model", action="store_true", help="En proceso con MODEL_BACKEND=fake")
+    parser.add_argument("--fake-latency-ms", type=float, default=800.0, help="Latencia del modelo simulado")
+
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--scenarios", type=Path, default=DEFAULT_SCENARIOS, help="Archivo JSON con la mezcla de escenarios")
+    source.add_argument("--replay", type=Path, help="JSONL con tráfico capturado")
+    source.add_argument("--replay-db", type=Path, help="SQLite con filas de chat_history a reproducir")
+    parser.add_argument("--loop", action="store_true", help="Repetir el tráfico reproducido hasta agotar duración")
+
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", type=int, default=4, help="Usuarios concurrentes (lazo cerrado)")
+    parser.add_argument("--rate", type=float, default=5.0, help="Llegadas por segundo (lazo abierto)")
+    parser.add_argument("--max-inflight", type=int, default=256, help="Peticiones simultáneas máximas (lazo abierto)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duración en segundos")
+    parser.add_argument("--requests", type=int, default=None, help="Número máximo de peticiones")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout por petición en segundos")
+    parser.add_argument("--json", type=Path, default=None, help="Guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.json:
+        args.json.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"\n💾 Reporte guardado en {args.json}")
+    errors = sum(sum(e["errors"].values()) for e in report["endpoints"].values())
+    return 1 if report["total_requests"] and errors == report["total_requests"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
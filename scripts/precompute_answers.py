@@ -0,0 +1,254 @@
+"""
+Precálculo fuera de hora pico de las respuestas más consultadas.
+
+Extrae de chat_history las preguntas más frecuentes (texto normalizado + cultivo,
+etapa y longitud) y/o las lee de un archivo semilla, las responde con
+GeminiClient con concurrencia y ritmo acotados y deja cada respuesta en la caché
+compartida (RESPONSE_CACHE_BACKEND=sqlite) con un TTL largo. Las claves llevan la
+versión de la caché (hash del prompt de sistema + modelo): si cambia cualquiera
+de los dos, las entradas precalculadas dejan de usarse y la próxima corrida las
+regenera.
+
+Las lecturas de sensores no pasan por la caché de respuestas (el valor cambia en
+cada lectura); para ellas el script lista las combinaciones (cultivo, etapa,
+parámetro) más frecuentes que no tienen una regla específica del cultivo, que es
+lo que permite responderlas sin modelo (RULES_FIRST).
+
+Uso:
+    python scripts/precompute_answers.py --dry-run                   # ver candidatas
+    python scripts/precompute_answers.py --top 300 --concurrency 2 --rpm 30 --until 05:30
+    python scripts/precompute_answers.py --seed preguntas.jsonl --no-history
+
+Archivo semilla: JSON (lista) o JSONL con {"question", "crop", "stage", "length"}.
+Cron sugerido (02:00 todas las noches):
+    0 2 * * * cd /srv/agro && RESPONSE_CACHE_BACKEND=sqlite python scripts/precompute_answers.py --until 05:30
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.config import get_settings
+from app.schemas.requests import AskRequest
+from app.services.gemini_client import get_gemini_client
+from app.services.response_cache import MemoryResponseCache, cache_version, get_response_cache
+from app.services.rules_engine import ANY, get_rules_engine
+from app.utils.deadline import Deadline
+
+# Endpoints cuyas preguntas pasan por la caché de respuestas (chat sin sensores)
+CHAT_ENDPOINTS = ("/v1/agro/chat", "/v1/agro/jobs")
+
+
+@dataclass
+class Candidate:
+    question: str
+    crop: Optional[str] = None
+    stage: Optional[str] = None
+    length: Optional[str] = None
+    count: int = 0
+    source: str = "history"
+
+
+def mine_history(top: int, days: int, min_count: int) -> Tuple[List[Candidate], List[Tuple[Tuple[str, str, str], int]]]:
+    """Preguntas y combinaciones de sensores más frecuentes de los últimos `days` días."""
+    from sqlalchemy import func, select
+
+    from app.db.database import ChatHistory, SessionLocal
+    from app.db.history_service import HistoryService
+
+    since = datetime.utcnow() - timedelta(days=days)
+    db = SessionLocal()
+    try:
+        norm = func.lower(func.trim(ChatHistory.question))
+        n = func.count(ChatHistory.id)
+        rows = db.execute(
+            select(func.max(ChatHistory.question), ChatHistory.crop, ChatHistory.stage, ChatHistory.length, n)
+            .where(
+                ChatHistory.endpoint.in_(CHAT_ENDPOINTS),
+                ChatHistory.question.is_not(None),
+                ChatHistory.error.is_(None),
+                # Con sesión la respuesta depende de la conversación previa
+                ChatHistory.session_id.is_(None),
+                ChatHistory.timestamp >= since,
+            )
+            .group_by(norm, ChatHistory.crop, ChatHistory.stage, ChatHistory.length)
+            .having(n >= min_count)
+            .order_by(n.desc())
+            .limit(top)
+        ).all()
+        candidates = [
+            Candidate(question=q, crop=crop, stage=stage, length=length, count=count)
+            for q, crop, stage, length, count in rows
+        ]
+        # Lecturas: agregadas por partición mensual y sumadas
+        sensors: Counter = Counter()
+        for table in HistoryService.sensor_tables(db, since):
+            for c, s, p, k in db.execute(
+                select(table.c.crop, table.c.stage, table.c.parameter, func.count())
+                .where(table.c.timestamp >= since)
+                .group_by(table.c.crop, table.c.stage, table.c.parameter)
+            ):
+                sensors[(c, s, p)] += k
+    finally:
+        db.close()
+    return candidates, sensors.most_common(top)
+
+
+def load_seed(path: Path) -> List[Candidate]:
+    text = path.read_text(encoding="utf-8")
+    if text.lstrip().startswith("["):
+        items = json.loads(text)
+    else:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [
+        Candidate(
+            question=item["question"],
+            crop=item.get("crop"),
+            stage=item.get("stage"),
+            length=item.get("length"),
+            source="seed",
+        )
+        for item in items
+        if item.get("question")
+    ]
+
+
+def uncovered_sensor_tuples(tuples: List[Tuple[Tuple[str, str, str], int]]) -> List[Tuple[Tuple[str, str, str], int]]:
+    """Combinaciones frecuentes sin regla específica del cultivo (siempre requieren el modelo)."""
+    engine = get_rules_engine()
+    out = []
+    for (crop, stage, parameter), count in tuples:
+        param = engine.parameter(AskRequest._map_parameter(parameter))
+        rule = engine.lookup(param, engine.crop(crop), engine.stage(stage)) if param else None
+        if rule is None or rule.crop == ANY or not rule.has_range:
+            out.append(((crop, stage, parameter), count))
+    return out
+
+
+def _parse_until(value: Optional[str]) -> Optional[datetime]:
+    """HH:MM local de hoy (o de mañana si ya pasó)."""
+    if not value:
+        return None
+    hour, minute = (int(x) for x in value.split(":"))
+    now = datetime.now()
+    until = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return until if until > now else until + timedelta(days=1)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Precalcula respuestas frecuentes en la caché compartida")
+    parser.add_argument("--top", type=int, default=200, help="Preguntas más frecuentes a precalcular")
+    parser.add_argument("--days", type=int, default=30, help="Días de historial a considerar")
+    parser.add_argument("--min-count", type=int, default=2, help="Repeticiones mínimas de una pregunta")
+    parser.add_argument("--seed", type=Path, default=None, help="Archivo JSON/JSONL con preguntas adicionales")
+    parser.add_argument("--no-history", action="store_true", help="No leer chat_history (solo --seed)")
+    parser.add_argument("--concurrency", type=int, default=2, help="Llamadas simultáneas al modelo")
+    parser.add_argument("--rpm", type=float, default=30.0, help="Llamadas por minuto como máximo (0 = sin límite)")
+    parser.add_argument("--ttl-s", type=float, default=86400.0, help="Vigencia de las respuestas precalculadas")
+    parser.add_argument("--timeout-s", type=float, default=None, help="Presupuesto por pregunta (por defecto TIMEOUT_S)")
+    parser.add_argument("--until", default=None, help="Hora local HH:MM a partir de la cual no se envían más preguntas")
+    parser.add_argument("--dry-run", action="store_true", help="Solo listar candidatas, sin llamar al modelo")
+    args = parser.parse_args()
+
+    settings = get_settings()
+    cache = get_response_cache()
+    if isinstance(cache, MemoryResponseCache) and not args.dry_run:
+        print("❌ RESPONSE_CACHE_BACKEND=memory: lo precalculado se perdería al terminar el script.")
+        print("   Usa RESPONSE_CACHE_BACKEND=sqlite (el mismo RESPONSE_CACHE_PATH que el servidor).")
+        return 2
+    if settings.mock_mode and not args.dry_run:
+        print("❌ MOCK_MODE=true: las respuestas de demostración no se cachean.")
+        return 2
+
+    candidates: List[Candidate] = []
+    sensor_tuples: List[Tuple[Tuple[str, str, str], int]] = []
+    if not args.no_history:
+        candidates, sensor_tuples = mine_history(args.top, args.days, args.min_count)
+    if args.seed:
+        candidates += load_seed(args.seed)
+
+    client = get_gemini_client()
+    print(f"Versión de caché: {cache_version(client.prompt_text, client._cache_model('medium'))}")
+
+    # La misma pregunta puede aparecer con otra capitalización o espacios: una sola clave
+    pending: Dict[str, Tuple[Candidate, AskRequest]] = {}
+    for cand in candidates:
+        req = AskRequest(question=cand.question, crop=cand.crop, stage=cand.stage, length=cand.length)
+        key = client._cache_key(req, req.length or "medium")
+        if key not in pending:
+            pending[key] = (cand, req)
+    print(f"Candidatas: {len(pending)} ({len(candidates)} antes de deduplicar)")
+
+    if args.dry_run:
+        for cand, _ in pending.values():
+            print(f"  {cand.count:6d}  [{cand.source}] {cand.crop or '-'} / {cand.stage or '-'} / {cand.length or '-'}: {cand.question[:90]}")
+    stats: Counter = Counter()
+    lock = threading.Lock()
+
+    def generate(key: str, req: AskRequest) -> None:
+        timeout = args.timeout_s or settings.timeout_s
+        try:
+            client.ask(req, Deadline(timeout))
+        except Exception as e:
+            with lock:
+                stats["failed"] += 1
+            print(f"  ⚠️  {req.question[:60]}: {e}")
+            return
+        # ask() solo cachea respuestas válidas (no degradadas ni bloqueadas); se extiende su vigencia
+        value = cache.get(key)
+        with lock:
+            if value is None:
+                stats["not_cacheable"] += 1
+                return
+            stats["generated"] += 1
+        cache.set(key, value, ttl_s=args.ttl_s)
+
+    if not args.dry_run:
+        until = _parse_until(args.until)
+        interval = 60.0 / args.rpm if args.rpm > 0 else 0.0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            next_at = time.monotonic()
+            for key, (cand, req) in pending.items():
+                cached = cache.get(key)
+                if cached is not None:
+                    # Misma versión: la respuesta sigue siendo válida, solo se extiende su vigencia
+                    cache.set(key, cached, ttl_s=args.ttl_s)
+                    stats["reused"] += 1
+                    continue
+                if until is not None and datetime.now() >= until:
+                    stats["deferred"] += 1
+                    continue
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at = max(next_at, time.monotonic()) + interval
+                pool.submit(generate, key, req)
+        print(
+            f"\nGeneradas: {stats['generated']}, reutilizadas: {stats['reused']}, "
+            f"no cacheables: {stats['not_cacheable']}, fallidas: {stats['failed']}, "
+            f"pospuestas: {stats['deferred']} ({time.perf_counter() - start:.1f} s)"
+        )
+
+    uncovered = uncovered_sensor_tuples(sensor_tuples)
+    if uncovered:
+        print("\nLecturas frecuentes sin regla específica del cultivo (siempre llaman al modelo):")
+        for (crop, stage, parameter), count in uncovered[:20]:
+            print(f"  {count:6d}  {crop or '-'} / {stage or '-'} / {parameter}")
+    return 1 if stats["failed"] and not stats["generated"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())